@@ -1,7 +1,7 @@
 import flask
 import telegram
 
-from stickertaggerbot import config, flask_app, logging
+from stickertaggerbot import config, flask_app, logging, webhook
 
 app_config = {"SQLALCHEMY_DATABASE_URI": config.DATABASE_URI,
               "SQLALCHEMY_TRACK_MODIFICATIONS": False}
@@ -13,8 +13,19 @@ application = flask_app.Application(app_config)
 def route_update():
     update_json = flask.request.get_json()
     update = telegram.Update.de_json(update_json, application.bot)
+
+    reply = config.WEBHOOK_REPLY_TIMEOUT and webhook.expects_reply(update)
+    if reply:
+        application.replies.expect(update)
+
     application.update_queue.put(update)
-    logging.get_logger(logging.Type.APP).info("Received update " +
-                                              str(update.update_id))
+    logging.get_logger(logging.Type.APP).info("Received update %s",
+                                              update.update_id)
+
+    if reply:
+        payload = application.replies.wait(update,
+                                           config.WEBHOOK_REPLY_TIMEOUT)
+        if payload:
+            return flask.jsonify(payload)
     return ""
 
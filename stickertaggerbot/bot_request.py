@@ -0,0 +1,46 @@
+import telegram.utils.request
+
+
+# Parses "method=seconds,method=seconds", e.g. "answerInlineQuery=2"
+def parse_timeouts(timeouts):
+    parsed = {}
+    for setting in timeouts.split(","):
+        if setting.strip():
+            method, seconds = setting.split("=")
+            parsed[method.strip()] = float(seconds)
+    return parsed
+
+
+# Connection pool shared by every thread calling the Bot API, with read
+# timeouts per Bot API method. Connections are kept alive between calls.
+# read_timeouts: Bot API method -> seconds, overriding read_timeout
+class Request(telegram.utils.request.Request):
+    def __init__(self, con_pool_size, connect_timeout, read_timeout,
+                 read_timeouts=None):
+        super().__init__(con_pool_size=con_pool_size,
+                         connect_timeout=connect_timeout,
+                         read_timeout=read_timeout)
+        self.read_timeouts = read_timeouts or {}
+
+    def _timeout(self, url, timeout):
+        if timeout is None:
+            method = url.rsplit("/", 1)[-1]
+            timeout = self.read_timeouts.get(method)
+        return timeout
+
+    def get(self, url, timeout=None):
+        return super().get(url, timeout=self._timeout(url, timeout))
+
+    def post(self, url, data, timeout=None):
+        return super().post(url, data, timeout=self._timeout(url, timeout))
+
+    # Returns (connections opened, requests made) over all hosts.
+    # Requests beyond the connections opened reused a kept alive
+    # connection.
+    def connection_counts(self):
+        pools = self._con_pool.pools
+        with pools.lock:
+            host_pools = list(pools._container.values())
+
+        return (sum(pool.num_connections for pool in host_pools),
+                sum(pool.num_requests for pool in host_pools))
@@ -1,6 +1,8 @@
 from enum import Enum
 
-from stickertaggerbot import conversations
+import itsdangerous
+
+from stickertaggerbot import config, conversations
 
 
 class CallbackData(object):
@@ -10,6 +12,11 @@ class CallbackData(object):
 
     SEPARATOR = "+"
 
+    # Keys of pending labels are signed, so that they cannot be guessed.
+    # A signed key is 39 characters, within the 64 bytes allowed for
+    # callback data along with the button text and state.
+    signer = itsdangerous.Signer(config.TELEGRAM_TOKEN, salt="pending_labels")
+
     # Strings
     def __init__(self, state, state_identifier, button_text=None):
         self.state = state
@@ -30,3 +37,15 @@ class CallbackData(object):
         button_text = CallbackData.ButtonText(button_text_value)
 
         return cls(state, state_identifier, button_text)
+
+    @classmethod
+    def sign(cls, key):
+        return cls.signer.sign(key.encode()).decode()
+
+    # Returns None if signed_key was not signed by sign
+    @classmethod
+    def unsign(cls, signed_key):
+        try:
+            return cls.signer.unsign(signed_key.encode()).decode()
+        except itsdangerous.BadSignature:
+            return None
@@ -0,0 +1,68 @@
+import queue
+import threading
+
+import telegram
+
+
+# Tracks the latest inline query received from each user, so that queries
+# superseded by a newer one from the same user can be skipped.
+# Telegram only uses the answer to a user's latest query.
+class InlineQueryCoalescer(object):
+    def __init__(self):
+        self.dropped = 0  # superseded before they started
+        self.cancelled = 0  # superseded while in flight
+        self._latest = {}  # user id -> update id of latest inline query
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._latest)
+
+    def register(self, update):
+        if not update.inline_query:
+            return
+
+        user_id = update.inline_query.from_user.id
+        with self._lock:
+            latest = self._latest.get(user_id)
+            if latest is None or update.update_id > latest:
+                self._latest[user_id] = update.update_id
+
+    def _is_superseded(self, update):
+        user_id = update.inline_query.from_user.id
+        with self._lock:
+            latest = self._latest.get(user_id)
+        return latest is not None and latest > update.update_id
+
+    # Call before handling an update
+    def drop(self, update):
+        if self._is_superseded(update):
+            self.dropped += 1
+            return True
+        return False
+
+    # Call at checkpoints while handling an update, e.g. before answering
+    def cancel(self, update):
+        if self._is_superseded(update):
+            self.cancelled += 1
+            return True
+        return False
+
+    # Call after handling an update, superseded or not
+    def finish(self, update):
+        user_id = update.inline_query.from_user.id
+        with self._lock:
+            if self._latest.get(user_id) == update.update_id:
+                del self._latest[user_id]
+
+
+# Update queue that registers inline queries with a coalescer as they are
+# queued, before the dispatcher hands them to handlers
+class CoalescingQueue(queue.Queue):
+    def __init__(self, coalescer, maxsize=0):
+        super().__init__(maxsize)
+        self.coalescer = coalescer
+
+    def put(self, item, block=True, timeout=None):
+        if isinstance(item, telegram.Update):
+            self.coalescer.register(item)
+        super().put(item, block, timeout)
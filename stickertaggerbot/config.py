@@ -2,8 +2,86 @@ import os
 
 TELEGRAM_TOKEN = os.environ["TELEGRAM_TOKEN"]
 
+# Threads running handlers and their background tasks
 MAX_WORKERS = int(os.environ["MAX_WORKERS"])
 
+# Caps the workers each lane of handlers may use at once, e.g.
+# "chat=3,bookkeeping=1". By default, inline queries may use every worker,
+# chat handlers half, and sticker checks and bookkeeping an eighth each.
+EXECUTOR_LANE_LIMITS = os.environ.get("EXECUTOR_LANE_LIMITS", "")
+
+# Bot API timeouts in seconds. BOT_READ_TIMEOUTS overrides the read timeout
+# per method, e.g. "answerInlineQuery=2,sendMessage=10"
+BOT_CONNECT_TIMEOUT = float(os.environ.get("BOT_CONNECT_TIMEOUT", 5))
+BOT_READ_TIMEOUT = float(os.environ.get("BOT_READ_TIMEOUT", 5))
+BOT_READ_TIMEOUTS = os.environ.get("BOT_READ_TIMEOUTS",
+                                   "answerInlineQuery=2")
+
+# Total number of associations held by the in-memory inline query index
+INDEX_MAX_ASSOCIATIONS = int(os.environ.get("INDEX_MAX_ASSOCIATIONS",
+                                            1000000))
+
+# Number of label text -> id mappings cached per process
+LABEL_CACHE_SIZE = int(os.environ.get("LABEL_CACHE_SIZE", 100000))
+
+# Usage counts are written every USAGE_FLUSH_INTERVAL seconds, or once
+# USAGE_FLUSH_EVENTS increments are pending
+USAGE_FLUSH_INTERVAL = float(os.environ.get("USAGE_FLUSH_INTERVAL", 10))
+USAGE_FLUSH_EVENTS = int(os.environ.get("USAGE_FLUSH_EVENTS", 100))
+
+# Pending usage counts are dropped after USAGE_FLUSH_RETRIES consecutive
+# failed flushes, so that they do not grow without bound while the
+# database is unavailable
+USAGE_FLUSH_RETRIES = int(os.environ.get("USAGE_FLUSH_RETRIES", 5))
+
+# Conversations unused for CONVERSATION_TIMEOUT seconds are dropped, and
+# idle ones are evicted beyond MAX_CONVERSATIONS
+CONVERSATION_TIMEOUT = float(os.environ.get("CONVERSATION_TIMEOUT", 3600))
+MAX_CONVERSATIONS = int(os.environ.get("MAX_CONVERSATIONS", 10000))
+
+# Number of independently locked parts of the conversation registry
+CONVERSATION_STRIPES = int(os.environ.get("CONVERSATION_STRIPES", 16))
+
+# Path of an SQLite database to share conversations between processes.
+# If unset, conversations are kept in memory by each process.
+CONVERSATION_DATABASE = os.environ.get("CONVERSATION_DATABASE")
+
+# Set to keep labelling in progress in the database instead of in
+# conversations, so that any process can handle any step
+STATELESS_LABELLING = bool(os.environ.get("STATELESS_LABELLING"))
+
+# Set to match labels in inline queries by full-text search, in the
+# configuration for the user's language, so that e.g. "cats" finds "cat".
+# Each query matches at most LABEL_SEARCH_LIMIT labels, best first.
+FULL_TEXT_SEARCH = bool(os.environ.get("FULL_TEXT_SEARCH"))
+LABEL_SEARCH_LIMIT = int(os.environ.get("LABEL_SEARCH_LIMIT", 100))
+
+# Seconds the webhook waits for handlers to reply in its response, for
+# inline queries and single message replies. 0 disables this.
+WEBHOOK_REPLY_TIMEOUT = float(os.environ.get("WEBHOOK_REPLY_TIMEOUT", 0))
+
+# Messages are sent by OUTBOX_SENDERS threads, at most OUTBOX_GLOBAL_RATE
+# per second overall and OUTBOX_CHAT_RATE per second per chat.
+# 0 senders sends messages from handler threads instead.
+OUTBOX_SENDERS = int(os.environ.get("OUTBOX_SENDERS", 2))
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", 30))
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", 1))
+
+# Database connections kept open by each process, and opened beyond that
+# under load
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW", 10))
+
+# Set to test connections before each checkout, replacing those the server
+# has dropped
+DATABASE_POOL_PRE_PING = bool(os.environ.get("DATABASE_POOL_PRE_PING"))
+
+# URI of a read replica for handlers that only read. Users who wrote in the
+# last DATABASE_REPLICA_STICKINESS seconds keep reading from the primary.
+DATABASE_REPLICA_URI = os.environ.get("DATABASE_REPLICA_URI")
+DATABASE_REPLICA_STICKINESS = float(
+    os.environ.get("DATABASE_REPLICA_STICKINESS", 30))
+
 db_name = os.environ["DATABASE_NAME"]
 db_endpoint = os.environ["DATABASE_ENDPOINT"]
 db_port = os.environ["DATABASE_PORT"]
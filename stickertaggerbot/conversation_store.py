@@ -0,0 +1,120 @@
+import sqlite3
+import threading
+import time
+
+
+# Conversation stores keep a serialized conversation per user, with a
+# version that is incremented on every save, so that a process can only
+# overwrite a conversation it has seen the latest version of.
+#
+# load(user_id) -> (version, serialized, updated) or None
+#   updated is the time.time() of the last save
+# save(user_id, serialized, version) -> new version, or None if the stored
+#   version is not version. version None saves only if there is none.
+# delete(user_id)
+# expire(before) -> number of conversations last saved before before
+
+
+# Store local to the process, for tests and single process deployments
+class MemoryStore(object):
+    def __init__(self):
+        self._records = {}  # user id -> (version, serialized, updated)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._records)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def load(self, user_id):
+        return self._records.get(user_id)
+
+    def save(self, user_id, serialized, version):
+        with self._lock:
+            record = self._records.get(user_id)
+            current_version = record[0] if record else None
+            if current_version != version:
+                return None
+
+            new_version = (version or 0) + 1
+            self._records[user_id] = (new_version, serialized, time.time())
+            return new_version
+
+    def delete(self, user_id):
+        with self._lock:
+            self._records.pop(user_id, None)
+
+    def expire(self, before):
+        with self._lock:
+            expired = [user_id for user_id, (_, _, updated)
+                       in self._records.items() if updated < before]
+            for user_id in expired:
+                del self._records[user_id]
+        return len(expired)
+
+
+# Store in an SQLite database on local disk, shared by all processes on
+# the host. Each thread uses its own connection.
+class SQLiteStore(object):
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS conversation ("
+                           "user_id INTEGER PRIMARY KEY, "
+                           "version INTEGER NOT NULL, "
+                           "serialized BLOB NOT NULL, "
+                           "updated REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS "
+                           "ix_conversation_updated ON conversation (updated)")
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit, since every statement stands alone
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def __len__(self):
+        count, = self._connection().execute(
+            "SELECT count(*) FROM conversation").fetchone()
+        return count
+
+    def clear(self):
+        self._connection().execute("DELETE FROM conversation")
+
+    def load(self, user_id):
+        return self._connection().execute(
+            "SELECT version, serialized, updated FROM conversation "
+            "WHERE user_id = ?", (user_id,)).fetchone()
+
+    def save(self, user_id, serialized, version):
+        if version is None:
+            cursor = self._connection().execute(
+                "INSERT OR IGNORE INTO conversation "
+                "(user_id, version, serialized, updated) VALUES (?, 1, ?, ?)",
+                (user_id, serialized, time.time()))
+            return 1 if cursor.rowcount == 1 else None
+
+        cursor = self._connection().execute(
+            "UPDATE conversation "
+            "SET version = version + 1, serialized = ?, updated = ? "
+            "WHERE user_id = ? AND version = ?",
+            (serialized, time.time(), user_id, version))
+        return version + 1 if cursor.rowcount == 1 else None
+
+    def delete(self, user_id):
+        self._connection().execute(
+            "DELETE FROM conversation WHERE user_id = ?", (user_id,))
+
+    def expire(self, before):
+        cursor = self._connection().execute(
+            "DELETE FROM conversation WHERE updated < ?", (before,))
+        return cursor.rowcount
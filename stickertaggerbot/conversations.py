@@ -1,12 +1,68 @@
 import logging
 import threading
 import enum
+import collections
 import concurrent.futures
+import heapq
+import itertools
+import json
+import time
+import weakref
+
+import telegram
+
+from stickertaggerbot import config, conversation_store
 
-all = {}
-lock = threading.Lock()
 logger = logging.getLogger("conversations")
 
+# Seconds to wait for the previous state's action before giving up
+WAIT_TIMEOUT = 10
+
+
+# Calls callbacks once their deadline passes, all from a single thread
+class Deadlines(object):
+    def __init__(self):
+        self._deadlines = []  # heap of (deadline, sequence, callback)
+        self._sequence = itertools.count()  # breaks ties between deadlines
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    # delay in seconds
+    def call_later(self, delay, callback):
+        with self._condition:
+            heapq.heappush(self._deadlines, (time.monotonic() + delay,
+                                             next(self._sequence), callback))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name="deadlines", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._deadlines:
+                    self._condition.wait()
+                    continue
+
+                deadline, _, callback = self._deadlines[0]
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                heapq.heappop(self._deadlines)
+
+            try:
+                callback()
+            except Exception as e:
+                logger.error(e)
+
+
+deadlines = Deadlines()
+
 
 class Conversation(object):
     # States should typically transition as per the listed order
@@ -23,10 +79,15 @@ class Conversation(object):
         self.user = user
         self.chat = chat
         self.state = Conversation.State.IDLE
-        self._lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._condition = threading.Condition(self._lock)
         self._sticker = None
         self._labels = None
         self._future = None
+        self.last_used = None  # set by Registry
+        self._store = None  # set by SharedRegistry
+        self._version = None
+        self._futures = None  # set by SharedRegistry
 
     @property
     def sticker(self):
@@ -34,7 +95,12 @@ class Conversation(object):
 
     @sticker.setter
     def sticker(self, sticker):
-        self._sticker = sticker
+        def apply():
+            self._sticker = sticker
+
+        with self._lock:
+            apply()
+            self._save(apply)
 
     @property
     def labels(self):
@@ -42,7 +108,87 @@ class Conversation(object):
 
     @labels.setter
     def labels(self, labels):
-        self._labels = labels
+        def apply():
+            self._labels = labels
+
+        with self._lock:
+            apply()
+            self._save(apply)
+
+    # Compact form for conversation stores, without the future, which is
+    # local to the process waiting on it
+    def dumps(self):
+        data = {"u": self.user.to_dict(),
+                "c": self.chat.to_dict(),
+                "s": self.state.value,
+                "k": self._sticker.to_dict() if self._sticker else None,
+                "l": self._labels}
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    @classmethod
+    def loads(cls, serialized):
+        conversation = cls(None, None)
+        conversation._apply(serialized)
+        return conversation
+
+    def _apply(self, serialized):
+        data = json.loads(serialized.decode())
+        self.user = telegram.User.de_json(data["u"], None)
+        self.chat = telegram.Chat.de_json(data["c"], None)
+        self.state = Conversation.State(data["s"])
+        self._sticker = telegram.Sticker.de_json(data["k"], None)
+        self._labels = data["l"]
+
+    # Stores this conversation in store, and keeps it there on changes
+    def bind(self, store, version=None):
+        with self._lock:
+            self._store = store
+            self._version = version
+            self._save()
+
+    # Must be called while holding self._lock
+    def _reload(self):
+        record = self._store.load(self.user.id)
+        if record is None:
+            # Expired by another process
+            self.state = Conversation.State.IDLE
+            self._sticker = None
+            self._labels = None
+            self._version = None
+        else:
+            self._version, serialized, _ = record
+            self._apply(serialized)
+
+        if self._futures is not None:
+            self._future = self._futures.get(self.user.id)
+
+    # Sets the current future, sharing it with other copies of this
+    # conversation loaded by the process.
+    # Must be called while holding self._lock
+    def _set_future(self, future):
+        self._future = future
+        if self._futures is not None:
+            if future is None:
+                self._futures.pop(self.user.id, None)
+            else:
+                self._futures[self.user.id] = future
+
+    # Writes this conversation to its store, if any. If another process
+    # changed it since it was loaded, reloads it and calls reapply before
+    # trying again, or raises ValueError if there is no reapply.
+    # Must be called while holding self._lock
+    def _save(self, reapply=None):
+        while self._store is not None:
+            version = self._store.save(self.user.id, self.dumps(),
+                                       self._version)
+            if version is not None:
+                self._version = version
+                return
+
+            self._reload()
+            if reapply is None:
+                raise ValueError(self.state)
+            reapply()
 
     # Returns True if state is None and self.state is IDLE
     #                 state is None and future is done
@@ -62,18 +208,50 @@ class Conversation(object):
         return self.state == Conversation.State.IDLE
 
     def reset_state(self):
-        with self._lock:
+        def apply():
             self.state = Conversation.State.IDLE
             if self._future:
                 self._future.cancel()
-            self._future = None
+            self._set_future(None)
+            self._condition.notify_all()
+
+        with self._lock:
+            apply()
+            self._save(apply)
 
     def __change_state(self, new_state, future):
         with self._lock:
             self.state = new_state
             if self._future:
                 self._future.cancel()
-            self._future = future
+            self._set_future(future)
+            self._condition.notify_all()
+
+    def _notify_waiters(self, future):
+        with self._condition:
+            self._condition.notify_all()
+
+    # Sleeps until the current future is done, or the timeout has passed.
+    # Returns False on timeout.
+    # Must be called while holding self._lock
+    def _wait_for_future(self, timeout):
+        deadline = time.monotonic() + timeout
+        future = None
+        while self._future and not self._future.done():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+
+            # Registered once per future, since other changes also wake
+            # this thread. Called immediately if the future completed in
+            # the meantime, otherwise from the thread completing it, which
+            # has to wait for the lock until this thread is waiting
+            if self._future is not future:
+                future = self._future
+                future.add_done_callback(self._notify_waiters)
+            if not future.done():
+                self._condition.wait(remaining)
+        return True
 
     # Change state to typical previous state, unless otherwise specified
     # If specifying future, state must also be specified
@@ -81,70 +259,84 @@ class Conversation(object):
         if future and not state:
             raise ValueError()
 
-        with self._lock:
+        def apply():
             if state:
                 if self.state == Conversation.State.STICKER:
-                    self.sticker = None
+                    self._sticker = None
                 elif self.state == Conversation.State.LABEL:
-                    self.labels = None
+                    self._labels = None
                 self.state = state
 
             if future:
-                self._future = future
+                self._set_future(future)
+                self._condition.notify_all()
 
             if state is None and future is None:
                 if self._future:
                     self._future.cancel()
 
                 if self.state == Conversation.State.STICKER:
-                    self.sticker = None
+                    self._sticker = None
                 elif self.state == Conversation.State.LABEL:
-                    self.labels = None
+                    self._labels = None
 
                 if self.state != Conversation.State.IDLE:
                     self.state = Conversation.State(self.state.value - 1)
 
-    def change_state(self, new_state, future=None, force=False):
+        with self._lock:
+            apply()
+            self._save(apply)
+
+    # Raises ValueError if the transition is out of order, if the
+    # previous state's action does not complete within timeout seconds, or
+    # if another process changed the conversation meanwhile
+    def change_state(self, new_state, future=None, force=False,
+                     timeout=WAIT_TIMEOUT):
         if force:
-            self.__change_state(new_state, future)
+            with self._lock:
+                self.__change_state(new_state, future)
+                self._save(lambda: self.__change_state(new_state, future))
             return
 
-        # Block until previous state's action is complete
-        elif self._future:
-            while not self._future.done():
-                pass
+        with self._lock:
+            # Block until previous state's action is complete
+            if not self._wait_for_future(timeout):
+                raise ValueError(self.state)
+
+            if self._store is not None:
+                self._reload()
+
+            # Enforce state transition order
+            try:
+                if new_state == Conversation.State.STICKER:
+                    assert self.state == Conversation.State.IDLE
+                elif new_state == Conversation.State.LABEL:
+                    assert (self.state == Conversation.State.STICKER or
+                            self.state == Conversation.State.LABEL)
+                elif new_state == Conversation.State.CONFIRMED:
+                    assert self.state == Conversation.State.LABEL
+            except AssertionError:
+                raise ValueError(self.state)
+
+            old_state = self.state
+            self.__change_state(new_state, future)
+            self._save()
 
-        # Enforce state transition order
-        try:
-            if new_state == Conversation.State.STICKER:
-                assert self.state == Conversation.State.IDLE
-            elif new_state == Conversation.State.LABEL:
-                assert (self.state == Conversation.State.STICKER or
-                        self.state == Conversation.State.LABEL)
-            elif new_state == Conversation.State.CONFIRMED:
-                assert self.state == Conversation.State.LABEL
-        except AssertionError:
-            raise ValueError(self.state)
-
-        logger = logging.getLogger("conversation." + str(self.user.id))
-        logger.debug("Transiting from " + str(self.state) +
-                     " to " + str(new_state))
-
-        self.__change_state(new_state, future)
-
-    def update_future(self, new_future, force=False):
-        if force:
-            with self._lock:
+        logger.debug("User %s transited from %s to %s",
+                     self.user.id, old_state, new_state)
+
+    # Raises ValueError if the current future does not complete within
+    # timeout seconds, unless forced
+    def update_future(self, new_future, force=False, timeout=WAIT_TIMEOUT):
+        with self._lock:
+            if force:
                 if self._future:
                     self._future.cancel()
-                self._future = new_future
+            elif not self._wait_for_future(timeout):
+                raise ValueError(self.state)
 
-        if not force:
-            if self._future:
-                while not self._future.done():
-                    pass
-            with self._lock:
-                self._future = new_future
+            self._set_future(new_future)
+            self._condition.notify_all()
 
     # timeout in seconds
     def get_future_result(self, timeout=3):
@@ -155,22 +347,283 @@ class Conversation(object):
         except concurrent.futures.TimeoutError:
             return None
 
+    # Calls callback(result) from the thread completing the current future,
+    # or callback(None) from the deadline thread if it does not complete
+    # within timeout seconds, so no thread waits on the future.
+    # callback is not called if the future is cancelled, since the
+    # conversation has moved on, and gets None if the future raised.
+    # timeout in seconds
+    def when_future_done(self, callback, timeout=3):
+        with self._lock:
+            future = self._future
+        if not future:
+            raise ValueError("Conversation has no future.")
+
+        called = threading.Lock()
+
+        def call_once(result):
+            if called.acquire(blocking=False):
+                callback(result)
+
+        def on_done(future):
+            if future.cancelled():
+                called.acquire(blocking=False)
+            elif future.exception():
+                logger.error(future.exception())
+                call_once(None)
+            else:
+                call_once(future.result())
+
+        future.add_done_callback(on_done)
+        deadlines.call_later(timeout, lambda: call_once(None))
+
+
+# Live conversations, least recently used first.
+# Conversations unused for timeout seconds are expired lazily on access,
+# whatever their state. Beyond max_size conversations, the least recently
+# used IDLE conversations are evicted; busy ones are kept.
+# Existing conversations are looked up without taking the lock, so
+# last_used may be newer than a conversation's position in the order;
+# such conversations are moved to the end when reached.
+class Registry(object):
+    def __init__(self, max_size, timeout):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
+        self._conversations = collections.OrderedDict()
+        self._ordered_at = {}  # user id -> last_used when moved to the end
+
+    def __len__(self):
+        return len(self._conversations)
+
+    def __contains__(self, user_id):
+        return user_id in self._conversations
+
+    def __getitem__(self, user_id):
+        return self._conversations[user_id]
+
+    def __setitem__(self, user_id, conversation):
+        with self.lock:
+            self._add(user_id, conversation)
+
+    def clear(self):
+        with self.lock:
+            self._conversations.clear()
+            self._ordered_at.clear()
+
+    def _is_expired(self, conversation, now):
+        return now - conversation.last_used > self.timeout
+
+    # Must be called while holding self.lock
+    def _move_to_end(self, user_id):
+        self._conversations.move_to_end(user_id)
+        self._ordered_at[user_id] = self._conversations[user_id].last_used
+
+    # Must be called while holding self.lock
+    def _add(self, user_id, conversation):
+        conversation.last_used = time.monotonic()
+        self._conversations[user_id] = conversation
+        self._move_to_end(user_id)
+        self._evict(user_id)
+
+    # Must be called while holding self.lock
+    def _remove(self, user_id):
+        self._ordered_at.pop(user_id)
+        return self._conversations.pop(user_id)
+
+    # Returns True if user_id was used since it was ordered, and moves it
+    # to the end if so
+    # Must be called while holding self.lock
+    def _reorder(self, user_id):
+        if self._conversations[user_id].last_used > self._ordered_at[user_id]:
+            self._move_to_end(user_id)
+            return True
+        return False
+
+    # Must be called while holding self.lock
+    def _expire(self):
+        now = time.monotonic()
+        while self._conversations:
+            user_id = next(iter(self._conversations))
+            if self._reorder(user_id):
+                continue
+            if not self._is_expired(self._conversations[user_id], now):
+                break
+            self._remove(user_id).reset_state()
+            self.expirations += 1
+
+    # Never evicts the conversation of keep_user_id
+    # Must be called while holding self.lock
+    def _evict(self, keep_user_id):
+        excess = len(self._conversations) - self.max_size
+        if excess <= 0:
+            return
 
-def get_or_create(telegram_user, get_only=False, chat=None):
-    conversation = None
-    user_id = telegram_user.id
+        idle_user_ids = []
+        for user_id in list(self._conversations):
+            if user_id == keep_user_id or self._reorder(user_id):
+                continue
+            if self._conversations[user_id].is_idle():
+                idle_user_ids.append(user_id)
+                if len(idle_user_ids) == excess:
+                    break
+
+        for user_id in idle_user_ids:
+            self._remove(user_id)
+        self.evictions += len(idle_user_ids)
+
+    def get_or_create(self, telegram_user, get_only=False, chat=None):
+        user_id = telegram_user.id
+        now = time.monotonic()
+
+        conversation = self._conversations.get(user_id)
+        if conversation is not None and \
+                not self._is_expired(conversation, now):
+            conversation.last_used = now
+            logger.debug("User %s found", user_id)
+            return conversation
+
+        created = False
+        with self.lock:
+            self._expire()
+
+            conversation = self._conversations.get(user_id)
+            if conversation is not None:
+                conversation.last_used = now
+            elif not get_only:
+                conversation = Conversation(telegram_user, chat)
+                self._add(user_id, conversation)
+                created = True
+
+        if created:
+            logger.debug("Created new conversation for user %s", user_id)
+        return conversation
+
+
+# Registry split into stripes by user id, each with its own lock, so that
+# threads handling different users rarely contend
+class StripedRegistry(object):
+    def __init__(self, stripes, max_size, timeout):
+        stripe_size = max(1, max_size // stripes)
+        self.stripes = [Registry(stripe_size, timeout)
+                        for _ in range(stripes)]
+
+    def _stripe(self, user_id):
+        return self.stripes[hash(user_id) % len(self.stripes)]
+
+    @property
+    def evictions(self):
+        return sum(stripe.evictions for stripe in self.stripes)
 
+    @property
+    def expirations(self):
+        return sum(stripe.expirations for stripe in self.stripes)
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self.stripes)
+
+    def __contains__(self, user_id):
+        return user_id in self._stripe(user_id)
+
+    def __getitem__(self, user_id):
+        return self._stripe(user_id)[user_id]
+
+    def __setitem__(self, user_id, conversation):
+        self._stripe(user_id)[user_id] = conversation
+
+    def clear(self):
+        for stripe in self.stripes:
+            stripe.clear()
+
+    def get_or_create(self, telegram_user, get_only=False, chat=None):
+        return self._stripe(telegram_user.id).get_or_create(
+            telegram_user, get_only, chat)
+
+
+# Registry backed by a conversation store shared with other processes.
+# Conversations are loaded from the store on every access, since another
+# process may have changed them, and expire once unchanged for timeout
+# seconds.
+# Futures are not stored, so the conversations loaded by this process
+# share them through a map from user id to the future in flight, which
+# lets the labels step wait for the sticker check. Finished futures are
+# dropped from the map once nothing else refers to them.
+class SharedRegistry(object):
+    def __init__(self, store, timeout):
+        self.store = store
+        self.timeout = timeout
+        self.evictions = 0
+        self.expirations = 0
+        self._futures = weakref.WeakValueDictionary()
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, user_id):
+        return self._load(user_id) is not None
+
+    def __getitem__(self, user_id):
+        conversation = self._load(user_id)
+        if conversation is None:
+            raise KeyError(user_id)
+        return conversation
+
+    def __setitem__(self, user_id, conversation):
+        self.store.delete(user_id)
+        conversation._futures = self._futures
+        conversation.bind(self.store)
+
+    def clear(self):
+        self.store.clear()
+
+    def _load(self, user_id):
+        record = self.store.load(user_id)
+        if record is None:
+            return None
+
+        version, serialized, updated = record
+        if time.time() - updated > self.timeout:
+            return None
+
+        conversation = Conversation.loads(serialized)
+        conversation._store = self.store
+        conversation._version = version
+        conversation._futures = self._futures
+        conversation._future = self._futures.get(user_id)
+        return conversation
+
+    def get_or_create(self, telegram_user, get_only=False, chat=None):
+        conversation = self._load(telegram_user.id)
+        if conversation is not None or get_only:
+            return conversation
+
+        self.expirations += self.store.expire(time.time() - self.timeout)
+
+        # If another process created one meanwhile, bind() raises
+        # ValueError after loading it, and it is used instead
+        conversation = Conversation(telegram_user, chat)
+        conversation._futures = self._futures
+        try:
+            conversation.bind(self.store)
+        except ValueError:
+            pass
+        return conversation
+
+
+if config.CONVERSATION_DATABASE:
+    all = SharedRegistry(
+        conversation_store.SQLiteStore(config.CONVERSATION_DATABASE),
+        config.CONVERSATION_TIMEOUT)
+else:
+    all = StripedRegistry(config.CONVERSATION_STRIPES,
+                          config.MAX_CONVERSATIONS,
+                          config.CONVERSATION_TIMEOUT)
+
+
+def get_or_create(telegram_user, get_only=False, chat=None):
     if not (get_only or chat):
         raise ValueError("Pass in chat or get_only=True")
 
-    with lock:
-        logger.debug("Acquired conversations lock")
-        if user_id in all:
-            logger.debug("User " + str(user_id) + " found")
-            conversation = all[user_id]
-        elif not get_only:
-            logger.debug("Creating new conversation")
-            conversation = Conversation(telegram_user, chat)
-            all[user_id] = conversation
-
-    return conversation
+    return all.get_or_create(telegram_user, get_only, chat)
@@ -0,0 +1,71 @@
+import threading
+import time
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import QueuePool
+
+from stickertaggerbot import config
+
+
+# Connection pool metrics, in seconds
+class PoolStats(object):
+    def __init__(self):
+        self.checkouts = 0
+        self.total_wait = 0.0  # waiting for a connection
+        self.max_wait = 0.0
+        self.checkins = 0
+        self.total_held = 0.0  # between checkout and checkin
+        self.max_held = 0.0
+        self.overflow_checkouts = 0  # checkouts beyond pool_size
+        self.max_overflow = 0
+        self._lock = threading.Lock()
+
+    def checked_out(self, wait, overflow):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if overflow > 0:
+                self.overflow_checkouts += 1
+                self.max_overflow = max(self.max_overflow, overflow)
+
+    def checked_in(self, held):
+        with self._lock:
+            self.checkins += 1
+            self.total_held += held
+            self.max_held = max(self.max_held, held)
+
+
+stats = PoolStats()
+
+
+# QueuePool recording how long each checkout waited and whether it
+# overflowed into stats
+class InstrumentedQueuePool(QueuePool):
+    def connect(self):
+        started = time.monotonic()
+        connection = super().connect()
+        stats.checked_out(time.monotonic() - started, self.overflow())
+        return connection
+
+
+@event.listens_for(InstrumentedQueuePool, "checkout")
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    # Connections dropped by the server are replaced before use, rather
+    # than failing the handler's first statement
+    if config.DATABASE_POOL_PRE_PING:
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except Exception:
+            raise exc.DisconnectionError()
+
+    connection_record.info["checked_out_at"] = time.monotonic()
+
+
+@event.listens_for(InstrumentedQueuePool, "checkin")
+def on_checkin(dbapi_connection, connection_record):
+    checked_out_at = connection_record.info.pop("checked_out_at", None)
+    if checked_out_at is not None:
+        stats.checked_in(time.monotonic() - checked_out_at)
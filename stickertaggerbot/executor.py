@@ -0,0 +1,155 @@
+import collections
+import concurrent.futures
+import enum
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger("executor")
+
+
+# In order of priority: a waiting task in an earlier lane always starts
+# before one in a later lane
+class Lane(enum.IntEnum):
+    INLINE = 0  # inline queries, answered while the user types
+    CHECK = 1  # lookups chat handlers wait on, such as sticker checks
+    CHAT = 2  # replies in private chats
+    BOOKKEEPING = 3  # feedback such as chosen inline results
+
+
+# Returns {Lane: limit} from e.g. "chat=3,bookkeeping=1"
+def parse_limits(limits):
+    parsed = {}
+    for limit in limits.split(","):
+        if not limit.strip():
+            continue
+        lane, value = limit.split("=")
+        parsed[Lane[lane.strip().upper()]] = int(value)
+    return parsed
+
+
+# Keeps a quarter of the workers for inline queries, however busy the other
+# lanes are, since the other lanes' limits add up to three quarters. Each
+# lane gets at least one worker, so with fewer than eight workers the
+# reserve is smaller. Checks have their own limit, since chat handlers
+# holding the chat lane's workers may be waiting for them.
+def default_limits(workers):
+    return {Lane.INLINE: workers,
+            Lane.CHECK: max(1, workers // 8),
+            Lane.CHAT: max(1, workers // 2),
+            Lane.BOOKKEEPING: max(1, workers // 8)}
+
+
+class LaneStats(object):
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.running = 0
+        self.total_wait = 0.0  # seconds spent queued by started tasks
+        self.max_wait = 0.0
+
+    @property
+    def mean_wait(self):
+        started = self.completed + self.running
+        if not started:
+            return 0.0
+        return self.total_wait / started
+
+
+# Runs tasks on a fixed set of worker threads, taking from the queue of the
+# highest priority lane below its limit of running tasks
+class Executor(object):
+    def __init__(self, workers, limits=None):
+        self.workers = workers
+        self.limits = default_limits(workers)
+        self.limits.update(limits or {})
+        self.stats = {lane: LaneStats() for lane in Lane}
+
+        # lane -> deque of (queued time, future, function, args, kwargs)
+        self._queues = {lane: collections.deque() for lane in Lane}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def queued(self, lane):
+        with self._condition:
+            return len(self._queues[lane])
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name="executor." + str(number),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Runs queued tasks before returning
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    # Returns a concurrent.futures.Future of function(*args, **kwargs)
+    def submit(self, lane, function, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self._condition:
+            self._queues[lane].append(
+                (time.monotonic(), future, function, args, kwargs))
+            self.stats[lane].submitted += 1
+            self._condition.notify()
+        return future
+
+    # Decorator for handlers to run in lane instead of the dispatcher thread.
+    # The undecorated handler is kept as __wrapped__.
+    def run_async(self, lane):
+        def decorator(handler):
+            @functools.wraps(handler)
+            def async_handler(*args, **kwargs):
+                return self.submit(lane, handler, *args, **kwargs)
+
+            return async_handler
+
+        return decorator
+
+    # Returns (lane, future, function, args, kwargs), or None once stopped
+    # with nothing queued
+    def _next(self):
+        with self._condition:
+            while True:
+                for lane in Lane:
+                    queue = self._queues[lane]
+                    stats = self.stats[lane]
+                    if queue and stats.running < self.limits[lane]:
+                        queued_at, *task = queue.popleft()
+                        wait = time.monotonic() - queued_at
+                        stats.running += 1
+                        stats.total_wait += wait
+                        stats.max_wait = max(stats.max_wait, wait)
+                        return (lane, *task)
+
+                if self._stopped and not any(self._queues.values()):
+                    return None
+                self._condition.wait()
+
+    def _run(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            lane, future, function, args, kwargs = task
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(function(*args, **kwargs))
+                except Exception as e:
+                    logger.exception("Task in lane %s failed", lane.name)
+                    future.set_exception(e)
+
+            with self._condition:
+                self.stats[lane].running -= 1
+                self.stats[lane].completed += 1
+                # A lane at its limit may have tasks another worker can take
+                self._condition.notify_all()
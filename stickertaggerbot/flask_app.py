@@ -1,11 +1,13 @@
-import queue
+import atexit
 import threading
 
+import click
 import flask
 import telegram
 import telegram.ext
 
-from stickertaggerbot import config, models
+from stickertaggerbot import bot_request, coalescing, config, executor, \
+    index, message, migrations, models, outbox, replica, usage, webhook
 from stickertaggerbot.handlers import handlers
 
 
@@ -16,6 +18,18 @@ class Application(flask.Flask):
         self.testing = testing
         self.debug = True
 
+        self.index = None
+        self.coalescer = None
+        self.setup_inline_queries()
+
+        self.replies = webhook.Replies()
+
+        self.outbox = None
+        self.setup_outbox()
+
+        self.executor = None
+        self.setup_executor()
+
         self.bot = None
         self.update_queue = None
         self.dispatcher = None
@@ -25,6 +39,11 @@ class Application(flask.Flask):
         self.database = None
         self.setup_database(sqlalchemy_logging)
 
+        self.usage = None
+        self.setup_usage()
+
+        self.setup_commands()
+
     def apply_config(self, config):
         if not config:
             return
@@ -32,18 +51,69 @@ class Application(flask.Flask):
         for key, value in config.items():
             self.config[key] = value
 
+    def setup_inline_queries(self):
+        self.index = index.Index(config.INDEX_MAX_ASSOCIATIONS)
+        self.coalescer = coalescing.InlineQueryCoalescer()
+
+    def setup_outbox(self):
+        if not config.OUTBOX_SENDERS:
+            return
+
+        self.outbox = outbox.Outbox(config.OUTBOX_SENDERS,
+                                    config.OUTBOX_GLOBAL_RATE,
+                                    config.OUTBOX_CHAT_RATE)
+        self.outbox.start()
+        atexit.register(self.outbox.stop)
+        message.outbox = self.outbox
+
+    def setup_executor(self):
+        limits = executor.parse_limits(config.EXECUTOR_LANE_LIMITS)
+        self.executor = executor.Executor(config.MAX_WORKERS, limits)
+        self.executor.start()
+        atexit.register(self.executor.stop)
+
     def setup_telegram(self):
-        self.bot = telegram.Bot(token=config.TELEGRAM_TOKEN)
-        self.update_queue = queue.Queue()
-        self.dispatcher = telegram.ext.Dispatcher(self.bot, self.update_queue)
+        # Every thread that may call the Bot API at once gets a connection
+        threads = config.MAX_WORKERS + config.OUTBOX_SENDERS + 1
+        request = bot_request.Request(
+            threads, config.BOT_CONNECT_TIMEOUT, config.BOT_READ_TIMEOUT,
+            bot_request.parse_timeouts(config.BOT_READ_TIMEOUTS))
+
+        self.bot = telegram.Bot(token=config.TELEGRAM_TOKEN, request=request)
+        self.update_queue = coalescing.CoalescingQueue(self.coalescer)
+        # Handlers run on self.executor rather than the dispatcher's workers
+        self.dispatcher = telegram.ext.Dispatcher(
+            self.bot, self.update_queue, workers=0)
         handlers.register_handlers(self.dispatcher, self)
         self.dispatcher_thread = threading.Thread(target=self.dispatcher.start,
                                                   name="dispatcher")
         self.dispatcher_thread.start()
 
     def setup_database(self, sqlalchemy_logging):
+        self.config.setdefault("SQLALCHEMY_POOL_SIZE",
+                               config.DATABASE_POOL_SIZE)
+        self.config.setdefault("SQLALCHEMY_MAX_OVERFLOW",
+                               config.DATABASE_MAX_OVERFLOW)
+        if config.DATABASE_REPLICA_URI:
+            binds = self.config.setdefault("SQLALCHEMY_BINDS", {})
+            binds.setdefault(replica.BIND, config.DATABASE_REPLICA_URI)
         self.database = models.database
         self.database.init_app(self)
-        with self.app_context():
-            self.database.create_all()
+        migrations.upgrade(self.database.get_engine(self))
         models.sqlalchemy_logging(log=sqlalchemy_logging)
+
+    def setup_usage(self):
+        self.usage = usage.UsageBuffer(self, config.USAGE_FLUSH_INTERVAL,
+                                       config.USAGE_FLUSH_EVENTS,
+                                       config.USAGE_FLUSH_RETRIES)
+        self.usage.start()
+        atexit.register(self.usage.stop)
+
+    def setup_commands(self):
+        # flask rebuild-sticker-summaries
+        @self.cli.command("rebuild-sticker-summaries")
+        def rebuild_sticker_summaries():
+            with models.session_scope(self):
+                count = models.StickerSummary.rebuild()
+                models.database.session.commit()
+            click.echo("Rebuilt " + str(count) + " sticker summaries")
@@ -1,11 +1,12 @@
-from telegram.ext import run_async
-
-from stickertaggerbot import logging, message, conversations, CallbackData
+from stickertaggerbot import executor, logging, message, models, \
+    conversations, CallbackData
 from stickertaggerbot.handlers import labels_callback
 
 
 def create_callback_handler(app):
-    @run_async
+    @app.executor.run_async(executor.Lane.CHAT)
+    @models.report_statements
+    @models.unit_of_work(app)
     def callback_handler(bot, update):
         logger = logging.get_logger(logging.Type.HANDLER_CALLBACK_QUERY,
                                    update.update_id)
@@ -1,13 +1,13 @@
-from telegram.ext import run_async
-
-from stickertaggerbot import logging, models
+from stickertaggerbot import executor, logging, models
 from stickertaggerbot.inline_query_result import Sticker as StickerResult
 
 
 # TODO: Consider adding soft labels – labels in the query that aren't yet
 #       associated with the sticker
 def create_chosen_inline_result_handler(app):
-    @run_async
+    @app.executor.run_async(executor.Lane.BOOKKEEPING)
+    @models.report_statements
+    @models.unit_of_work(app, read_only=True)
     def chosen_inline_result_handler(bot, update):
         logger = logging.get_logger(logging.Type.HANDLER_CHOSEN_INLINE_RESULT,
                                    update.update_id)
@@ -18,12 +18,21 @@ def create_chosen_inline_result_handler(app):
         sticker_id = StickerResult.unwrap(chosen_inline_result.result_id)
         labels = chosen_inline_result.query.split()
 
-        logger.debug("Query: " + chosen_inline_result.query)
-        logger.debug("Labels: " + str(labels))
+        logger.debug("Query: %s", chosen_inline_result.query)
+        logger.debug("Labels: %s", labels)
+
+        user_index = app.index.get(app, user.id)
+        if user_index is not None:
+            label_ids = user_index.get_label_ids(labels)
+            user_index.increment_usage(sticker_id, labels)
+        else:
+            with models.session_scope(app):
+                label_ids = models.Label.get_ids(labels)
 
-        models.Association.increment_usage(user.id, sticker_id, labels)
+        # Written to the database later, in bulk
+        app.usage.add(user.id, sticker_id, label_ids)
 
-        logger.debug("Incremented usage for user " + str(user.id) +
-                     "'s sticker " + str(sticker_id))
+        logger.debug("Incremented usage for user %s's sticker %s",
+                     user.id, sticker_id)
 
     return chosen_inline_result_handler
@@ -1,5 +1,3 @@
-import concurrent.futures
-
 import telegram.ext
 
 from stickertaggerbot import handlers, config
@@ -15,17 +13,22 @@ def register_handlers(dispatcher, app):
         telegram.ext.CommandHandler(
             "start", handlers.create_command_start_handler(app)))
 
+    if config.STATELESS_LABELLING:
+        labelling = handlers.stateless
+    else:
+        labelling = handlers
+
     dispatcher.add_handler(
         telegram.ext.MessageHandler(telegram.ext.Filters.sticker,
-                                    handlers.create_sticker_handler(app)))
+                                    labelling.create_sticker_handler(app)))
 
     dispatcher.add_handler(
         telegram.ext.MessageHandler(telegram.ext.Filters.text,
-                                    handlers.create_labels_handler(app)))
+                                    labelling.create_labels_handler(app)))
 
     dispatcher.add_handler(
         telegram.ext.CallbackQueryHandler(
-            handlers.create_callback_handler(app)))
+            labelling.create_callback_handler(app)))
 
     dispatcher.add_handler(
         telegram.ext.InlineQueryHandler(
@@ -34,6 +37,3 @@ def register_handlers(dispatcher, app):
     dispatcher.add_handler(
         telegram.ext.CommandHandler(
             "help", handlers.create_command_start_handler(app)))
-
-
-pool = concurrent.futures.ThreadPoolExecutor(max_workers=config.MAX_WORKERS)
\ No newline at end of file
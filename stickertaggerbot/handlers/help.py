@@ -1,10 +1,8 @@
-from telegram.ext import run_async
-
-from stickertaggerbot import logging, message
+from stickertaggerbot import executor, logging, message
 
 
 def create_help_handler(app):
-    @run_async
+    @app.executor.run_async(executor.Lane.CHAT)
     def help_handler(bot, update):
         logger = logging.get_logger(logging.Type.HANDLER_HELP,
                                    update.update_id)
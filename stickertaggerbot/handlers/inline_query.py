@@ -1,49 +1,151 @@
-from telegram.ext import run_async
-
-from stickertaggerbot import models, message
+from stickertaggerbot import config, executor, logging, models, message, \
+    text_search
 import stickertaggerbot.inline_query_result as inline_query_result
 
+# Maximum number of results accepted by answerInlineQuery
+MAX_RESULTS = 50
+
+
+# Returns (labels, prefix), where prefix is the last label if it may still
+# be partially typed, i.e. if the query does not end with whitespace
+def get_labels(query_string):
+    labels = query_string.split()
+    if labels and not query_string[-1].isspace():
+        return labels[:-1], labels[-1]
+    return labels, None
+
 
 # TODO Add deep-linking parameters
-# TODO Support pagination
 def create_inline_query_handler(app):
-    @run_async
+    @app.executor.run_async(executor.Lane.INLINE)
+    @models.report_statements
+    @models.unit_of_work(app, read_only=True)
     def inline_query_handler(bot, update):
-        query = update.inline_query
-        user_id = update.effective_user.id
-        labels = query.query.split()
-
-        with app.app_context():
-            user_associations = models.Association.query.filter_by(
-                user_id=user_id)
-
-        if user_associations.count() == 0:
-            result = inline_query_result.Text(
-                update.update_id,
-                message.Text.Inline.NOT_STARTED.value,
-                message.Text.Inline.CHAT_TO_START.value)
-            query.answer(results=[result],
-                         is_personal=True,
-                         cache_time=2,
-                         switch_pm_text=message.Text.Inline.START_BUTTON.value)
-            return
+        logger = logging.get_logger(logging.Type.HANDLER_INLINE_QUERY,
+                                    update.update_id)
+        logger.log_start()
 
-        with app.app_context():
-            stickers = models.Association.get_sticker_ids(
-                user_id, labels, unique=True)
-
-        if not stickers:
-            result = inline_query_result.Text(
-                update.update_id,
-                message.Text.Inline.NO_RESULTS.value,
-                message.Text.Inline.CHAT_TO_LABEL.value)
-            query.answer(results=[result],
-                         is_personal=True,
-                         cache_time=2)
+        if app.coalescer.drop(update):
+            logger.debug("Dropped superseded query")
+            app.replies.release(update)
             return
 
-        sticker_results = [inline_query_result.Sticker(sticker)
-                           for sticker in stickers]
-        query.answer(sticker_results, is_personal=True)
+        try:
+            answer_inline_query(app, update, logger)
+        finally:
+            app.coalescer.finish(update)
+            app.replies.release(update)
 
     return inline_query_handler
+
+
+# Answers in the webhook response if the webhook is waiting for it,
+# otherwise as InlineQuery.answer does
+def answer(app, update, *args, **kwargs):
+    if app.replies.is_waiting(update):
+        params = dict(kwargs)
+        results = params.pop("results", None) or (args[0] if args else [])
+        params["results"] = [result.to_dict() for result in results]
+        params["inline_query_id"] = update.inline_query.id
+        if app.replies.give(update, "answerInlineQuery", **params):
+            return
+
+    update.inline_query.answer(*args, **kwargs)
+
+
+# Returns [(sticker_id, sort_key)] from the user's index if it is loaded,
+# otherwise from the database
+def get_ranked_stickers(app, update, user_index, labels, limit, after,
+                        prefix):
+    user = update.effective_user
+    if config.FULL_TEXT_SEARCH:
+        search_config = text_search.config_for(user.language_code)
+        with models.session_scope(app):
+            label_ids = models.Label.search_ids(user.id, labels, prefix,
+                                                search_config)
+            if user_index is None:
+                return models.StickerSummary.get_ranked_stickers_by_ids(
+                    user.id, label_ids, limit, after)
+        return user_index.get_ranked_stickers_by_ids(label_ids, limit, after)
+
+    if user_index is not None:
+        return user_index.get_ranked_stickers(labels, limit, after, prefix)
+    with models.session_scope(app):
+        return models.StickerSummary.get_ranked_stickers(
+            user.id, labels, limit, after, prefix)
+
+
+def answer_inline_query(app, update, logger):
+    query = update.inline_query
+    user_id = update.effective_user.id
+    labels, prefix = get_labels(query.query)
+
+    user_index = app.index.get(app, user_id)
+    if user_index is not None:
+        has_associations = not user_index.is_empty()
+    else:
+        with models.session_scope(app):
+            has_associations = models.StickerSummary.user_has_stickers(
+                user_id)
+
+    if not has_associations:
+        result = inline_query_result.Text(
+            update.update_id,
+            message.Text.Inline.NOT_STARTED.value,
+            message.Text.Inline.CHAT_TO_START.value)
+        answer(app, update, results=[result],
+               is_personal=True,
+               cache_time=2,
+               switch_pm_text=message.Text.Inline.START_BUTTON.value)
+        return
+
+    # The index and the sticker summaries rank by different uses, so a
+    # cursor made by one cannot be followed by the other. The user may
+    # have switched between them since the previous page, e.g. by labelling
+    # a sticker, in which case the results end rather than repeat.
+    if user_index is not None:
+        ranking = inline_query_result.Offset.BY_LABEL_USES
+    else:
+        ranking = inline_query_result.Offset.BY_STICKER_USES
+    after = None
+    offset = inline_query_result.Offset.unwrap(query.offset)
+    if offset is not None:
+        offset_ranking, after = offset
+        if offset_ranking != ranking:
+            logger.debug("Ended results of another ranking")
+            answer(app, update, [], is_personal=True)
+            return
+
+    # Fetch one extra result to find out if there is a next page
+    stickers = get_ranked_stickers(app, update, user_index, labels,
+                                   MAX_RESULTS + 1, after, prefix)
+
+    if app.coalescer.cancel(update):
+        logger.debug("Cancelled superseded query")
+        return
+
+    if not stickers and after:
+        answer(app, update, [], is_personal=True)
+        return
+
+    if not stickers:
+        result = inline_query_result.Text(
+            update.update_id,
+            message.Text.Inline.NO_RESULTS.value,
+            message.Text.Inline.CHAT_TO_LABEL.value)
+        answer(app, update, results=[result],
+               is_personal=True,
+               cache_time=2)
+        return
+
+    next_offset = ""
+    if len(stickers) > MAX_RESULTS:
+        stickers = stickers[:MAX_RESULTS]
+        _, last_sort_key = stickers[-1]
+        next_offset = inline_query_result.Offset.generate(ranking,
+                                                          last_sort_key)
+
+    sticker_results = [inline_query_result.Sticker(sticker)
+                       for sticker, _ in stickers]
+    answer(app, update, sticker_results, is_personal=True,
+           next_offset=next_offset)
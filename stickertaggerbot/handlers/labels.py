@@ -1,7 +1,7 @@
-from telegram.ext import run_async
 import telegram
 
-from stickertaggerbot import logging, message, conversations, CallbackData
+from stickertaggerbot import executor, logging, message, conversations, \
+    CallbackData
 
 
 def get_labels(update):
@@ -11,7 +11,7 @@ def get_labels(update):
 
 
 def create_labels_handler(app):
-    @run_async
+    @app.executor.run_async(executor.Lane.CHAT)
     def labels_handler(bot, update):
         logger = logging.get_logger(logging.Type.HANDLER_LABELS,
                                    update.update_id)
@@ -44,7 +44,7 @@ def create_labels_handler(app):
 
         new_labels = get_labels(update)
         if not new_labels:
-            logger.debug("No new labels found. Message: " +
+            logger.debug("No new labels found. Message: %s",
                          update.message.text)
 
             response_content = message.Text.Error.LABEL_MISSING
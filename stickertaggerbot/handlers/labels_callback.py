@@ -70,19 +70,14 @@ def add_sticker(app, bot, update, conversation):
     chat_id = update.effective_chat.id
     sticker = conversation.sticker
 
-    with app.app_context():
+    with models.session_scope(app):
         try:
-            database_user = models.User.get(user.id)
-            database_sticker = models.Sticker.get_or_create(sticker)
-
-            for label in conversation.labels:
-                database_label = models.Label.get_or_create(label)
-
-                # TODO Work with existing labels
-                association = models.Association(
-                    database_user, database_sticker, database_label)
+            # TODO Work with existing labels
+            associations = models.Association.bulk_create(
+                user.id, sticker, conversation.labels)
 
             models.database.session.commit()
+            app.index.add_sticker(user.id, sticker.file_id, associations)
         except Exception as e:
             response = message.Message(bot, update, logger, chat_id)
             response_content = message.Text.Error.UNKNOWN
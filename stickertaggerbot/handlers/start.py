@@ -1,13 +1,13 @@
-from telegram.ext import run_async
-
-from stickertaggerbot import logging, message, models
+from stickertaggerbot import executor, logging, message, models
 
 
 # Catch errors when sending messages
 # TODO Handle deep-linking parameters
 # Add user to database if user is new
 def create_command_start_handler(app):
-    @run_async
+    @app.executor.run_async(executor.Lane.CHAT)
+    @models.report_statements
+    @models.unit_of_work(app)
     def command_start_handler(bot, update):
         logger = logging.get_logger(logging.Type.HANDLER_START,
                                    update.update_id)
@@ -18,16 +18,16 @@ def create_command_start_handler(app):
 
         response = message.Message(bot, update, logger, chat_id)
 
-        with app.app_context():
+        with models.session_scope(app):
             user = models.User.get(user_id)
             if not user:
-                logger.debug("User " + str(user_id) + " not found")
+                logger.debug("User %s not found", user_id)
                 user = models.User.from_telegram_user(update.effective_user,
                                                       chat_id)
                 models.database.session.commit()
-                logger.debug("Created user " + str(user_id))
+                logger.debug("Created user %s", user_id)
 
         response_content = message.Text.Instruction.START
-        response.set_content(response_content).send()
+        response.set_content(response_content).reply(app.replies)
 
     return command_start_handler
@@ -0,0 +1,151 @@
+from stickertaggerbot import executor, logging, message, models, \
+    conversations, CallbackData
+from stickertaggerbot.handlers.labels import get_labels, \
+    generate_inline_keyboard_markup
+from stickertaggerbot.handlers.sticker import sticker_is_new
+
+# Labelling flow that keeps no conversations in memory, so that any process
+# can handle any step. The sticker and labels are kept in
+# models.PendingLabels, which the confirmation keyboard refers to by a
+# signed key.
+
+
+def create_sticker_handler(app):
+    @app.executor.run_async(executor.Lane.CHAT)
+    @models.report_statements
+    @models.unit_of_work(app)
+    def sticker_handler(bot, update):
+        logger = logging.get_logger(logging.Type.HANDLER_STICKER,
+                                   update.update_id)
+        logger.log_start()
+
+        user = update.effective_user
+        sticker = update.effective_message.sticker
+        chat_id = update.effective_chat.id
+
+        response = message.Message(bot, update, logger, chat_id)
+
+        if not sticker_is_new(app, user, sticker):
+            logger.debug("Sticker exists")
+            response_content = message.Text.Error.STICKER_EXISTS
+            response.set_content(response_content).reply(app.replies)
+            return
+
+        with models.session_scope(app):
+            models.PendingLabels.start(user.id, sticker)
+            models.database.session.commit()
+
+        response_content = message.Text.Instruction.LABEL
+        response.set_content(response_content).reply(app.replies)
+
+    return sticker_handler
+
+
+def create_labels_handler(app):
+    @app.executor.run_async(executor.Lane.CHAT)
+    @models.report_statements
+    @models.unit_of_work(app)
+    def labels_handler(bot, update):
+        logger = logging.get_logger(logging.Type.HANDLER_LABELS,
+                                   update.update_id)
+        logger.log_start()
+
+        user = update.effective_user
+        chat_id = update.effective_chat.id
+
+        response = message.Message(bot, update, logger, chat_id)
+
+        new_labels = get_labels(update)
+        with models.session_scope(app):
+            pending = models.PendingLabels.get_latest(user.id)
+            if not pending:
+                logger.log_conversation_not_found(user.id)
+                response_content = message.Text.Error.NOT_STARTED
+                response.set_content(response_content).send()
+                return
+
+            if not new_labels:
+                logger.debug("No new labels found. Message: %s",
+                             update.message.text)
+                response_content = message.Text.Error.LABEL_MISSING
+                response.set_content(response_content).send()
+                return
+
+            pending.labels = new_labels
+            key = pending.key
+            sticker = pending.telegram_sticker
+            models.database.session.commit()
+
+        message_text = message.Text.Instruction.CONFIRM.value + \
+            "\n".join(new_labels)
+
+        buttons = [[CallbackData.ButtonText.CONFIRM,
+                    CallbackData.ButtonText.CANCEL]]
+        generator = CallbackData(conversations.Conversation.State.LABEL,
+                                 CallbackData.sign(key)).generator
+        inline_keyboard_markup = generate_inline_keyboard_markup(
+            generator, buttons)
+
+        response.set_content(sticker).send()
+
+        response_confirmation = message.Message(bot, update, logger, chat_id,
+                                                content=message_text)
+        response_confirmation.send(reply_markup=inline_keyboard_markup)
+        logger.debug("Sent sticker with confirmation message")
+
+    return labels_handler
+
+
+def create_callback_handler(app):
+    @app.executor.run_async(executor.Lane.CHAT)
+    @models.report_statements
+    @models.unit_of_work(app)
+    def callback_handler(bot, update):
+        logger = logging.get_logger(
+            logging.Type.HANDLER_CALLBACK_QUERY_LABELS, update.update_id)
+        logger.log_start()
+
+        callback_data = CallbackData.unwrap(update.callback_query.data)
+        user = update.effective_user
+        chat_id = update.effective_chat.id
+
+        response = message.Message(bot, update, logger, chat_id)
+
+        key = CallbackData.unsign(callback_data.state_identifier)
+        with models.session_scope(app):
+            pending = models.PendingLabels.get(key) if key else None
+            if not pending or pending.user_id != user.id or \
+                    not pending.labels:
+                logger.log_conversation_not_found(user.id)
+                response_content = message.Text.Error.UNKNOWN
+                response.set_content(response_content).send()
+                return
+
+            if callback_data.button_text == CallbackData.ButtonText.CANCEL:
+                pending.labels = None
+                models.database.session.commit()
+                response_content = message.Text.Instruction.RE_LABEL
+                response.set_content(response_content).send()
+                return
+
+            logger.debug("Button – confirm")
+            sticker = pending.telegram_sticker
+            try:
+                associations = models.Association.bulk_create(
+                    user.id, sticker, pending.labels)
+                pending.delete()
+                models.database.session.commit()
+            except Exception as e:
+                logger.error(e)
+                models.database.session.rollback()
+                response_content = message.Text.Error.UNKNOWN
+                response.set_content(response_content).send()
+                return
+
+        app.index.add_sticker(user.id, sticker.file_id, associations)
+
+        logger.debug("Added sticker successfully")
+        response_content = message.Text.Other.SUCCESS
+        response.set_content(response_content).send()
+
+    return callback_handler
@@ -1,21 +1,17 @@
-from telegram.ext import run_async
-
-from stickertaggerbot import models, logging, message, conversations
-from stickertaggerbot.handlers.handlers import pool
+from stickertaggerbot import executor, models, logging, message, conversations
 
 
 def sticker_is_new(app, user, sticker):
-    with app.app_context():
-        subquery = models.Association.query.filter_by(
-            user_id=user.id, sticker_id=sticker.file_id)
-        count = subquery.count()
-    return count == 0
+    with models.session_scope(app, read_only_for=user.id):
+        return not models.Association.sticker_exists(user.id, sticker.file_id)
 
 
 # Create a conversation upon receiving a sticker,
 # or prompt to cancel previous conversations
 def create_sticker_handler(app):
-    @run_async
+    @app.executor.run_async(executor.Lane.CHAT)
+    @models.report_statements
+    @models.unit_of_work(app)
     def sticker_handler(bot, update):
         logger = logging.get_logger(logging.Type.HANDLER_STICKER,
                                    update.update_id)
@@ -33,7 +29,8 @@ def create_sticker_handler(app):
         try:
             conversation.change_state(
                 conversations.Conversation.State.STICKER,
-                pool.submit(sticker_is_new, app, user, sticker), force=True)
+                app.executor.submit(executor.Lane.CHECK, sticker_is_new,
+                                    app, user, sticker), force=True)
         except ValueError as e:
             # TODO Ask user if they want to cancel previous conversation
             # Currently should not enter this branch
@@ -42,26 +39,29 @@ def create_sticker_handler(app):
                 state, conversations.Conversation.State.STICKER)
 
             response_content = message.Text.Error.RESTART
-            response.set_content(response_content).send()
+            response.set_content(response_content).reply(app.replies)
             return
 
         logger.debug("Entered STICKER state")
-        new_sticker = conversation.get_future_result()
 
-        if new_sticker:
-            response_content = message.Text.Instruction.LABEL
-            response.set_content(response_content).send()
-            conversation.sticker = sticker
-        elif new_sticker is False:
-            logger.debug("Sticker exists")
-            response_content = message.Text.Error.STICKER_EXISTS
-            response.set_content(response_content).send()
-            # TODO Ask user if they meant to change the sticker's labels
-            conversation.rollback_state()
-        else:
-            logger.debug("Future timed out")
-            response_content = message.Text.Error.UNKNOWN
-            response.set_content(response_content).send()
-            conversation.rollback_state()
+        # Continues once the check completes, without holding this thread
+        def respond(new_sticker):
+            if new_sticker:
+                response_content = message.Text.Instruction.LABEL
+                response.set_content(response_content).reply(app.replies)
+                conversation.sticker = sticker
+            elif new_sticker is False:
+                logger.debug("Sticker exists")
+                response_content = message.Text.Error.STICKER_EXISTS
+                response.set_content(response_content).reply(app.replies)
+                # TODO Ask user if they meant to change the sticker's labels
+                conversation.rollback_state()
+            else:
+                logger.debug("Future timed out")
+                response_content = message.Text.Error.UNKNOWN
+                response.set_content(response_content).reply(app.replies)
+                conversation.rollback_state()
+
+        conversation.when_future_done(respond)
 
     return sticker_handler
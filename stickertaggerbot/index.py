@@ -0,0 +1,259 @@
+import collections
+import heapq
+import threading
+
+from stickertaggerbot import models
+
+
+# Prefix tree over label texts, for matching partially typed labels
+class Trie(object):
+    def __init__(self):
+        self.root = {}
+
+    def add(self, text, label_id):
+        node = self.root
+        for character in text:
+            node = node.setdefault(character, {})
+        node[None] = label_id  # None cannot be a character
+
+    # Returns IDs of all labels starting with prefix
+    def find(self, prefix):
+        node = self.root
+        for character in prefix:
+            node = node.get(character)
+            if node is None:
+                return set()
+
+        label_ids = set()
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for character, child in node.items():
+                if character is None:
+                    label_ids.add(child)
+                else:
+                    nodes.append(child)
+        return label_ids
+
+
+# In-memory inverted index of a single user's associations
+class UserIndex(object):
+    def __init__(self, rows=()):
+        self.lock = threading.Lock()
+        self.label_ids = {}  # label text -> label id
+        self.sticker_ids = {}  # label id -> set of sticker ids
+        self.uses = {}  # (sticker id, label id) -> uses
+        self.association_ids = {}  # (sticker id, label id) -> association id
+        self.trie = Trie()
+
+        for association_id, label_id, label_text, sticker_id, uses in rows:
+            self._add(association_id, sticker_id, label_id, label_text, uses)
+
+    def __len__(self):
+        return len(self.uses)
+
+    def is_empty(self):
+        return not self.uses
+
+    def _add(self, association_id, sticker_id, label_id, label_text, uses=0):
+        if label_text not in self.label_ids:
+            self.label_ids[label_text] = label_id
+            self.trie.add(label_text, label_id)
+        self.sticker_ids.setdefault(label_id, set()).add(sticker_id)
+        self.uses.setdefault((sticker_id, label_id), uses or 0)
+        self.association_ids.setdefault((sticker_id, label_id),
+                                        association_id)
+
+    # associations: [(association_id, label_id, label_text)]
+    # Returns number of new associations
+    def add_sticker(self, sticker_id, associations):
+        with self.lock:
+            original_size = len(self.uses)
+            for association_id, label_id, label_text in associations:
+                self._add(association_id, sticker_id, label_id, label_text)
+            return len(self.uses) - original_size
+
+    # Nonexistent labels are ignored, as in Association.increment_usage
+    def increment_usage(self, sticker_id, labels):
+        with self.lock:
+            for label in labels:
+                key = (sticker_id, self.label_ids.get(label))
+                if key in self.uses:
+                    self.uses[key] += 1
+
+    # Returns IDs of the labels the user has, ignoring other labels
+    def get_label_ids(self, labels):
+        with self.lock:
+            return [self.label_ids[label] for label in labels
+                    if label in self.label_ids]
+
+    def get_usage_count(self, sticker_id, label):
+        with self.lock:
+            return self.uses.get((sticker_id, self.label_ids.get(label)), 0)
+
+    def get_sticker_ids(self, labels):
+        with self.lock:
+            sticker_ids = set()
+            for label in labels:
+                label_id = self.label_ids.get(label)
+                if label_id is not None:
+                    sticker_ids.update(self.sticker_ids[label_id])
+            return list(sticker_ids)
+
+    # Must be called while holding self.lock
+    def _get_label_ids(self, labels, prefix=None):
+        label_ids = {self.label_ids[label] for label in labels
+                     if label in self.label_ids}
+        if prefix:
+            label_ids.update(self.trie.find(prefix))
+        return label_ids
+
+    # Same ordering, sort keys, pagination and prefix matching as
+    # Association.get_ranked_stickers
+    def get_ranked_stickers(self, labels, limit=None, after=None,
+                            prefix=None):
+        with self.lock:
+            label_ids = self._get_label_ids(labels, prefix)
+        return self.get_ranked_stickers_by_ids(label_ids, limit, after)
+
+    # As get_ranked_stickers, for labels already looked up.
+    # Labels the user does not have are ignored.
+    def get_ranked_stickers_by_ids(self, label_ids, limit=None, after=None):
+        with self.lock:
+            # sticker id -> [matches, uses, first matching association id]
+            scores = {}
+            for label_id in set(label_ids) & self.sticker_ids.keys():
+                for sticker_id in self.sticker_ids[label_id]:
+                    key = (sticker_id, label_id)
+                    association_id = self.association_ids[key]
+                    score = scores.setdefault(sticker_id,
+                                              [0, 0, association_id])
+                    score[0] += 1
+                    score[1] += self.uses[key]
+                    score[2] = min(score[2], association_id)
+
+            stickers = [(sticker_id, tuple(score))
+                        for sticker_id, score in scores.items()]
+
+        def order(sticker):
+            _, (matches, uses, first_id) = sticker
+            return -matches, -uses, first_id
+
+        if after:
+            after_order = order((None, after))
+            stickers = [sticker for sticker in stickers
+                        if order(sticker) > after_order]
+
+        if limit is None:
+            return sorted(stickers, key=order)
+        return heapq.nsmallest(limit, stickers, key=order)
+
+    def get_ranked_sticker_ids(self, labels, limit=None, after=None,
+                               prefix=None):
+        stickers = self.get_ranked_stickers(labels, limit, after, prefix)
+        return [sticker_id for sticker_id, _ in stickers]
+
+
+# LRU cache of UserIndex instances, bounded by the total number of
+# associations held, which is what dominates its memory usage.
+# Users are loaded lazily with a single query on first access.
+class Index(object):
+    def __init__(self, max_associations):
+        self.max_associations = max_associations
+        self.size = 0
+        self._users = collections.OrderedDict()
+        # user id -> [loads in progress, updates since the first started]
+        self._loading = {}
+        self._too_large = set()  # ids of users who do not fit within the cap
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        return user_id in self._users
+
+    def __len__(self):
+        return len(self._users)
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self._too_large.clear()
+            self.size = 0
+
+    # Returns None if the user's associations do not fit within the cap,
+    # in which case callers should query the database instead.
+    # Such users are remembered, so that they are not loaded again until
+    # they label another sticker.
+    def get(self, app, user_id):
+        with self._lock:
+            if user_id in self._too_large:
+                return None
+            user_index = self._users.get(user_id)
+            if user_index is not None:
+                self._users.move_to_end(user_id)
+                return user_index
+            loading = self._loading.setdefault(user_id, [0, 0])
+            loading[0] += 1
+            generation = loading[1]
+
+        try:
+            with models.session_scope(app):
+                rows = models.Association.get_index_rows(user_id)
+            user_index = UserIndex(rows)
+        finally:
+            with self._lock:
+                stale = loading[1] != generation
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[user_id]
+
+        if len(user_index) > self.max_associations:
+            with self._lock:
+                if not stale:
+                    self._too_large.add(user_id)
+            return None
+
+        # Updates made while loading may be missing from the rows,
+        # so the next access reloads instead
+        if stale:
+            return user_index
+
+        with self._lock:
+            if user_id in self._users:
+                return self._users[user_id]
+            self._users[user_id] = user_index
+            self.size += len(user_index)
+            self._evict()
+
+        return user_index
+
+    # Must be called while holding self._lock
+    def _evict(self):
+        while self.size > self.max_associations and len(self._users) > 1:
+            _, user_index = self._users.popitem(last=False)
+            self.size -= len(user_index)
+
+    def _get_loaded(self, user_id):
+        with self._lock:
+            if user_id in self._loading:
+                self._loading[user_id][1] += 1
+            return self._users.get(user_id)
+
+    # Users that are not loaded are left alone, since they will pick up
+    # committed changes when they are next loaded.
+    def add_sticker(self, user_id, sticker_id, associations):
+        with self._lock:
+            self._too_large.discard(user_id)
+        user_index = self._get_loaded(user_id)
+        if user_index is None:
+            return
+
+        added = user_index.add_sticker(sticker_id, associations)
+        with self._lock:
+            if self._users.get(user_id) is user_index:
+                self.size += added
+                self._evict()
+
+    def increment_usage(self, user_id, sticker_id, labels):
+        user_index = self._get_loaded(user_id)
+        if user_index is not None:
+            user_index.increment_usage(sticker_id, labels)
@@ -22,3 +22,32 @@ class Text(telegram.InlineQueryResultArticle):
         super().__init__(id=update_id,
                          title=text,
                          input_message_content=message_content)
+
+
+# Keyset cursor carried in InlineQuery.offset and next_offset.
+# Encodes the ranking and the sort key of the last result on the previous
+# page, since a sort key only means something to the ranking that made it.
+class Offset(object):
+    SEPARATOR = "."
+
+    # Rankings, by uses of the matching labels or of the whole sticker
+    BY_LABEL_USES = "l"  # user indexes and associations
+    BY_STICKER_USES = "s"  # sticker summaries
+
+    @classmethod
+    def generate(cls, ranking, sort_key):
+        return cls.SEPARATOR.join([ranking] +
+                                  [str(value) for value in sort_key])
+
+    # Returns (ranking, sort_key), or None for the first page or an
+    # unrecognized offset
+    @classmethod
+    def unwrap(cls, offset):
+        try:
+            ranking, matches, uses, first_id = offset.split(cls.SEPARATOR)
+            sort_key = int(matches), int(uses), int(first_id)
+        except ValueError:
+            return None
+        if ranking not in (cls.BY_LABEL_USES, cls.BY_STICKER_USES):
+            return None
+        return ranking, sort_key
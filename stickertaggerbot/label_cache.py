@@ -0,0 +1,49 @@
+import collections
+import threading
+
+
+# Process-wide LRU cache of label text -> label id.
+# Label texts are unique and never change once committed, so entries never
+# need to be invalidated, only evicted.
+class LabelCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._ids = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, text):
+        return text in self._ids
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+    # Returns ({text: id} for cached texts, [texts that are not cached])
+    def get_many(self, texts):
+        found = {}
+        missing = []
+        with self._lock:
+            for text in texts:
+                label_id = self._ids.get(text)
+                if label_id is None:
+                    missing.append(text)
+                else:
+                    self._ids.move_to_end(text)
+                    found[text] = label_id
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    # label_ids: {text: id}
+    def update(self, label_ids):
+        with self._lock:
+            for text, label_id in label_ids.items():
+                self._ids[text] = label_id
+                self._ids.move_to_end(text)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
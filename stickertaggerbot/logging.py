@@ -1,12 +1,125 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import random
 from enum import Enum
 
-logging.basicConfig(filename=os.environ["LOG_LOCATION"],
-                    level=logging.DEBUG,
-                    format='%(asctime)s - %(name)s - %(levelname)s - '
-                           '%(message)s',
-                    datefmt='%d/%m/%Y %I:%M:%S %p')
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+DATE_FORMAT = "%d/%m/%Y %I:%M:%S %p"
+
+
+# File handler that leaves flushing to its caller, so that records are
+# written to disk in batches instead of one at a time
+class BatchingFileHandler(logging.FileHandler):
+    def __init__(self, filename, batch_size):
+        super().__init__(filename)
+        self.batch_size = batch_size
+        self._pending = 0
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+            return
+
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self._pending = 0
+        super().flush()
+
+
+# Queue listener that flushes its handlers whenever the queue has been
+# empty for flush_interval seconds
+class BatchingQueueListener(logging.handlers.QueueListener):
+    def __init__(self, log_queue, flush_interval, *handlers):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.flush_interval = flush_interval
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, self.flush_interval)
+            except queue.Empty:
+                self.flush()
+
+    # Writes out queued records before returning
+    def stop(self):
+        super().stop()
+        self.flush()
+
+
+# Queue handler that leaves formatting to the listener's thread.
+# Messages are formatted from their %-style arguments when written, so
+# arguments must not be mutated after logging them.
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Keeps a random sample of DEBUG records
+class DebugSampler(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+
+# levels: "name=LEVEL,name=LEVEL", e.g. "handler=INFO,sqlalchemy=WARNING"
+def set_levels(levels):
+    for setting in levels.split(","):
+        if setting.strip():
+            name, level = setting.split("=")
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+
+# Handlers only put records on a queue; a single listener thread formats
+# them and writes them to the log file in batches.
+#
+# LOG_LEVEL: root level, DEBUG by default
+# LOG_LEVELS: levels per subsystem, as for set_levels
+# LOG_DEBUG_SAMPLE_RATE: fraction of DEBUG records kept, 1 by default
+# LOG_BATCH_SIZE: records written before flushing
+# LOG_FLUSH_INTERVAL: seconds the queue is empty for before flushing
+def setup():
+    file_handler = BatchingFileHandler(
+        os.environ["LOG_LOCATION"],
+        int(os.environ.get("LOG_BATCH_SIZE", 100)))
+    file_handler.setFormatter(logging.Formatter(FORMAT, DATE_FORMAT))
+
+    log_queue = queue.Queue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    sample_rate = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 1))
+    if sample_rate < 1:
+        queue_handler.addFilter(DebugSampler(sample_rate))
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(os.environ.get("LOG_LEVEL", "DEBUG").upper())
+    set_levels(os.environ.get("LOG_LEVELS", ""))
+
+    listener = BatchingQueueListener(
+        log_queue, float(os.environ.get("LOG_FLUSH_INTERVAL", 1)),
+        file_handler)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+listener = setup()
 
 
 class Type(Enum):
@@ -23,33 +136,47 @@ class Type(Enum):
     HANDLER_HELP = "handler.help"
 
 
+# Loggers are fixed per type; the update being handled is added to each
+# message by an adapter, since the logging module keeps every named logger
+# for the lifetime of the process.
 def get_logger(logger_type, update_id=None):
+    logger = logging.getLogger(logger_type.value)
     if update_id:
-        return logging.getLogger(logger_type.value + "." + str(update_id))
+        return UpdateLoggerAdapter(logger, {"update_id": update_id})
     else:
-        return logging.getLogger(logger_type.value)
-
+        return logger
 
-class Logger(logging.getLoggerClass()):
-    def __init__(self, name):
-        super().__init__(name)
 
+class LogHelpers(object):
     def log_start(self):
         self.debug("Handling update")
 
     def log_failed_to_change_conversation_state(self, original_state,
                                                 target_state):
-        self.debug("Failed to enter " + original_state.name +
-                   " from " + target_state.name)
+        self.debug("Failed to enter %s from %s",
+                   original_state.name, target_state.name)
 
     def log_conversation_not_found(self, user_id):
-        self.debug("Conversation for user " + str(user_id) + " not found")
+        self.debug("Conversation for user %s not found", user_id)
 
     def log_sent_message(self, message_string):
-        self.debug("Sent: " + message_string)
+        self.debug("Sent: %s", message_string)
 
     def log_sent_sticker(self, sticker_id):
-        self.debug("Sent sticker: " + str(sticker_id))
+        self.debug("Sent sticker: %s", sticker_id)
+
+
+class Logger(LogHelpers, logging.getLoggerClass()):
+    def __init__(self, name):
+        super().__init__(name)
+
+
+# Prefixes messages with the update ID, and sets it as the update_id
+# attribute of log records
+class UpdateLoggerAdapter(LogHelpers, logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        kwargs["extra"] = self.extra
+        return "[%s] %s" % (self.extra["update_id"], msg), kwargs
 
 
 logging.setLoggerClass(Logger)
@@ -1,7 +1,12 @@
+import functools
 from enum import Enum
 
 import telegram.error
 
+# Set by the application to an outbox.Outbox to send messages from sender
+# threads instead of the handler's thread
+outbox = None
+
 
 # For outgoing messages via bot
 
@@ -69,7 +74,38 @@ class Message(object):
 
         return self  # allows for chaining with send
 
+    # Sends the message in the webhook response if the webhook is waiting
+    # for a reply to the update, otherwise as send does.
+    # Only for handlers sending a single message per update.
+    def reply(self, replies):
+        if replies.is_waiting(self.update):
+            if self.type == Message.Type.TEXT:
+                given = replies.give(self.update, "sendMessage",
+                                     chat_id=self.chat_id, text=self.content)
+                if given:
+                    self.logger.log_sent_message(self.content)
+                    return
+            elif self.type == Message.Type.STICKER:
+                given = replies.give(self.update, "sendSticker",
+                                     chat_id=self.chat_id,
+                                     sticker=self.content.file_id)
+                if given:
+                    self.logger.log_sent_sticker(self.content.file_id)
+                    return
+
+        self.send()
+
+    # Queues the message in the outbox if there is one, otherwise sends it
+    # right away
     def send(self, *args, **kwargs):  # TODO chat_id
+        if outbox is None:
+            self._send(args, kwargs)
+        else:
+            outbox.put(self.chat_id,
+                       functools.partial(self._send, args, kwargs, True))
+
+    # retry: raise RetryAfter for the outbox to retry
+    def _send(self, args, kwargs, retry=False):
         try:
             if self.type == Message.Type.TEXT:
                 self.bot.send_message(self.chat_id, self.content,
@@ -90,6 +126,8 @@ class Message(object):
         except telegram.error.NetworkError as e:
             self.logger.error(e)
         except telegram.error.RetryAfter as e:
+            if retry:
+                raise
             self.logger.error(e)
         except telegram.error.Unauthorized as e:
             self.logger.error(e)
@@ -0,0 +1,269 @@
+import json
+import logging
+
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, \
+    MetaData, String, Table, Text, UniqueConstraint, select, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.functions import func
+
+from stickertaggerbot import text_search
+
+logger = logging.getLogger("migrations")
+
+# Key of the advisory lock held while upgrading, so that processes starting
+# at the same time upgrade one at a time
+LOCK_KEY = 5817321
+
+metadata = MetaData()
+schema_version = Table("schema_version", metadata,
+                       Column("version", Integer, primary_key=True),
+                       Column("applied", DateTime,
+                              server_default=func.now()))
+
+# [(version, transactional, upgrade)]
+migrations = []
+
+
+# Decorator registering upgrade(connection) as the upgrade to version.
+# Upgrades run in a transaction unless transactional is False, as needed
+# for CREATE INDEX CONCURRENTLY, in which case they must be safe to run
+# again after failing partway.
+def migration(version, transactional=True):
+    def decorator(upgrade):
+        migrations.append((version, transactional, upgrade))
+        migrations.sort(key=lambda migration: migration[0])
+        return upgrade
+
+    return decorator
+
+
+def latest_version():
+    return migrations[-1][0]
+
+
+# Builds the index without blocking writes to the table.
+# An index left invalid by a failed build is rebuilt.
+def create_index_concurrently(connection, name, definition):
+    valid = connection.execute(text(
+        "SELECT pg_index.indisvalid FROM pg_index "
+        "JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = :name"), name=name).scalar()
+    if valid:
+        return
+    if valid is False:
+        connection.execute("DROP INDEX CONCURRENTLY " + name)
+    connection.execute("CREATE INDEX CONCURRENTLY " + name + " ON " +
+                       definition)
+
+
+# The tables as they were when migrations were added. Later migrations
+# change them, so they are not taken from the models.
+initial_metadata = MetaData()
+Table("user", initial_metadata,
+      Column("id", Integer, primary_key=True),
+      Column("chat_id", Integer),
+      Column("username", String(32), unique=True),
+      Column("first_name", String(80)),
+      Column("last_name", String(80)),
+      Column("language", String(35)))
+Table("sticker", initial_metadata,
+      Column("id", String(80), primary_key=True),
+      Column("set", String(64)))
+Table("label", initial_metadata,
+      Column("id", Integer, primary_key=True),
+      Column("text", String(80), unique=True),
+      Index("ix_label_text_pattern", "text",
+            postgresql_ops={"text": "varchar_pattern_ops"}))
+Table("association", initial_metadata,
+      Column("id", Integer, primary_key=True),
+      Column("user_id", Integer, ForeignKey("user.id")),
+      Column("sticker_id", String(80), ForeignKey("sticker.id")),
+      Column("label_id", Integer, ForeignKey("label.id")),
+      Column("uses", Integer),
+      UniqueConstraint("user_id", "sticker_id", "label_id"))
+Table("pending_labels", initial_metadata,
+      Column("key", String(16), primary_key=True),
+      Column("user_id", Integer, index=True),
+      Column("sticker", Text),
+      Column("labels", postgresql.ARRAY(String(80))),
+      Column("created", DateTime, server_default=func.now()))
+
+
+# Databases created before migrations already have these tables
+@migration(1)
+def create_tables(connection):
+    initial_metadata.create_all(connection, checkfirst=True)
+
+
+@migration(2, transactional=False)
+def create_association_indexes(connection):
+    # Sticker ids, uses and first association by user and labels, as read by
+    # query_get_sticker_ids, query_get_ranked_stickers and get_index_rows,
+    # from the index alone. increment_usage uses the unique constraint.
+    create_index_concurrently(
+        connection, "ix_association_user_label",
+        "association (user_id, label_id, sticker_id, uses, id)")
+
+    # Uses by sticker and label, optionally for a user, as read by
+    # get_usage_count
+    create_index_concurrently(
+        connection, "ix_association_sticker_label",
+        "association (sticker_id, label_id, user_id, uses)")
+
+    # For label tables created before ix_label_text_pattern was declared
+    create_index_concurrently(
+        connection, "ix_label_text_pattern",
+        "label (text varchar_pattern_ops)")
+
+
+# As added by migration 3
+sticker_summary_metadata = MetaData()
+Table("sticker_summary", sticker_summary_metadata,
+      Column("user_id", Integer, primary_key=True),
+      Column("sticker_id", String(80), primary_key=True),
+      Column("label_ids", postgresql.ARRAY(Integer), nullable=False),
+      Column("uses", Integer, nullable=False, server_default="0"),
+      Column("last_used", DateTime),
+      Column("first_association_id", Integer),
+      Index("ix_sticker_summary_label_ids", "label_ids",
+            postgresql_using="gin"))
+
+
+@migration(3)
+def create_sticker_summaries(connection):
+    sticker_summary_metadata.create_all(connection, checkfirst=True)
+    connection.execute(
+        "INSERT INTO sticker_summary "
+        "(user_id, sticker_id, label_ids, uses, first_association_id) "
+        "SELECT user_id, sticker_id, array_agg(label_id ORDER BY label_id), "
+        "coalesce(sum(uses), 0), min(id) "
+        "FROM association GROUP BY user_id, sticker_id "
+        "ON CONFLICT (user_id, sticker_id) DO NOTHING")
+
+
+@migration(4)
+def add_label_search(connection):
+    connection.execute(
+        "ALTER TABLE label ADD COLUMN IF NOT EXISTS search tsvector")
+    connection.execute(
+        "CREATE OR REPLACE FUNCTION label_search() RETURNS trigger AS $$ "
+        "BEGIN NEW.search := " + text_search.vector_sql("NEW.text") + "; "
+        "RETURN NEW; END $$ LANGUAGE plpgsql")
+    connection.execute("DROP TRIGGER IF EXISTS label_search ON label")
+    connection.execute(
+        "CREATE TRIGGER label_search BEFORE INSERT OR UPDATE OF text "
+        "ON label FOR EACH ROW EXECUTE PROCEDURE label_search()")
+    connection.execute(
+        "UPDATE label SET search = " + text_search.vector_sql("text"))
+
+
+@migration(5, transactional=False)
+def create_label_search_index(connection):
+    create_index_concurrently(connection, "ix_label_search",
+                              "label USING gin (search)")
+
+
+# Applies migrations newer than the database's version.
+# Returns the database's version.
+def upgrade(engine):
+    with engine.connect() as lock:
+        lock.execute(text("SELECT pg_advisory_lock(:key)"), key=LOCK_KEY)
+        try:
+            schema_version.create(lock, checkfirst=True)
+            version = lock.scalar(select(
+                [func.coalesce(func.max(schema_version.c.version), 0)]))
+
+            for migration_version, transactional, upgrade_to in migrations:
+                if migration_version <= version:
+                    continue
+
+                logger.info("Upgrading schema to version %s: %s",
+                            migration_version, upgrade_to.__name__)
+                if transactional:
+                    with engine.begin() as connection:
+                        upgrade_to(connection)
+                        connection.execute(schema_version.insert().values(
+                            version=migration_version))
+                else:
+                    with engine.connect() as connection:
+                        connection = connection.execution_options(
+                            isolation_level="AUTOCOMMIT")
+                        upgrade_to(connection)
+                        connection.execute(schema_version.insert().values(
+                            version=migration_version))
+                version = migration_version
+
+            return version
+        finally:
+            lock.execute(text("SELECT pg_advisory_unlock(:key)"),
+                         key=LOCK_KEY)
+
+
+# Shapes of the hot queries, which must be answered from indexes
+HOT_QUERIES = [
+    ("sticker ids by labels",
+     "SELECT sticker_id FROM association "
+     "WHERE user_id = 0 AND label_id IN (1, 2)"),
+    ("ranked stickers",
+     "SELECT sticker_id, count(label_id), sum(uses), min(id) "
+     "FROM association WHERE user_id = 0 AND label_id IN (1, 2) "
+     "GROUP BY sticker_id"),
+    ("index rows",
+     "SELECT association.id, label.text FROM association "
+     "JOIN label ON label.id = association.label_id "
+     "WHERE association.user_id = 0"),
+    ("usage count",
+     "SELECT association.uses FROM association "
+     "JOIN label ON label.id = association.label_id "
+     "WHERE association.user_id = 0 AND association.sticker_id = '' "
+     "AND label.text = ''"),
+    ("total usage count",
+     "SELECT sum(association.uses) FROM association "
+     "JOIN label ON label.id = association.label_id "
+     "WHERE association.sticker_id = '' AND label.text = ''"),
+    ("increment usage",
+     "UPDATE association SET uses = uses + 1 "
+     "WHERE user_id = 0 AND sticker_id = '' AND label_id IN (1, 2)"),
+    ("sticker summaries by labels",
+     "SELECT sticker_id FROM sticker_summary "
+     "WHERE user_id = 0 AND label_ids && ARRAY[1, 2]"),
+    ("label ids by prefix",
+     "SELECT id FROM label WHERE text IN ('') OR text LIKE 'a%'"),
+    ("label ids by text search",
+     "SELECT id FROM label WHERE (text IN ('cats') "
+     "OR search @@ plainto_tsquery('english', 'cats') OR text LIKE 'a%') "
+     "AND EXISTS (SELECT 1 FROM association WHERE user_id = 0 "
+     "AND label_id = label.id)"),
+    ("latest pending labels",
+     "SELECT * FROM pending_labels WHERE user_id = 0 "
+     "ORDER BY created DESC LIMIT 1"),
+]
+
+
+# Returns the tables scanned sequentially in a plan from
+# EXPLAIN (FORMAT JSON)
+def find_seq_scans(plan):
+    tables = []
+    if plan.get("Node Type") == "Seq Scan":
+        tables.append(plan["Relation Name"])
+    for subplan in plan.get("Plans", []):
+        tables.extend(find_seq_scans(subplan))
+    return tables
+
+
+# Returns {query name: [tables]} for hot queries that scan tables
+# sequentially even when the planner is told to avoid it, which only
+# happens if no index can answer them
+def check_plans(engine):
+    failures = {}
+    with engine.begin() as connection:
+        connection.execute("SET LOCAL enable_seqscan = off")
+        for name, query in HOT_QUERIES:
+            explained = connection.execute(
+                text("EXPLAIN (FORMAT JSON) " + query)).scalar()
+            if isinstance(explained, str):
+                explained = json.loads(explained)
+            tables = find_seq_scans(explained[0]["Plan"])
+            if tables:
+                failures[name] = tables
+    return failures
@@ -1,12 +1,59 @@
+import base64
+import collections
+import contextlib
+import functools
+import json
 import logging
+import os
+import threading
 
+import flask
 import flask_sqlalchemy as fsa
+import telegram
+from sqlalchemy import bindparam, event, exists, literal_column, or_, orm, \
+    text, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext import baked
+from sqlalchemy.sql.expression import UpdateBase
 from sqlalchemy.sql.functions import func
 
+from stickertaggerbot import config, db_pool, label_cache, replica
+
 # NOTE: All Models flush the session upon creation
 
 MAX_STRING_SIZE = 80
-database = fsa.SQLAlchemy()
+
+
+class Database(fsa.SQLAlchemy):
+    # Pools connections in db_pool.InstrumentedQueuePool, sized by the
+    # app's SQLALCHEMY_POOL_SIZE and SQLALCHEMY_MAX_OVERFLOW
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        options.setdefault("poolclass", db_pool.InstrumentedQueuePool)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# Sends reads in read only units of work to the replica bind, if the app
+# has one, and everything else to the primary
+class RoutingSession(fsa.SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        binds = self.app.config.get("SQLALCHEMY_BINDS") or {}
+        if self.info.get("read_only") and replica.BIND in binds and \
+                not self._flushing and not isinstance(clause, UpdateBase):
+            return database.get_engine(self.app, bind=replica.BIND)
+        return super().get_bind(mapper, clause)
+
+
+database = Database()
+
+# Hot lookups are built once as baked queries, so that their SQL is compiled
+# once and cached instead of on every call.
+# Queries built in ModelMixin must pass cls to the bakery, since the cache
+# is keyed on the lambda's code object, which subclasses share.
+bakery = baked.bakery()
 
 sqlalchemy_loggers = ["sqlalchemy.engine",
                       "sqlalchemy.dialects",
@@ -20,6 +67,136 @@ def sqlalchemy_logging(log=False, level=logging.DEBUG):
             logging.getLogger(logger).setLevel(level)
 
 
+# Label text -> id, shared by all sessions.
+# Labels created in a transaction are only cached once it commits, as are
+# labels read in a transaction that created labels, since they may be
+# rolled back.
+label_id_cache = label_cache.LabelCache(config.LABEL_CACHE_SIZE)
+
+
+# label_ids: {text: id}
+def cache_label_ids(label_ids, created=False):
+    session = database.session()
+    if created or "pending_label_ids" in session.info:
+        session.info.setdefault("pending_label_ids", {}).update(label_ids)
+    else:
+        label_id_cache.update(label_ids)
+
+
+@event.listens_for(orm.Session, "after_commit")
+def cache_committed_label_ids(session):
+    pending_label_ids = session.info.get("pending_label_ids")
+    if pending_label_ids:
+        label_id_cache.update(pending_label_ids)
+
+
+@event.listens_for(orm.Session, "after_transaction_end")
+def discard_pending_label_ids(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("pending_label_ids", None)
+
+
+# Users whose reads stay on the primary after writing
+recent_writers = replica.RecentWriters(config.DATABASE_REPLICA_STICKINESS)
+
+
+# Marks users as recent writers once the current transaction commits.
+# Only new associations are recorded: usage counts are written behind
+# anyway, and recording them would keep active users off the replica.
+def record_writers(user_ids):
+    database.session().info.setdefault("writer_ids", set()).update(user_ids)
+
+
+@event.listens_for(orm.Session, "after_commit")
+def add_recent_writers(session):
+    writer_ids = session.info.get("writer_ids")
+    if writer_ids:
+        recent_writers.add(writer_ids)
+
+
+@event.listens_for(orm.Session, "after_transaction_end")
+def discard_writers(session, transaction):
+    if transaction.parent is None:
+        session.info.pop("writer_ids", None)
+
+
+# Counts statements issued by the current thread
+_statements = threading.local()
+
+# Handler name -> [updates handled, statements issued]
+statement_counts = collections.defaultdict(lambda: [0, 0])
+_statement_counts_lock = threading.Lock()
+statements_logger = logging.getLogger("database.statements")
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(connection, cursor, statement, parameters, context,
+                    executemany):
+    _statements.count = getattr(_statements, "count", 0) + 1
+
+
+# Decorator for handlers taking (bot, update), that reports how many SQL
+# statements the handler issued from its own thread. Statements issued by
+# work it hands to other threads, such as sticker checks and usage
+# flushes, are not counted.
+def report_statements(handler):
+    @functools.wraps(handler)
+    def wrapper(bot, update):
+        _statements.count = 0
+        try:
+            return handler(bot, update)
+        finally:
+            count = _statements.count
+            # Handlers run concurrently on the executor's threads
+            with _statement_counts_lock:
+                totals = statement_counts[handler.__name__]
+                totals[0] += 1
+                totals[1] += count
+            statements_logger.debug(
+                "%s issued %s statements for update %s",
+                handler.__name__, count, update.update_id)
+
+    return wrapper
+
+
+# Runs the block in the current thread's unit of work, or in a new one:
+# an app context whose session is removed, returning its connection to the
+# pool, when the block exits
+# read_only_for: id of the user the block reads for. A new unit of work
+# reads from the replica, unless the user wrote recently.
+@contextlib.contextmanager
+def session_scope(app, read_only_for=None):
+    if flask.has_app_context():
+        yield database.session
+        return
+
+    with app.app_context():
+        if read_only_for is not None and \
+                read_only_for not in recent_writers:
+            database.session().info["read_only"] = True
+        try:
+            yield database.session
+        finally:
+            database.session.remove()
+
+
+# Decorator for handlers taking (bot, update), that handles each update in
+# one unit of work, so that nothing outlives the update
+# read_only: for handlers that only read, which may read from the replica
+def unit_of_work(app, read_only=False):
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(bot, update):
+            user = update.effective_user
+            read_only_for = user.id if read_only and user else None
+            with session_scope(app, read_only_for):
+                return handler(bot, update)
+
+        return wrapper
+
+    return decorator
+
+
 class ObjectAlreadyExistsError(Exception):
     pass
 
@@ -31,8 +208,9 @@ class ModelMixin(object):
 
     @classmethod
     def id_exists(cls, class_id):
-        query = cls.query.filter_by(id=class_id)
-        return query.count() > 0
+        query = bakery(lambda session: session.query(
+            exists().where(cls.id == bindparam("id"))), cls)
+        return query(database.session()).params(id=class_id).scalar()
 
     # Returns number of records where field_string == value, or
     # returns number of records
@@ -128,18 +306,41 @@ class Sticker(database.Model, ModelMixin):
         else:
             return cls.from_telegram_sticker(telegram_sticker)
 
+    # Inserts the sticker unless it exists, without loading it
+    @classmethod
+    def insert_if_missing(cls, telegram_sticker):
+        statement = postgresql.insert(cls.__table__).values(
+            id=telegram_sticker.file_id, set=telegram_sticker.set_name)
+        statement = statement.on_conflict_do_nothing(index_elements=["id"])
+        database.session.execute(statement)
+
 
 class Label(database.Model, ModelMixin):
+    LIKE_ESCAPE = "\\"
+
     id = database.Column(database.Integer, primary_key=True)
     text = database.Column(database.String(MAX_STRING_SIZE),
                            unique=True)
 
+    # Lexemes of text, set by a trigger, see text_search.vector_sql.
+    # Only used in queries, so not loaded with labels.
+    search = orm.deferred(database.Column(postgresql.TSVECTOR))
+
+    # Allows prefix matching with LIKE to use an index regardless of the
+    # database's collation
+    __table_args__ = (database.Index("ix_label_text_pattern", "text",
+                                     postgresql_ops={
+                                         "text": "varchar_pattern_ops"}),
+                      database.Index("ix_label_search", "search",
+                                     postgresql_using="gin"))
+
     def __init__(self, text):
         if Label.exists(text):
             raise ObjectAlreadyExistsError("Label exists")
 
         self.text = text
         self.add_to_database()
+        cache_label_ids({self.text: self.id}, created=True)
 
     def __str__(self):
         return "ID: " + str(self.id) + \
@@ -147,31 +348,127 @@ class Label(database.Model, ModelMixin):
 
     @classmethod
     def get_or_create(cls, text, get_only=False):
-        query = cls.query.filter_by(text=text)
+        query = bakery(lambda session: session.query(Label).filter(
+            Label.text == bindparam("text")))
+        label = query(database.session()).params(text=text).first()
 
-        if query.count() == 0:
-            if not get_only:
-                return cls(text)
-            else:
-                return None
-        elif query.count() == 1:
-            return query.first()
+        if label is None and not get_only:
+            return cls(text)
+
+        if label is not None:
+            cache_label_ids({label.text: label.id})
+        return label
 
     @classmethod
     def exists(cls, text):
-        query = cls.query.filter_by(text=text)
-        return query.count() > 0
+        query = bakery(lambda session: session.query(
+            exists().where(Label.text == bindparam("text"))))
+        return query(database.session()).params(text=text).scalar()
+
+    # Returns {text: id} for all texts, inserting missing labels.
+    # Labels inserted concurrently by another transaction are picked up by
+    # the second query instead of raising an error.
+    @classmethod
+    def get_or_create_all(cls, texts):
+        texts = sorted(set(texts))  # consistent lock order
+        label_ids, texts = label_id_cache.get_many(texts)
+        if not texts:
+            return label_ids
+
+        statement = postgresql.insert(cls.__table__).values(
+            [{"text": text} for text in texts])
+        statement = statement.on_conflict_do_nothing(
+            index_elements=["text"]).returning(cls.id, cls.text)
+        created_label_ids = {text: label_id for label_id, text
+                             in database.session.execute(statement)}
+        cache_label_ids(created_label_ids, created=True)
+        label_ids.update(created_label_ids)
+
+        existing_texts = [text for text in texts if text not in label_ids]
+        if existing_texts:
+            label_ids.update(cls._get_and_cache_ids(existing_texts))
+
+        return label_ids
+
+    # Escapes LIKE wildcards in text
+    @classmethod
+    def escape_like(cls, text):
+        for character in (cls.LIKE_ESCAPE, "%", "_"):
+            text = text.replace(character, cls.LIKE_ESCAPE + character)
+        return text
 
+    # IDs of labels matching any of the texts, or starting with prefix
     @classmethod
-    def query_get_ids(cls, texts):
+    def query_get_ids(cls, texts, prefix=None):
         select_ids = cls.query.with_entities(cls.id)
         any_texts = cls.text.in_(texts)
+        if prefix:
+            starts_with_prefix = cls.text.like(
+                cls.escape_like(prefix) + "%", escape=cls.LIKE_ESCAPE)
+            any_texts = or_(any_texts, starts_with_prefix)
         return select_ids.filter(any_texts)
 
+    # Returns IDs of the user's labels matching any of the texts by
+    # full-text search under search_config, or equal to any of them, or
+    # starting with prefix. At most limit labels are returned, best
+    # matches first.
+    @classmethod
+    def search_ids(cls, user_id, texts, prefix=None, search_config="simple",
+                   limit=config.LABEL_SEARCH_LIMIT):
+        tsquery = None
+        for label_text in texts:
+            text_query = func.plainto_tsquery(search_config, label_text)
+            tsquery = text_query if tsquery is None else \
+                tsquery.op("||")(text_query)
+
+        conditions = []
+        if texts:
+            conditions.append(cls.text.in_(texts))
+            conditions.append(cls.search.op("@@")(tsquery))
+        if prefix:
+            conditions.append(cls.text.like(
+                cls.escape_like(prefix) + "%", escape=cls.LIKE_ESCAPE))
+        if not conditions:
+            return []
+
+        # Only the user's labels, before limiting, answered by
+        # ix_association_user_label
+        used_by_user = exists().where(Association.user_id == user_id).where(
+            Association.label_id == cls.id)
+
+        query = database.session.query(cls.id).filter(
+            or_(*conditions), used_by_user)
+        if tsquery is not None:
+            query = query.order_by(func.ts_rank(cls.search, tsquery).desc())
+        query = query.order_by(cls.id)
+        return [label_id for label_id, in query.limit(limit)]
+
+    # Returns IDs of labels matching any of the texts, for use with in_().
+    # If all texts are cached, this is a list of IDs, otherwise it is a
+    # subquery, so that no extra round trip is made either way.
+    @classmethod
+    def select_ids(cls, texts, prefix=None):
+        if texts and not prefix:
+            label_ids, missing_texts = label_id_cache.get_many(texts)
+            if not missing_texts:
+                return list(label_ids.values())
+        return cls.query_get_ids(texts, prefix)
+
+    # Returns {text: id} for texts that have labels
+    @classmethod
+    def _get_and_cache_ids(cls, texts):
+        select_labels = database.session.query(cls.id, cls.text)
+        query = select_labels.filter(cls.text.in_(texts))
+        label_ids = {text: label_id for label_id, text in query}
+        cache_label_ids(label_ids)
+        return label_ids
+
     @classmethod
     def get_ids(cls, texts):
-        label_ids = cls.query_get_ids(texts).all()
-        return [label_id for label_id, in label_ids]
+        label_ids, missing_texts = label_id_cache.get_many(texts)
+        if missing_texts:
+            label_ids.update(cls._get_and_cache_ids(missing_texts))
+        return list(label_ids.values())
 
 
 class Association(database.Model, ModelMixin):
@@ -204,6 +501,8 @@ class Association(database.Model, ModelMixin):
         self.label_id = label.id
         self.uses = 0
         self.add_to_database()
+        StickerSummary.add_labels(self.user_id, self.sticker_id,
+                                  [(self.id, self.label_id)])
 
     def __str__(self):
         return "User: " + str(self.user_id) + \
@@ -213,14 +512,27 @@ class Association(database.Model, ModelMixin):
 
     @classmethod
     def exists(cls, user, sticker, label):
-        query = cls.query.filter_by(user_id=user.id,
-                                    sticker_id=sticker.id,
-                                    label_id=label.id)
-        return query.count() > 0
+        query = bakery(lambda session: session.query(exists().where(
+            (Association.user_id == bindparam("user_id")) &
+            (Association.sticker_id == bindparam("sticker_id")) &
+            (Association.label_id == bindparam("label_id")))))
+        query = query(database.session()).params(
+            user_id=user.id, sticker_id=sticker.id, label_id=label.id)
+        return query.scalar()
+
+    # Returns True if the user has labelled the sticker
+    @classmethod
+    def sticker_exists(cls, user_id, sticker_id):
+        query = bakery(lambda session: session.query(exists().where(
+            (Association.user_id == bindparam("user_id")) &
+            (Association.sticker_id == bindparam("sticker_id")))))
+        query = query(database.session()).params(
+            user_id=user_id, sticker_id=sticker_id)
+        return query.scalar()
 
     @classmethod
     def query_get_sticker_ids(cls, user_id, labels, unique=False):
-        label_ids = Label.get_ids(labels)
+        label_ids = Label.select_ids(labels)
         select_sticker_ids = cls.query.with_entities(cls.sticker_id)
         any_labels = cls.label_id.in_(label_ids)
         query = select_sticker_ids.filter_by(user_id=user_id).filter(
@@ -236,38 +548,357 @@ class Association(database.Model, ModelMixin):
         sticker_ids = cls.query_get_sticker_ids(user_id, labels, unique).all()
         return [sticker_id for sticker_id, in sticker_ids]
 
+    # Labels a sticker for a user, creating the sticker and labels as
+    # needed, with one multi-row statement per table.
+    # Existing associations are left unchanged.
+    # Returns [(association_id, label_id, label_text)] for new associations
+    @classmethod
+    def bulk_create(cls, user_id, telegram_sticker, labels):
+        Sticker.insert_if_missing(telegram_sticker)
+        label_ids = Label.get_or_create_all(labels)
+        if not label_ids:
+            return []
+
+        statement = postgresql.insert(cls.__table__).values(
+            [{"user_id": user_id,
+              "sticker_id": telegram_sticker.file_id,
+              "label_id": label_id,
+              "uses": 0} for label_id in sorted(label_ids.values())])
+        statement = statement.on_conflict_do_nothing(
+            index_elements=["user_id", "sticker_id", "label_id"]).returning(
+            cls.id, cls.label_id)
+
+        record_writers([user_id])
+        created = database.session.execute(statement).fetchall()
+        if created:
+            StickerSummary.add_labels(user_id, telegram_sticker.file_id,
+                                      created)
+
+        label_texts = {label_id: text for text, label_id in label_ids.items()}
+        return [(association_id, label_id, label_texts[label_id])
+                for association_id, label_id in created]
+
+    # Stickers matching any of the labels, ordered by the number of
+    # matching labels, then by total uses across those labels, then by
+    # when they were first labelled.
+    # Each row is (sticker_id, matches, uses, first_association_id), where
+    # the last three columns form the sort key used for keyset pagination.
+    # after: sort key of the last row of the previous page
+    # prefix: partially typed label, matching any label that starts with it
+    @classmethod
+    def query_get_ranked_stickers(cls, user_id, labels, after=None,
+                                  prefix=None):
+        label_ids = Label.select_ids(labels, prefix)
+        matches = func.count(cls.label_id)
+        uses = func.coalesce(func.sum(cls.uses), 0)
+        first_id = func.min(cls.id)
+
+        select_stickers = database.session.query(
+            cls.sticker_id, matches, uses, first_id)
+        query = select_stickers.filter(cls.user_id == user_id).filter(
+            cls.label_id.in_(label_ids))
+        query = query.group_by(cls.sticker_id)
+
+        if after:
+            after_matches, after_uses, after_first_id = after
+            query = query.having(
+                tuple_(matches, uses, -first_id) <
+                tuple_(after_matches, after_uses, -after_first_id))
+
+        return query.order_by(matches.desc(), uses.desc(), first_id)
+
+    # Returns [(sticker_id, (matches, uses, first_association_id))]
+    @classmethod
+    def get_ranked_stickers(cls, user_id, labels, limit=None, after=None,
+                            prefix=None):
+        query = cls.query_get_ranked_stickers(user_id, labels, after, prefix)
+        if limit is not None:
+            query = query.limit(limit)
+        return [(sticker_id, (matches, int(uses), first_id))
+                for sticker_id, matches, uses, first_id in query.all()]
+
+    @classmethod
+    def get_ranked_sticker_ids(cls, user_id, labels, limit=None, after=None,
+                               prefix=None):
+        stickers = cls.get_ranked_stickers(user_id, labels, limit, after,
+                                           prefix)
+        return [sticker_id for sticker_id, _ in stickers]
+
+    # Returns [(association_id, label_id, label_text, sticker_id, uses)]
+    # for all of a user's associations
+    @classmethod
+    def get_index_rows(cls, user_id):
+        select_rows = database.session.query(
+            cls.id, cls.label_id, Label.text, cls.sticker_id, cls.uses)
+        query = select_rows.join(Label, Label.id == cls.label_id).filter(
+            cls.user_id == user_id)
+        rows = query.all()
+        cache_label_ids({label_text: label_id
+                         for _, label_id, label_text, _, _ in rows})
+        return rows
+
     @classmethod
     def increment_usage(cls, user_id, sticker_id, labels):
         by_user_and_sticker = cls.query.filter_by(user_id=user_id,
                                                   sticker_id=sticker_id)
-        label_ids = Label.query_get_ids(labels)
+        label_ids = Label.select_ids(labels)
         any_labels = cls.label_id.in_(label_ids)
 
         associations = by_user_and_sticker.filter(any_labels)
 
-        associations.update({'uses': Association.uses + 1},
-                            synchronize_session='fetch')  # Hence not flushing
+        updated = associations.update(
+            {'uses': Association.uses + 1},
+            synchronize_session='fetch')  # Hence not flushing
+        if updated:
+            StickerSummary.add_uses(user_id, sticker_id, updated)
+
+    # counts: {(user_id, sticker_id, label_id): uses to add}
+    # Updates all associations, and their stickers' summaries, in one
+    # statement. Nonexistent associations are ignored.
+    @classmethod
+    def bulk_increment_usage(cls, counts):
+        values = []
+        params = {}
+        for i, ((user_id, sticker_id, label_id), uses) in \
+                enumerate(counts.items()):
+            names = [name + "_" + str(i)
+                     for name in ("user_id", "sticker_id", "label_id", "uses")]
+            values.append("(" + ", ".join(":" + name for name in names) + ")")
+            params.update(zip(names, (user_id, sticker_id, label_id, uses)))
+
+        if not values:
+            return
+
+        statement = text(
+            "WITH updated AS ("
+            "UPDATE association SET uses = association.uses + v.uses "
+            "FROM (VALUES " + ", ".join(values) + ") "
+            "AS v (user_id, sticker_id, label_id, uses) "
+            "WHERE association.user_id = v.user_id "
+            "AND association.sticker_id = v.sticker_id "
+            "AND association.label_id = v.label_id "
+            "RETURNING association.user_id, association.sticker_id, "
+            "v.uses AS uses) "
+            "UPDATE sticker_summary "
+            "SET uses = sticker_summary.uses + u.uses, last_used = now() "
+            "FROM (SELECT user_id, sticker_id, sum(uses) AS uses "
+            "FROM updated GROUP BY user_id, sticker_id) AS u "
+            "WHERE sticker_summary.user_id = u.user_id "
+            "AND sticker_summary.sticker_id = u.sticker_id")
+        database.session.execute(statement, params)
 
     # Fails silently if no such association exists
     @classmethod
     def get_usage_count(cls, sticker_id, label, user_id=None):
-        uses = 0
-
-        label_id = Label.get_ids([label])
-        if not label_id:
-            return uses
-        label_id, = label_id
+        params = {"sticker_id": sticker_id, "label": label}
 
         if user_id is None:
-            query = Association.query.filter_by(sticker_id=sticker_id,
-                                                label_id=label_id)
-            uses = query.with_entities(func.sum(Association.uses)).scalar()
+            query = bakery(lambda session: session.query(
+                func.coalesce(func.sum(Association.uses), 0)).select_from(
+                Association))
         else:
-            select_uses = Association.query.with_entities(Association.uses)
-            query = select_uses.filter_by(
-                user_id=user_id, sticker_id=sticker_id, label_id=label_id)
-            result = query.first()
-            if result:
-                uses, = result
+            query = bakery(lambda session: session.query(Association.uses))
+            query += lambda q: q.filter(
+                Association.user_id == bindparam("user_id"))
+            params["user_id"] = user_id
+
+        query += lambda q: q.join(Label, Label.id == Association.label_id)
+        query += lambda q: q.filter(
+            Association.sticker_id == bindparam("sticker_id"))
+        query += lambda q: q.filter(Label.text == bindparam("label"))
+
+        result = query(database.session()).params(**params).first()
+        if result is None:
+            return 0
 
+        uses, = result
         return uses
+
+
+# One row per sticker per user, kept up to date with its associations, so
+# that inline queries find stickers with one indexed array overlap instead
+# of aggregating associations
+class StickerSummary(database.Model, ModelMixin):
+    user_id = database.Column(database.Integer, primary_key=True)
+    sticker_id = database.Column(database.String(MAX_STRING_SIZE),
+                                 primary_key=True)
+    label_ids = database.Column(postgresql.ARRAY(database.Integer),
+                                nullable=False)
+    uses = database.Column(database.Integer, nullable=False,
+                           server_default="0")  # across all labels
+    last_used = database.Column(database.DateTime)
+    first_association_id = database.Column(database.Integer)
+
+    __table_args__ = (database.Index("ix_sticker_summary_label_ids",
+                                     "label_ids", postgresql_using="gin"),)
+
+    # Recompute every row from associations, keeping last_used
+    REBUILD = [
+        text("INSERT INTO sticker_summary "
+             "(user_id, sticker_id, label_ids, uses, first_association_id) "
+             "SELECT user_id, sticker_id, array_agg(label_id ORDER BY "
+             "label_id), coalesce(sum(uses), 0), min(id) "
+             "FROM association GROUP BY user_id, sticker_id "
+             "ON CONFLICT (user_id, sticker_id) DO UPDATE "
+             "SET label_ids = excluded.label_ids, uses = excluded.uses, "
+             "first_association_id = excluded.first_association_id"),
+        text("DELETE FROM sticker_summary WHERE NOT EXISTS ("
+             "SELECT 1 FROM association "
+             "WHERE association.user_id = sticker_summary.user_id "
+             "AND association.sticker_id = sticker_summary.sticker_id)")]
+
+    # associations: [(association_id, label_id)] newly created for the
+    # user and sticker
+    @classmethod
+    def add_labels(cls, user_id, sticker_id, associations):
+        statement = postgresql.insert(cls.__table__).values(
+            user_id=user_id, sticker_id=sticker_id,
+            label_ids=sorted(label_id for _, label_id in associations),
+            uses=0,
+            first_association_id=min(
+                association_id for association_id, _ in associations))
+        label_ids = literal_column(
+            "ARRAY(SELECT DISTINCT unnest(sticker_summary.label_ids "
+            "|| excluded.label_ids) ORDER BY 1)")
+        first_association_id = func.least(
+            cls.first_association_id, statement.excluded.first_association_id)
+        statement = statement.on_conflict_do_update(
+            index_elements=["user_id", "sticker_id"],
+            set_={"label_ids": label_ids,
+                  "first_association_id": first_association_id})
+        database.session.execute(statement)
+
+    @classmethod
+    def add_uses(cls, user_id, sticker_id, uses):
+        database.session.execute(
+            cls.__table__.update().where(
+                (cls.user_id == user_id) & (cls.sticker_id == sticker_id)
+            ).values(uses=cls.uses + uses, last_used=func.now()))
+
+    # Returns the number of summaries
+    @classmethod
+    def rebuild(cls):
+        for statement in cls.REBUILD:
+            database.session.execute(statement)
+        return database.session.query(func.count(cls.user_id)).scalar()
+
+    @classmethod
+    def user_has_stickers(cls, user_id):
+        query = bakery(lambda session: session.query(exists().where(
+            StickerSummary.user_id == bindparam("user_id"))))
+        return query(database.session()).params(user_id=user_id).scalar()
+
+    # Stickers with any of the labels, ordered by the number of matching
+    # labels, then by total uses, then by when they were first labelled.
+    # Returns [(sticker_id, (matches, uses, first_association_id))], as
+    # Association.get_ranked_stickers does.
+    # after: sort key of the last row of the previous page
+    # prefix: partially typed label, matching any label that starts with it
+    @classmethod
+    def get_ranked_stickers(cls, user_id, labels, limit=None, after=None,
+                            prefix=None):
+        label_ids = Label.select_ids(labels, prefix)
+        if isinstance(label_ids, list):
+            return cls.get_ranked_stickers_by_ids(user_id, label_ids, limit,
+                                                  after)
+
+        # Labels that are not all cached are looked up in the same
+        # statement, among the user's labels only, so that the ids of
+        # every label matching a short prefix never leave the database
+        conditions = ["label.text = ANY(CAST(:texts AS VARCHAR[]))"]
+        params = {"texts": list(labels)}
+        if prefix:
+            conditions.append("label.text LIKE :prefix ESCAPE '" +
+                              Label.LIKE_ESCAPE + "'")
+            params["prefix"] = Label.escape_like(prefix) + "%"
+        label_ids_sql = (
+            "ARRAY(SELECT label.id FROM label "
+            "WHERE (" + " OR ".join(conditions) + ") "
+            "AND EXISTS (SELECT 1 FROM association "
+            "WHERE association.user_id = :user_id "
+            "AND association.label_id = label.id))")
+        return cls._get_ranked_stickers(user_id, label_ids_sql, params,
+                                        limit, after)
+
+    # As get_ranked_stickers, for labels already looked up
+    @classmethod
+    def get_ranked_stickers_by_ids(cls, user_id, label_ids, limit=None,
+                                   after=None):
+        if not label_ids:
+            return []
+
+        return cls._get_ranked_stickers(
+            user_id, "CAST(:label_ids AS INTEGER[])",
+            {"label_ids": list(label_ids)}, limit, after)
+
+    # label_ids_sql: SQL array of label ids, using bind parameters in params
+    @classmethod
+    def _get_ranked_stickers(cls, user_id, label_ids_sql, params, limit,
+                             after):
+        params = dict(params, user_id=user_id)
+        query = ("SELECT sticker_id, matches, uses, first_association_id "
+                 "FROM (SELECT sticker_id, uses, first_association_id, "
+                 "(SELECT count(*) FROM unnest(label_ids) AS label_id "
+                 "WHERE label_id = ANY(" + label_ids_sql + ")) "
+                 "AS matches "
+                 "FROM sticker_summary WHERE user_id = :user_id "
+                 "AND label_ids && " + label_ids_sql + ") "
+                 "AS matching ")
+        if after:
+            after_matches, after_uses, after_first_id = after
+            query += ("WHERE (matches, uses, -first_association_id) < "
+                      "(:after_matches, :after_uses, :after_first_id) ")
+            params.update(after_matches=after_matches, after_uses=after_uses,
+                          after_first_id=-after_first_id)
+        query += "ORDER BY matches DESC, uses DESC, first_association_id"
+        if limit is not None:
+            query += " LIMIT :limit"
+            params["limit"] = limit
+
+        rows = database.session.execute(text(query), params)
+        return [(sticker_id, (matches, uses, first_id))
+                for sticker_id, matches, uses, first_id in rows]
+
+
+# Labelling in progress, for the stateless labelling flow, which keeps no
+# conversations in memory. Rows are referenced from inline keyboards by key.
+class PendingLabels(database.Model, ModelMixin):
+    KEY_BYTES = 8
+
+    key = database.Column(database.String(16), primary_key=True)
+    user_id = database.Column(database.Integer, index=True)
+    sticker = database.Column(database.Text)  # telegram.Sticker as JSON
+    labels = database.Column(postgresql.ARRAY(
+        database.String(MAX_STRING_SIZE)))
+    created = database.Column(database.DateTime, server_default=func.now())
+
+    def __init__(self, user_id, telegram_sticker):
+        self.key = base64.urlsafe_b64encode(
+            os.urandom(PendingLabels.KEY_BYTES)).rstrip(b"=").decode()
+        self.user_id = user_id
+        self.sticker = json.dumps(telegram_sticker.to_dict(),
+                                  separators=(",", ":"))
+        self.add_to_database()
+
+    @property
+    def telegram_sticker(self):
+        return telegram.Sticker.de_json(json.loads(self.sticker), None)
+
+    # Replaces the user's labelling in progress, if any
+    @classmethod
+    def start(cls, user_id, telegram_sticker):
+        cls.query.filter(cls.user_id == user_id).delete(
+            synchronize_session=False)
+        return cls(user_id, telegram_sticker)
+
+    @classmethod
+    def get_latest(cls, user_id):
+        query = bakery(lambda session: session.query(PendingLabels))
+        query += lambda q: q.filter(
+            PendingLabels.user_id == bindparam("user_id"))
+        query += lambda q: q.order_by(PendingLabels.created.desc())
+        return query(database.session()).params(user_id=user_id).first()
+
+    def delete(self):
+        database.session.delete(self)
+        database.session.flush()
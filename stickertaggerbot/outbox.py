@@ -0,0 +1,179 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import telegram.error
+
+logger = logging.getLogger("outbox")
+
+
+# Allows rate calls per second on average, and up to burst at once
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    # _updated is in the future while paused
+    def _refill(self, now):
+        if now > self._updated:
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+
+    # Returns seconds until a token is available
+    def delay(self, now):
+        self._refill(now)
+        paused = max(0, self._updated - now)
+        if self._tokens >= 1:
+            return paused
+        return paused + (1 - self._tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self._tokens -= 1
+
+    # Refills no tokens until seconds have passed
+    def pause(self, now, seconds):
+        self._refill(now)
+        self._tokens = min(self._tokens, 0)
+        self._updated = max(self._updated, now + seconds)
+
+
+# Queue of outgoing messages, sent by a pool of sender threads within
+# Telegram's limits on messages per second overall and per chat.
+# Messages to a chat are sent one at a time, in the order they were put.
+# Messages failing with RetryAfter are retried once the chat may be sent
+# to again.
+class Outbox(object):
+    def __init__(self, senders, global_rate, chat_rate):
+        self.senders = senders
+        self.chat_rate = chat_rate
+        self.sent = 0
+        self.retried = 0
+
+        self._global = TokenBucket(global_rate)
+        self._chats = {}  # chat id -> deque of pending sends
+        self._chat_buckets = {}  # chat id -> TokenBucket
+        self._idle = collections.deque()  # (time, chat id) of emptied chats
+        self._ready = []  # heap of (time, sequence, chat id)
+        self._sequence = itertools.count()  # breaks ties between chats
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = []
+
+    def __len__(self):
+        with self._condition:
+            return sum(len(sends) for sends in self._chats.values())
+
+    def start(self):
+        for number in range(self.senders):
+            thread = threading.Thread(target=self._run,
+                                      name="outbox." + str(number),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    # Sends pending messages before returning
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    # send: callable making the Bot API call, which may raise RetryAfter
+    def put(self, chat_id, send):
+        with self._condition:
+            now = time.monotonic()
+            self._prune(now)
+
+            sends = self._chats.get(chat_id)
+            if sends is None:
+                sends = self._chats[chat_id] = collections.deque()
+                self._schedule(chat_id, now)
+            sends.append(send)
+            self._condition.notify()
+
+    # Drops buckets of chats that have been idle long enough for their
+    # buckets to be full again
+    # Must be called while holding self._condition
+    def _prune(self, now):
+        while self._idle and now - self._idle[0][0] > 1 / self.chat_rate:
+            _, chat_id = self._idle.popleft()
+            if chat_id not in self._chats:
+                self._chat_buckets.pop(chat_id, None)
+
+    # Schedules chat_id to be sent to once its bucket allows it
+    # Must be called while holding self._condition
+    def _schedule(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(
+                self.chat_rate, 1)
+        heapq.heappush(self._ready, (now + bucket.delay(now),
+                                     next(self._sequence), chat_id))
+
+    # Returns (chat id, send), or None once stopped with nothing pending
+    def _next(self):
+        with self._condition:
+            while True:
+                if not self._ready:
+                    if self._stopped and not self._chats:
+                        return None
+                    self._condition.wait()
+                    continue
+
+                now = time.monotonic()
+                ready_time, _, chat_id = self._ready[0]
+                delay = max(ready_time - now, self._global.delay(now))
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+
+                heapq.heappop(self._ready)
+                self._chat_buckets[chat_id].take(now)
+                self._global.take(now)
+                return chat_id, self._chats[chat_id][0]
+
+    # Must be called while holding self._condition
+    def _finish(self, chat_id):
+        now = time.monotonic()
+        sends = self._chats[chat_id]
+        sends.popleft()
+        if sends:
+            self._schedule(chat_id, now)
+        else:
+            del self._chats[chat_id]
+            self._idle.append((now, chat_id))
+        self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            pending = self._next()
+            if pending is None:
+                return
+            chat_id, send = pending
+
+            try:
+                send()
+            except telegram.error.RetryAfter as e:
+                logger.warning("Retrying message to chat %s after %s seconds",
+                               chat_id, e.retry_after)
+                with self._condition:
+                    self.retried += 1
+                    now = time.monotonic()
+                    self._chat_buckets[chat_id].pause(now, e.retry_after)
+                    self._schedule(chat_id, now)
+                    self._condition.notify()
+                continue
+            except Exception as e:
+                logger.error(e)
+
+            with self._condition:
+                self.sent += 1
+                self._finish(chat_id)
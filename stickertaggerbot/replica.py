@@ -0,0 +1,45 @@
+import collections
+import threading
+import time
+
+# Name of the read replica in SQLALCHEMY_BINDS
+BIND = "replica"
+
+
+# Users who wrote within the last window seconds, whose reads go to the
+# primary so that they see their own writes despite replication lag
+class RecentWriters(object):
+    def __init__(self, window):
+        self.window = window
+        self._written = collections.OrderedDict()  # user id -> time
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            return len(self._written)
+
+    def __contains__(self, user_id):
+        with self._lock:
+            self._prune(time.monotonic())
+            return user_id in self._written
+
+    def add(self, user_ids):
+        with self._lock:
+            now = time.monotonic()
+            for user_id in user_ids:
+                self._written[user_id] = now
+                self._written.move_to_end(user_id)
+            self._prune(now)
+
+    def clear(self):
+        with self._lock:
+            self._written.clear()
+
+    # Must be called while holding self._lock
+    def _prune(self, now):
+        while self._written:
+            user_id, written = next(iter(self._written.items()))
+            if now - written < self.window:
+                return
+            del self._written[user_id]
@@ -0,0 +1,38 @@
+# PostgreSQL text search configurations by ISO 639-1 language code
+CONFIGS = {"da": "danish",
+           "de": "german",
+           "en": "english",
+           "es": "spanish",
+           "fi": "finnish",
+           "fr": "french",
+           "hu": "hungarian",
+           "it": "italian",
+           "nb": "norwegian",
+           "nl": "dutch",
+           "nn": "norwegian",
+           "no": "norwegian",
+           "pt": "portuguese",
+           "ro": "romanian",
+           "ru": "russian",
+           "sv": "swedish",
+           "tr": "turkish"}
+
+# For languages without a configuration, which matches words unstemmed
+DEFAULT = "simple"
+
+
+# language: IETF language tag, as in User.language, e.g. "en-US"
+def config_for(language):
+    if not language:
+        return DEFAULT
+    return CONFIGS.get(language.split("-")[0].lower(), DEFAULT)
+
+
+# SQL expression of the tsvector stored for a label, holding its lexemes
+# under every configuration, so that one vector matches queries made in
+# any of them.
+# Changing the configurations requires a migration rebuilding the vectors.
+def vector_sql(column):
+    configs = sorted(set(CONFIGS.values())) + [DEFAULT]
+    return " || ".join("to_tsvector('" + config + "', " + column + ")"
+                       for config in configs)
@@ -0,0 +1,103 @@
+import collections
+import logging
+import threading
+
+from stickertaggerbot import models
+
+logger = logging.getLogger("usage")
+
+
+# Write-behind buffer for association usage counts.
+# Increments are summed in memory and written by a background thread in a
+# single statement every interval seconds, or sooner once max_events
+# increments are pending. Failed flushes are retried with the next one,
+# and pending increments are dropped after max_retries consecutive
+# failures.
+class UsageBuffer(object):
+    def __init__(self, app, interval, max_events, max_retries):
+        self.app = app
+        self.interval = interval
+        self.max_events = max_events
+        self.max_retries = max_retries
+        self.flushes = 0
+        self.flushed_events = 0
+        self.dropped_events = 0
+
+        self._failures = 0  # consecutive failed flushes
+
+        self._counts = collections.Counter()  # (user, sticker, label) -> uses
+        self._events = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def __len__(self):
+        return len(self._counts)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="usage",
+                                        daemon=True)
+        self._thread.start()
+
+    # Flushes pending increments before returning
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def add(self, user_id, sticker_id, label_ids):
+        with self._lock:
+            for label_id in label_ids:
+                self._counts[(user_id, sticker_id, label_id)] += 1
+                self._events += 1
+            if self._events >= self.max_events:
+                self._wake.set()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                counts, self._counts = self._counts, collections.Counter()
+                events, self._events = self._events, 0
+
+            if not counts:
+                return
+
+            with models.session_scope(self.app):
+                try:
+                    models.Association.bulk_increment_usage(counts)
+                    models.database.session.commit()
+                except Exception:
+                    logger.exception("Failed to flush %s usage increments",
+                                     events)
+                    models.database.session.rollback()
+
+                    self._failures += 1
+                    if self._failures > self.max_retries:
+                        self._failures = 0
+                        self.dropped_events += events
+                        logger.warning(
+                            "Dropped %s usage increments after %s failed "
+                            "flushes, %s dropped in total", events,
+                            self.max_retries + 1, self.dropped_events)
+                        return
+
+                    # Retry with the next flush
+                    with self._lock:
+                        self._counts.update(counts)
+                        self._events += events
+                    return
+
+            self._failures = 0
+            self.flushes += 1
+            self.flushed_events += events
+            logger.debug("Flushed %s usage increments", events)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
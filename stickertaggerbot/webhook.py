@@ -0,0 +1,93 @@
+import threading
+
+# Telegram accepts a Bot API method call as the response to a webhook
+# request, which saves sending it as a request of its own. The webhook
+# waits up to a deadline for handlers to give it a reply; replies given
+# after the webhook has stopped waiting are sent as usual.
+
+
+# Returns True if handlers for update reply with a single method call
+def expects_reply(update):
+    if update.inline_query:
+        return True
+
+    message = update.message
+    if not message:
+        return False
+    return bool(message.sticker or
+                (message.text and message.text.startswith(("/start",
+                                                           "/help"))))
+
+
+class Reply(object):
+    def __init__(self):
+        self.payload = None
+        self._waiting = True
+        self._lock = threading.Lock()
+        self._given = threading.Event()
+
+    # Returns False if the webhook has stopped waiting.
+    # payload None tells the webhook not to wait for a reply.
+    def give(self, payload):
+        with self._lock:
+            if not self._waiting:
+                return False
+            self._waiting = False
+            self.payload = payload
+        self._given.set()
+        return True
+
+    # Returns the payload, or None if there is none by timeout
+    def wait(self, timeout):
+        self._given.wait(timeout)
+        with self._lock:
+            self._waiting = False
+            return self.payload
+
+
+# Replies the webhook is waiting for, by update ID
+class Replies(object):
+    def __init__(self):
+        self.replied = 0  # in the webhook response
+        self.timed_out = 0  # sent separately instead
+        self._replies = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._replies)
+
+    def expect(self, update):
+        with self._lock:
+            self._replies[update.update_id] = Reply()
+
+    def is_waiting(self, update):
+        return update.update_id in self._replies
+
+    # Returns the payload, or None if the update has no reply by timeout
+    def wait(self, update, timeout):
+        reply = self._replies[update.update_id]
+        payload = reply.wait(timeout)
+        with self._lock:
+            del self._replies[update.update_id]
+
+        if payload:
+            self.replied += 1
+        else:
+            self.timed_out += 1
+        return payload
+
+    # Returns False if the webhook is not waiting for a reply to update,
+    # in which case the method should be called as usual
+    def give(self, update, method, **params):
+        reply = self._replies.get(update.update_id)
+        if reply is None:
+            return False
+
+        params["method"] = method
+        return reply.give(params)
+
+    # Stops the webhook waiting for a reply to update
+    def release(self, update):
+        reply = self._replies.get(update.update_id)
+        if reply is not None:
+            reply.give(None)
@@ -22,7 +22,9 @@ def route_update():
     return ""
 
 
-tables = [models.Association,
+tables = [models.PendingLabels,
+          models.StickerSummary,
+          models.Association,
           models.User,
           models.Sticker,
           models.Label]
@@ -33,6 +35,7 @@ def clear_all_tables():
         models.database.session.query(table).delete()
 
     models.database.session.flush()
+    models.label_id_cache.clear()
 
 
 # Returns a new mock Conversation instance
@@ -0,0 +1,35 @@
+from unittest import mock
+
+import telegram.utils.request
+
+from stickertaggerbot import bot_request
+
+base_url = "https://api.telegram.org/bottoken/"
+
+
+class TestRequest(object):
+    def test_parse_timeouts(self):
+        assert bot_request.parse_timeouts(
+            "answerInlineQuery=2, sendMessage=10") == \
+            {"answerInlineQuery": 2, "sendMessage": 10}
+        assert bot_request.parse_timeouts("") == {}
+
+    @mock.patch.object(telegram.utils.request.Request, "post")
+    def test_read_timeout_per_method(self, post):
+        request = bot_request.Request(2, 5, 5, {"answerInlineQuery": 2})
+
+        request.post(base_url + "answerInlineQuery", {})
+        post.assert_called_with(base_url + "answerInlineQuery", {},
+                                timeout=2)
+
+        request.post(base_url + "sendMessage", {})
+        post.assert_called_with(base_url + "sendMessage", {}, timeout=None)
+
+        request.post(base_url + "answerInlineQuery", {}, timeout=7)
+        post.assert_called_with(base_url + "answerInlineQuery", {},
+                                timeout=7)
+
+    def test_connection_counts(self):
+        request = bot_request.Request(2, 5, 5)
+        assert request.connection_counts() == (0, 0)
+        assert request.con_pool_size == 2
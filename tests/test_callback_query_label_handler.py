@@ -69,8 +69,8 @@ class TestCallbackQueryHandlerInLabelState(object):
                         mock.MagicMock(autospec=True,
                                        return_value=database_user)), \
              mock.patch(*get_or_create(conversation)), \
-             mock.patch(base_patch_path_labels + ".Association",
-                        mock.MagicMock(autospec=True)), \
+             mock.patch(base_patch_path_labels + ".Association.bulk_create",
+                        mock.MagicMock(autospec=True, return_value=[])), \
              mock.patch(base_patch_path_labels + ".database.session.commit",
                         mock.MagicMock(autospec=True)):
             run_handler(callbacks.create_callback_handler, update)
@@ -5,20 +5,29 @@ import pytest
 from stickertaggerbot.handlers import chosen_inline_result
 from stickertaggerbot.inline_query_result import Sticker
 from tests import telegram_factories
-from tests.misc import run_handler
+from tests.misc import app_for_testing, run_handler
 
 base_patch_path = "stickertaggerbot.handlers.chosen_inline_result"
 
 
 class TestChosenInlineResultHandler(object):
+    # (association_id, label_id, label_text, sticker_id, uses)
+    rows = [(0, 0, "label_0", "sticker_0", 0),
+            (1, 1, "label_1", "sticker_0", 0),
+            (2, 2, "label_2", "sticker_0", 0)]
+
     @pytest.fixture(autouse=True)
     def patch_telegram(self):
-        patch = mock.patch(
-            base_patch_path + ".models.Association.increment_usage",
-            new_callable=mock.MagicMock(autospec=True))
-        patch.start()
+        patches = [
+            mock.patch(base_patch_path + ".models.Association.get_index_rows",
+                       mock.MagicMock(autospec=True, return_value=self.rows)),
+            mock.patch.object(app_for_testing.usage, "add")]
+
+        for patch in patches:
+            patch.start()
         yield
-        patch.stop()
+        for patch in patches:
+            patch.stop()
 
     def test_single_label(self):
         query_string = "label_0"
@@ -33,8 +42,10 @@ class TestChosenInlineResultHandler(object):
                     update)
 
         user_id = update.effective_user.id
-        chosen_inline_result.models.Association.increment_usage.assert_called_once_with(
-            user_id, sticker_id, [query_string])
+        app_for_testing.usage.add.assert_called_once_with(
+            user_id, sticker_id, [0])
+        assert app_for_testing.index.get(app_for_testing, user_id) \
+            .get_usage_count(sticker_id, query_string) == 1
 
     def test_multiple_labels(self):
         labels = ["label_0", "label_1", "label_2"]
@@ -50,10 +61,22 @@ class TestChosenInlineResultHandler(object):
                     update)
 
         user_id = update.effective_user.id
-        chosen_inline_result.models.Association.increment_usage.assert_called_once_with(
-            user_id, sticker_id, labels)
+        app_for_testing.usage.add.assert_called_once_with(
+            user_id, sticker_id, [0, 1, 2])
 
     # TODO: Flesh out when soft labels are implemented.
-    # Nonexistent labels are currently ignored at increment_usage
+    # Nonexistent labels are currently ignored
     def test_nonexistent_labels(self):
-        pass
+        sticker_id = "sticker_0"
+
+        result_id = Sticker.generate_result_id(sticker_id)
+        update = telegram_factories.ChosenInlineResultUpdateFactory(
+            chosen_inline_result__query="label_0 nonexistent",
+            chosen_inline_result__result_id=result_id)
+
+        run_handler(chosen_inline_result.create_chosen_inline_result_handler,
+                    update)
+
+        user_id = update.effective_user.id
+        app_for_testing.usage.add.assert_called_once_with(
+            user_id, sticker_id, [0])
@@ -0,0 +1,64 @@
+from stickertaggerbot import coalescing
+from tests import telegram_factories
+
+
+def inline_query_update(user, update_id):
+    return telegram_factories.InlineQueryUpdateFactory(
+        update_id=update_id, inline_query__from_user=user)
+
+
+class TestInlineQueryCoalescer(object):
+    def test_latest_query(self):
+        coalescer = coalescing.InlineQueryCoalescer()
+        update = inline_query_update(telegram_factories.UserFactory(), 1)
+        coalescer.register(update)
+
+        assert not coalescer.drop(update)
+        assert not coalescer.cancel(update)
+
+        coalescer.finish(update)
+        assert len(coalescer) == 0
+
+    def test_superseded_query(self):
+        coalescer = coalescing.InlineQueryCoalescer()
+        user = telegram_factories.UserFactory()
+        old_update = inline_query_update(user, 1)
+        new_update = inline_query_update(user, 2)
+        coalescer.register(old_update)
+
+        assert not coalescer.drop(old_update)
+        coalescer.register(new_update)
+        assert coalescer.cancel(old_update)
+        assert coalescer.drop(old_update)
+        assert coalescer.cancelled == 1
+        assert coalescer.dropped == 1
+
+        coalescer.finish(old_update)
+        assert not coalescer.drop(new_update)
+        coalescer.finish(new_update)
+        assert len(coalescer) == 0
+
+    def test_other_users(self):
+        coalescer = coalescing.InlineQueryCoalescer()
+        update = inline_query_update(telegram_factories.UserFactory(), 1)
+        other_update = inline_query_update(telegram_factories.UserFactory(), 2)
+        coalescer.register(update)
+        coalescer.register(other_update)
+
+        assert not coalescer.drop(update)
+        assert not coalescer.drop(other_update)
+
+
+class TestCoalescingQueue(object):
+    def test_put(self):
+        coalescer = coalescing.InlineQueryCoalescer()
+        update_queue = coalescing.CoalescingQueue(coalescer)
+        user = telegram_factories.UserFactory()
+
+        update_queue.put(inline_query_update(user, 1))
+        update_queue.put(inline_query_update(user, 2))
+        update_queue.put(telegram_factories.MessageUpdateFactory())
+
+        assert update_queue.qsize() == 3
+        assert coalescer.drop(update_queue.get())
+        assert not coalescer.drop(update_queue.get())
@@ -0,0 +1,46 @@
+import time
+
+import pytest
+
+from stickertaggerbot import conversation_store
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmpdir):
+    if request.param == "memory":
+        return conversation_store.MemoryStore()
+    return conversation_store.SQLiteStore(str(tmpdir.join("conversations")))
+
+
+class TestStore(object):
+    def test_save_and_load(self, store):
+        assert store.load(0) is None
+
+        assert store.save(0, b"first", None) == 1
+        version, serialized, _ = store.load(0)
+        assert version == 1
+        assert serialized == b"first"
+        assert len(store) == 1
+
+    def test_optimistic_versioning(self, store):
+        store.save(0, b"first", None)
+
+        assert store.save(0, b"conflicting", None) is None
+        assert store.save(0, b"second", 1) == 2
+        assert store.save(0, b"stale", 1) is None
+
+        version, serialized, _ = store.load(0)
+        assert version == 2
+        assert serialized == b"second"
+
+    def test_delete(self, store):
+        store.save(0, b"first", None)
+        store.delete(0)
+        assert store.load(0) is None
+        assert store.save(0, b"again", None) == 1
+
+    def test_expire(self, store):
+        store.save(0, b"old", None)
+        before = time.time() + 1
+        assert store.expire(before) == 1
+        assert len(store) == 0
@@ -1,9 +1,10 @@
 import time
+import threading
 import concurrent.futures
 import pytest
 from unittest import mock
 
-from stickertaggerbot import conversations, config
+from stickertaggerbot import conversations, config, conversation_store
 from tests import telegram_factories
 
 States = conversations.Conversation.State
@@ -153,6 +154,40 @@ class TestChangeState(object):
         assert conversation.state == States.STICKER
         assert conversation._future is None
 
+    def test_timed_out(self, conversation, incomplete_future):
+        conversation._future = incomplete_future
+
+        with pytest.raises(ValueError):
+            conversation.change_state(States.STICKER, timeout=0.1)
+        assert conversation.state == States.IDLE
+
+    def test_wakes_when_future_completes(self, conversation,
+                                         incomplete_future):
+        conversation._future = incomplete_future
+        threading.Timer(0.1, incomplete_future.set_result, [True]).start()
+
+        conversation.change_state(States.STICKER, timeout=3)
+        assert conversation.state == States.STICKER
+
+    def test_waits_register_one_callback(self, conversation,
+                                         incomplete_future):
+        incomplete_future.add_done_callback = mock.Mock(
+            wraps=incomplete_future.add_done_callback)
+        conversation._future = incomplete_future
+
+        def wake_repeatedly():
+            for _ in range(3):
+                time.sleep(0.05)
+                with conversation._condition:
+                    conversation._condition.notify_all()
+            incomplete_future.set_result(True)
+
+        threading.Thread(target=wake_repeatedly).start()
+        conversation.change_state(States.STICKER, timeout=3)
+        assert conversation.state == States.STICKER
+        incomplete_future.add_done_callback.assert_called_once_with(
+            conversation._notify_waiters)
+
     def test_wrong_transition_order(self, conversation):
         with pytest.raises(ValueError):
             conversation.change_state(States.LABEL)
@@ -192,6 +227,50 @@ class TestGetFutureResult(object):
         assert conversation.get_future_result()
 
 
+class TestWhenFutureDone(object):
+    def test_no_future(self, conversation):
+        with pytest.raises(ValueError):
+            conversation.when_future_done(mock.Mock())
+
+    def test_completed_future(self, conversation, completed_future):
+        conversation._future = completed_future
+        callback = mock.Mock()
+
+        conversation.when_future_done(callback)
+        callback.assert_called_once_with(True)
+
+    def test_incomplete_future(self, conversation, incomplete_future):
+        conversation._future = incomplete_future
+        callback = mock.Mock()
+
+        conversation.when_future_done(callback, timeout=3)
+        callback.assert_not_called()
+
+        incomplete_future.set_result(False)
+        callback.assert_called_once_with(False)
+
+    def test_timed_out(self, conversation, incomplete_future):
+        conversation._future = incomplete_future
+        called = threading.Event()
+        callback = mock.Mock(side_effect=lambda result: called.set())
+
+        conversation.when_future_done(callback, timeout=0.1)
+        assert called.wait(3)
+
+        incomplete_future.set_result(True)
+        callback.assert_called_once_with(None)
+
+    def test_cancelled_future(self, conversation):
+        future = concurrent.futures.Future()
+        conversation._future = future
+        callback = mock.Mock()
+
+        conversation.when_future_done(callback, timeout=0.1)
+        future.cancel()
+        time.sleep(0.2)
+        callback.assert_not_called()
+
+
 class TestGetOrCreate(object):
     def test_get(self, conversation):
         conversations.all[conversation.user.id] = conversation
@@ -208,3 +287,142 @@ class TestGetOrCreate(object):
         current_size = len(conversations.all)
 
         assert current_size == original_size + 1
+
+
+class TestRegistry(object):
+    @pytest.fixture()
+    def registry(self):
+        return conversations.Registry(2, 60)
+
+    def create(self, registry):
+        return registry.get_or_create(telegram_factories.UserFactory(),
+                                      chat=telegram_factories.ChatFactory())
+
+    def test_lru_eviction_of_idle_conversations(self, registry):
+        first = self.create(registry)
+        second = self.create(registry)
+        registry.get_or_create(first.user, get_only=True)
+        third = self.create(registry)
+
+        assert first.user.id in registry
+        assert second.user.id not in registry
+        assert third.user.id in registry
+        assert registry.evictions == 1
+
+    def test_busy_conversations_are_kept(self, registry):
+        first = self.create(registry)
+        first.state = States.STICKER
+        second = self.create(registry)
+        second.state = States.LABEL
+        self.create(registry)
+
+        assert len(registry) == 3
+        assert registry.evictions == 0
+
+    def test_expiry(self, registry):
+        conversation = self.create(registry)
+        conversation.state = States.STICKER
+        registry.timeout = 0
+
+        assert registry.get_or_create(conversation.user, get_only=True) is None
+        assert registry.expirations == 1
+        assert conversation.state == States.IDLE
+
+
+class TestStripedRegistry(object):
+    def test_get_or_create(self):
+        registry = conversations.StripedRegistry(4, 8, 60)
+        users = [telegram_factories.UserFactory() for _ in range(8)]
+        created = [
+            registry.get_or_create(user,
+                                   chat=telegram_factories.ChatFactory())
+            for user in users]
+
+        assert len(registry) == 8
+        for user, conversation in zip(users, created):
+            assert registry.get_or_create(user, get_only=True) is conversation
+            assert registry[user.id] is conversation
+
+
+class TestSharedRegistry(object):
+    @pytest.fixture()
+    def store(self):
+        return conversation_store.MemoryStore()
+
+    def test_shared_between_registries(self, store):
+        registry = conversations.SharedRegistry(store, 60)
+        other_registry = conversations.SharedRegistry(store, 60)
+        user = telegram_factories.UserFactory()
+
+        conversation = registry.get_or_create(
+            user, chat=telegram_factories.ChatFactory())
+        conversation.change_state(States.STICKER)
+        conversation.labels = ["label"]
+
+        other_conversation = other_registry.get_or_create(user, get_only=True)
+        assert other_conversation.user.id == user.id
+        assert other_conversation.state == States.STICKER
+        assert other_conversation.labels == ["label"]
+
+    def test_conflicting_change(self, store):
+        registry = conversations.SharedRegistry(store, 60)
+        user = telegram_factories.UserFactory()
+
+        conversation = registry.get_or_create(
+            user, chat=telegram_factories.ChatFactory())
+        stale_conversation = registry.get_or_create(user, get_only=True)
+        conversation.change_state(States.STICKER)
+
+        # Reloaded before checking the transition
+        with pytest.raises(ValueError):
+            stale_conversation.change_state(States.STICKER)
+        assert stale_conversation.state == States.STICKER
+
+        # Reloaded and reapplied
+        stale_conversation.labels = ["label"]
+        assert registry[user.id].labels == ["label"]
+        assert registry[user.id].state == States.STICKER
+
+    def test_expiry(self, store):
+        registry = conversations.SharedRegistry(store, 0)
+        user = telegram_factories.UserFactory()
+        registry.get_or_create(user, chat=telegram_factories.ChatFactory())
+
+        time.sleep(0.01)
+        assert registry.get_or_create(user, get_only=True) is None
+
+    def test_labels_wait_for_sticker_check(self, tmpdir, incomplete_future):
+        registry = conversations.SharedRegistry(
+            conversation_store.SQLiteStore(str(tmpdir.join("conversations"))),
+            60)
+        user = telegram_factories.UserFactory()
+        sticker = telegram_factories.StickerFactory()
+
+        # Sticker step
+        conversation = registry.get_or_create(
+            user, chat=telegram_factories.ChatFactory())
+        conversation.change_state(States.STICKER, incomplete_future,
+                                  force=True)
+
+        def respond(new_sticker):
+            conversation.sticker = sticker
+
+        conversation.when_future_done(respond)
+
+        # Labels step, with the conversation loaded again
+        labelled = threading.Event()
+
+        def label():
+            labels_conversation = registry[user.id]
+            labels_conversation.change_state(States.LABEL)
+            labelled.set()
+
+        thread = threading.Thread(target=label)
+        thread.start()
+        assert not labelled.wait(0.1)
+
+        incomplete_future.set_result(True)
+        thread.join()
+        assert labelled.is_set()
+        assert registry[user.id].state == States.LABEL
+        assert registry[user.id].sticker.file_id == sticker.file_id
@@ -1,8 +1,12 @@
+import threading
+from unittest import mock
+
+import flask
 import pytest
 
-from stickertaggerbot import models
-from tests import model_factories
-from tests.misc import clear_all_tables
+from stickertaggerbot import config, db_pool, models, replica
+from tests import model_factories, telegram_factories
+from tests.misc import app_for_testing, clear_all_tables
 
 models.sqlalchemy_logging(True)
 
@@ -95,6 +99,35 @@ class TestInsertion(object):
         assert models.Association.count() == 1
 
 
+class TestExistence(object):
+    @pytest.fixture(scope="function", autouse=True)
+    def clear_tables_before_each_test_function(self):
+        clear_all_tables()
+
+    def test_exists(self):
+        association = model_factories.AssociationFactory()
+        user = models.User.get(association.user_id)
+        sticker = models.Sticker.get(association.sticker_id)
+        label = models.Label.get(association.label_id)
+
+        assert models.User.id_exists(user.id)
+        assert not models.User.id_exists(user.id + 1)
+        assert models.Label.exists(label.text)
+        assert not models.Label.exists(label.text + "_")
+        assert models.Association.exists(user, sticker, label)
+        assert models.Association.sticker_exists(user.id, sticker.id)
+        assert not models.Association.sticker_exists(user.id + 1, sticker.id)
+
+    def test_report_statements(self):
+        @models.report_statements
+        def handler(bot, update):
+            models.User.id_exists(0)
+            models.Label.get_or_create("label", get_only=True)
+
+        handler(None, telegram_factories.UpdateFactory())
+        assert models.statement_counts["handler"] == [1, 2]
+
+
 class TestLabelRetrieval(object):
     def test_get_nonexisting_label(self):
         retrieved_label = models.Label.get_or_create("label0",
@@ -123,6 +156,48 @@ class TestLabelRetrieval(object):
         retrieved_label_ids = models.Label.get_ids(label_texts)
         assert set(retrieved_label_ids) == set(label_ids)
 
+    def test_created_labels_are_cached_after_commit_only(self):
+        label = models.Label.get_or_create("label3")
+        assert label.text not in models.label_id_cache
+
+        models.label_id_cache.update({"cached_label": -1})
+        assert models.Label.get_ids(["cached_label"]) == [-1]
+        assert models.Label.select_ids(["cached_label"]) == [-1]
+
+
+class TestBulkCreation(object):
+    @pytest.fixture(scope="function", autouse=True)
+    def clear_tables_before_each_test_function(self):
+        clear_all_tables()
+
+    def test_get_or_create_all(self):
+        label = model_factories.LabelFactory()
+        texts = [label.text, "new_label_0", "new_label_1", "new_label_0"]
+
+        label_ids = models.Label.get_or_create_all(texts)
+        assert set(label_ids) == set(texts)
+        assert label_ids[label.text] == label.id
+        assert models.Label.count() == 3
+        assert models.Label.get_or_create_all([]) == {}
+
+    def test_bulk_create(self):
+        user = model_factories.UserFactory()
+        sticker = telegram_factories.StickerFactory()
+        existing_label = model_factories.LabelFactory()
+        texts = [existing_label.text, "new_label"]
+
+        associations = models.Association.bulk_create(user.id, sticker, texts)
+        assert sorted(text for _, _, text in associations) == sorted(texts)
+        assert models.Sticker.id_exists(sticker.file_id)
+        assert set(models.Association.get_sticker_ids(user.id, texts)) == \
+            {sticker.file_id}
+
+        # Existing associations are skipped
+        associations = models.Association.bulk_create(
+            user.id, sticker, texts + ["another_label"])
+        assert [text for _, _, text in associations] == ["another_label"]
+        assert models.Association.count("user_id", user.id) == 3
+
 
 # 3 variables: user, sticker, and label.
 # Test cases are designed by considering combinations of the variations.
@@ -290,6 +365,18 @@ class TestAssociationUsage(object):
             association.user_id, association.sticker_id, [label.text])
         assert association.uses == 1
 
+    def test_bulk_increment_usage(self):
+        associations = model_factories.AssociationFactory.build_batch(2)
+        counts = {(association.user_id, association.sticker_id,
+                   association.label_id): uses
+                  for association, uses in zip(associations, [1, 3])}
+        counts[(0, "0", 0)] = 1  # nonexistent
+
+        models.Association.bulk_increment_usage(counts)
+        models.database.session.expire_all()
+
+        assert [association.uses for association in associations] == [1, 3]
+
     # Incrementing should fail silently
     def test_increment_usage_for_nonexistent_association(self):
         models.Association.increment_usage(0, "0", ["label"])
@@ -328,3 +415,276 @@ class TestAssociationUsage(object):
         incremented_uses = [use + 1 for use in current_uses]
 
         assert new_uses == incremented_uses
+
+
+class TestRankedRetrieval(object):
+    @pytest.fixture(scope="function", autouse=True)
+    def clear_tables_before_each_test_function(self):
+        clear_all_tables()
+
+    def test_ranked_by_matching_labels_then_uses(self):
+        user = model_factories.UserFactory()
+        stickers = model_factories.StickerFactory.build_batch(3)
+        labels = model_factories.LabelFactory.build_batch(2)
+
+        # sticker, label, uses
+        raw_associations = [(0, 0, 1),
+                            (1, 0, 5),
+                            (2, 0, 0),
+                            (2, 1, 0)]
+        for s, l, uses in raw_associations:
+            association = model_factories.AssociationFactory(
+                user=user, sticker=stickers[s], label=labels[l])
+            association.uses = uses
+        models.database.session.flush()
+
+        label_texts = [label.text for label in labels]
+        sticker_ids = models.Association.get_ranked_sticker_ids(
+            user.id, label_texts)
+        assert sticker_ids == [stickers[2].id, stickers[1].id, stickers[0].id]
+
+        top_sticker_ids = models.Association.get_ranked_sticker_ids(
+            user.id, label_texts, limit=2)
+        assert top_sticker_ids == [stickers[2].id, stickers[1].id]
+
+    def test_keyset_pagination(self):
+        user = model_factories.UserFactory()
+        stickers = model_factories.StickerFactory.build_batch(5)
+        label = model_factories.LabelFactory()
+        for sticker in stickers:
+            model_factories.AssociationFactory(
+                user=user, sticker=sticker, label=label)
+
+        pages = []
+        after = None
+        while True:
+            page = models.Association.get_ranked_stickers(
+                user.id, [label.text], limit=2, after=after)
+            if not page:
+                break
+            pages.append([sticker_id for sticker_id, _ in page])
+            _, after = page[-1]
+
+        assert pages == [[stickers[0].id, stickers[1].id],
+                         [stickers[2].id, stickers[3].id],
+                         [stickers[4].id]]
+
+    def test_prefix(self):
+        user = model_factories.UserFactory()
+        texts = ["prefix_cat", "prefix_catapult", "prefix%dog"]
+        stickers = model_factories.StickerFactory.build_batch(len(texts))
+        for text, sticker in zip(texts, stickers):
+            model_factories.AssociationFactory(
+                user=user, sticker=sticker,
+                label=model_factories.LabelFactory(text=text))
+
+        sticker_ids = models.Association.get_ranked_sticker_ids(
+            user.id, [], prefix="prefix_cat")
+        assert sticker_ids == [stickers[0].id, stickers[1].id]
+
+        sticker_ids = models.Association.get_ranked_sticker_ids(
+            user.id, [], prefix="prefix%")
+        assert sticker_ids == [stickers[2].id]
+
+        sticker_ids = models.Association.get_ranked_sticker_ids(
+            user.id, [texts[2]], prefix="prefix_catap")
+        assert sticker_ids == [stickers[1].id, stickers[2].id]
+
+    def test_other_users_ignored(self):
+        users = model_factories.UserFactory.build_batch(2)
+        sticker = model_factories.StickerFactory()
+        label = model_factories.LabelFactory()
+        model_factories.AssociationFactory(
+            user=users[1], sticker=sticker, label=label)
+
+        sticker_ids = models.Association.get_ranked_sticker_ids(
+            users[0].id, [label.text])
+        assert sticker_ids == []
+
+
+class TestPendingLabels(object):
+    def test_start(self):
+        user = model_factories.UserFactory()
+        sticker = telegram_factories.StickerFactory()
+
+        first = models.PendingLabels.start(user.id, sticker)
+        second = models.PendingLabels.start(user.id, sticker)
+        assert first.key != second.key
+        assert models.PendingLabels.count("user_id", user.id) == 1
+
+        pending = models.PendingLabels.get_latest(user.id)
+        assert pending.key == second.key
+        assert pending.telegram_sticker.file_id == sticker.file_id
+
+        pending.delete()
+        assert models.PendingLabels.get_latest(user.id) is None
+
+
+class TestSessionScope(object):
+    def test_reuses_current_unit_of_work(self):
+        context = flask._app_ctx_stack.top
+        with models.session_scope(app_for_testing):
+            assert flask._app_ctx_stack.top is context
+
+    def test_unit_of_work_releases_connection(self):
+        @models.unit_of_work(app_for_testing)
+        def handler(bot, update):
+            assert flask.has_app_context()
+            models.User.id_exists(0)
+
+        checkins = db_pool.stats.checkins
+        thread = threading.Thread(
+            target=handler, args=(None, telegram_factories.UpdateFactory()))
+        thread.start()
+        thread.join()
+        assert db_pool.stats.checkins == checkins + 1
+
+
+class TestReplicaRouting(object):
+    @pytest.fixture(scope="function", autouse=True)
+    def replica_bind(self):
+        binds = {replica.BIND: config.DATABASE_URI}
+        with mock.patch.dict(app_for_testing.config,
+                             {"SQLALCHEMY_BINDS": binds}):
+            yield
+        models.recent_writers.clear()
+
+    # Returns the engine a new unit of work reading for user_id reads from
+    def read_bind(self, user_id):
+        binds = []
+
+        def read():
+            with models.session_scope(app_for_testing, read_only_for=user_id):
+                binds.append(models.database.session().get_bind())
+
+        thread = threading.Thread(target=read)
+        thread.start()
+        thread.join()
+        return binds[0]
+
+    def test_reads_from_replica(self):
+        replica_engine = models.database.get_engine(app_for_testing,
+                                                    bind=replica.BIND)
+        assert self.read_bind(1) is replica_engine
+
+    def test_recent_writer_reads_from_primary(self):
+        models.record_writers([1])
+        models.database.session.commit()
+        assert 1 in models.recent_writers
+        assert self.read_bind(1) is models.database.get_engine(
+            app_for_testing)
+
+
+class TestStickerSummary(object):
+    @pytest.fixture(scope="function", autouse=True)
+    def clear_tables_before_each_test_function(self):
+        clear_all_tables()
+
+    def get_summary(self, user_id, sticker_id):
+        return models.StickerSummary.query.filter_by(
+            user_id=user_id, sticker_id=sticker_id).one()
+
+    def test_bulk_create(self):
+        user = model_factories.UserFactory()
+        sticker = telegram_factories.StickerFactory()
+        models.Association.bulk_create(user.id, sticker, ["label_0"])
+        models.Association.bulk_create(user.id, sticker,
+                                       ["label_0", "label_1"])
+
+        summary = self.get_summary(user.id, sticker.file_id)
+        assert summary.label_ids == sorted(
+            models.Label.get_ids(["label_0", "label_1"]))
+        assert summary.uses == 0
+        assert models.StickerSummary.user_has_stickers(user.id)
+        assert not models.StickerSummary.user_has_stickers(user.id + 1)
+
+    def test_usage(self):
+        user = model_factories.UserFactory()
+        sticker = telegram_factories.StickerFactory()
+        associations = models.Association.bulk_create(
+            user.id, sticker, ["label_0", "label_1"])
+
+        models.Association.increment_usage(user.id, sticker.file_id,
+                                           ["label_0", "label_1"])
+        models.Association.bulk_increment_usage(
+            {(user.id, sticker.file_id, label_id): 3
+             for _, label_id, _ in associations})
+
+        summary = self.get_summary(user.id, sticker.file_id)
+        models.database.session.refresh(summary)
+        assert summary.uses == 8
+        assert summary.last_used is not None
+
+    def test_ranked_stickers(self):
+        user = model_factories.UserFactory()
+        stickers = telegram_factories.StickerFactory.build_batch(3)
+        models.Association.bulk_create(user.id, stickers[0], ["a"])
+        models.Association.bulk_create(user.id, stickers[1], ["a", "b"])
+        models.Association.bulk_create(user.id, stickers[2], ["c"])
+
+        ranked = models.StickerSummary.get_ranked_stickers(user.id,
+                                                           ["a", "b"])
+        assert [sticker_id for sticker_id, _ in ranked] == \
+            [stickers[1].file_id, stickers[0].file_id]
+
+        _, after = ranked[0]
+        page = models.StickerSummary.get_ranked_stickers(
+            user.id, ["a", "b"], limit=1, after=after)
+        assert [sticker_id for sticker_id, _ in page] == \
+            [stickers[0].file_id]
+
+        prefixed = models.StickerSummary.get_ranked_stickers(
+            user.id, [], prefix="c")
+        assert [sticker_id for sticker_id, _ in prefixed] == \
+            [stickers[2].file_id]
+
+        # Uncached labels are looked up within the statement
+        other_user = model_factories.UserFactory()
+        models.Association.bulk_create(other_user.id, stickers[0], ["cat"])
+        prefixed = models.StickerSummary.get_ranked_stickers(
+            user.id, ["x"], prefix="c")
+        assert [sticker_id for sticker_id, _ in prefixed] == \
+            [stickers[2].file_id]
+
+    def test_rebuild(self):
+        user = model_factories.UserFactory()
+        sticker = telegram_factories.StickerFactory()
+        models.Association.bulk_create(user.id, sticker, ["label"])
+        models.StickerSummary.query.delete()
+
+        assert models.StickerSummary.rebuild() == 1
+        assert self.get_summary(user.id, sticker.file_id).label_ids == \
+            models.Label.get_ids(["label"])
+
+
+class TestLabelSearch(object):
+    @pytest.fixture(scope="function", autouse=True)
+    def clear_tables_before_each_test_function(self):
+        clear_all_tables()
+
+    def test_search_ids(self):
+        user = model_factories.UserFactory()
+        sticker = telegram_factories.StickerFactory()
+        models.Association.bulk_create(user.id, sticker, ["cat", "dog", "😺"])
+        label_ids = models.Label.get_or_create_all(["cat", "dog", "😺"])
+
+        assert models.Label.search_ids(
+            user.id, ["cats"], search_config="english") == [label_ids["cat"]]
+        assert models.Label.search_ids(user.id, ["😺"]) == [label_ids["😺"]]
+        assert models.Label.search_ids(user.id, [], prefix="do") == \
+            [label_ids["dog"]]
+        assert models.Label.search_ids(user.id, []) == []
+
+    def test_search_ids_limited_to_user(self):
+        users = model_factories.UserFactory.create_batch(2)
+        sticker = telegram_factories.StickerFactory()
+        models.Association.bulk_create(
+            users[0].id, sticker, ["dog_" + str(i) for i in range(5)])
+        models.Association.bulk_create(users[1].id, sticker, ["dog"])
+        label_ids = models.Label.get_ids(["dog"])
+
+        # Other users' matching labels do not use up the limit
+        assert models.Label.search_ids(users[1].id, ["dog"], prefix="dog",
+                                       limit=2) == label_ids
+        assert len(models.Label.search_ids(users[0].id, [], prefix="dog",
+                                           limit=2)) == 2
@@ -0,0 +1,99 @@
+import threading
+
+import pytest
+
+from stickertaggerbot import executor
+from stickertaggerbot.executor import Lane
+
+
+def test_parse_limits():
+    assert executor.parse_limits("chat=3, bookkeeping=1") == {
+        Lane.CHAT: 3, Lane.BOOKKEEPING: 1}
+    assert executor.parse_limits("") == {}
+
+
+class TestExecutor(object):
+    def test_submit(self):
+        tasks = executor.Executor(2)
+        tasks.start()
+        future = tasks.submit(Lane.CHAT, sum, [1, 2])
+        assert future.result(timeout=1) == 3
+        tasks.stop()
+
+        stats = tasks.stats[Lane.CHAT]
+        assert stats.submitted == stats.completed == 1
+        assert stats.running == 0
+
+    def test_exception(self):
+        tasks = executor.Executor(1)
+        tasks.start()
+        future = tasks.submit(Lane.CHAT, int, "not a number")
+        with pytest.raises(ValueError):
+            future.result(timeout=1)
+        tasks.stop()
+
+    def test_priority(self):
+        tasks = executor.Executor(1)
+        order = []
+        for lane in reversed(Lane):
+            tasks.submit(lane, order.append, lane)
+
+        tasks.start()
+        tasks.stop()
+        assert order == list(Lane)
+
+    def test_lane_limit(self):
+        tasks = executor.Executor(2, {Lane.BOOKKEEPING: 1})
+        release = threading.Event()
+        for _ in range(3):
+            tasks.submit(Lane.BOOKKEEPING, release.wait)
+        tasks.start()
+
+        # The second worker is left free for inline queries
+        inline = tasks.submit(Lane.INLINE, lambda: "answered")
+        assert inline.result(timeout=1) == "answered"
+        assert tasks.stats[Lane.BOOKKEEPING].running == 1
+        assert tasks.queued(Lane.BOOKKEEPING) == 2
+
+        release.set()
+        tasks.stop()
+        assert tasks.stats[Lane.BOOKKEEPING].completed == 3
+        assert tasks.stats[Lane.BOOKKEEPING].max_wait > 0
+
+    def test_check_while_chat_lane_full(self):
+        tasks = executor.Executor(2, {Lane.CHAT: 1})
+        tasks.start()
+        checks = []
+        labels_started = threading.Event()
+        check_submitted = threading.Event()
+
+        # Waits for the sticker check, as the labels handler does
+        def labels_handler():
+            labels_started.set()
+            check_submitted.wait(1)
+            return checks[0].result(timeout=1)
+
+        labels = tasks.submit(Lane.CHAT, labels_handler)
+        assert labels_started.wait(1)
+        checks.append(tasks.submit(Lane.CHECK, lambda: True))
+        check_submitted.set()
+
+        assert labels.result(timeout=2) is True
+        tasks.stop()
+
+    def test_default_limits_keep_inline_reserve(self):
+        limits = executor.default_limits(16)
+        assert sum(limit for lane, limit in limits.items()
+                   if lane != Lane.INLINE) == 12
+
+    def test_run_async(self):
+        tasks = executor.Executor(1)
+        tasks.start()
+
+        @tasks.run_async(Lane.CHAT)
+        def handler(bot, update):
+            return update
+
+        assert handler.__wrapped__(None, 1) == 1
+        assert handler(None, 2).result(timeout=1) == 2
+        tasks.stop()
@@ -0,0 +1,185 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from stickertaggerbot import index
+from tests.misc import app_for_testing
+
+base_patch_path = "stickertaggerbot.index"
+
+
+@pytest.fixture()
+def user_index():
+    # (association_id, label_id, label_text, sticker_id, uses)
+    rows = [(0, 0, "label_0", "sticker_0", 0),
+            (1, 1, "label_1", "sticker_0", 2),
+            (2, 1, "label_1", "sticker_1", 1)]
+    return index.UserIndex(rows)
+
+
+class TestTrie(object):
+    def test_find(self):
+        trie = index.Trie()
+        trie.add("cat", 0)
+        trie.add("catapult", 1)
+        trie.add("dog", 2)
+
+        assert trie.find("c") == {0, 1}
+        assert trie.find("cat") == {0, 1}
+        assert trie.find("cata") == {1}
+        assert trie.find("") == {0, 1, 2}
+        assert trie.find("cow") == set()
+
+
+class TestUserIndex(object):
+    def test_empty(self):
+        user_index = index.UserIndex()
+        assert user_index.is_empty()
+        assert user_index.get_sticker_ids(["label_0"]) == []
+
+    def test_get_sticker_ids(self, user_index):
+        assert user_index.get_sticker_ids(["label_0"]) == ["sticker_0"]
+        assert set(user_index.get_sticker_ids(["label_1"])) == \
+            {"sticker_0", "sticker_1"}
+        assert set(user_index.get_sticker_ids(["label_0", "label_1"])) == \
+            {"sticker_0", "sticker_1"}
+        assert user_index.get_sticker_ids(["nonexistent"]) == []
+
+    def test_get_ranked_sticker_ids(self, user_index):
+        assert user_index.get_ranked_sticker_ids(["label_0", "label_1"]) == \
+            ["sticker_0", "sticker_1"]
+        assert user_index.get_ranked_sticker_ids(["label_1"]) == \
+            ["sticker_0", "sticker_1"]
+        assert user_index.get_ranked_sticker_ids(["label_1"], limit=1) == \
+            ["sticker_0"]
+
+    def test_get_ranked_stickers_after(self, user_index):
+        first_page = user_index.get_ranked_stickers(["label_1"], limit=1)
+        assert first_page == [("sticker_0", (1, 2, 1))]
+
+        _, after = first_page[-1]
+        second_page = user_index.get_ranked_stickers(["label_1"], after=after)
+        assert second_page == [("sticker_1", (1, 1, 2))]
+
+    def test_get_ranked_stickers_with_prefix(self, user_index):
+        assert user_index.get_ranked_sticker_ids([], prefix="label_") == \
+            ["sticker_0", "sticker_1"]
+        assert user_index.get_ranked_sticker_ids([], prefix="label_0") == \
+            ["sticker_0"]
+        assert user_index.get_ranked_sticker_ids(["label_0"],
+                                                 prefix="lab") == \
+            ["sticker_0", "sticker_1"]
+        assert user_index.get_ranked_sticker_ids([], prefix="x") == []
+
+    def test_get_ranked_stickers_by_ids(self, user_index):
+        # Labels found by full-text search the user does not have are ignored
+        assert user_index.get_ranked_stickers_by_ids([0, 5]) == \
+            [("sticker_0", (1, 0, 0))]
+        assert user_index.get_ranked_stickers_by_ids([]) == []
+
+    def test_add_sticker(self, user_index):
+        added = user_index.add_sticker("sticker_2", [(3, 0, "label_0"),
+                                                     (4, 2, "label_2")])
+        assert added == 2
+        assert set(user_index.get_sticker_ids(["label_0"])) == \
+            {"sticker_0", "sticker_2"}
+        assert user_index.get_sticker_ids(["label_2"]) == ["sticker_2"]
+
+    def test_increment_usage(self, user_index):
+        user_index.increment_usage("sticker_0", ["label_1", "nonexistent"])
+        assert user_index.get_usage_count("sticker_0", "label_1") == 3
+        assert user_index.get_usage_count("sticker_0", "label_0") == 0
+
+
+class TestIndex(object):
+    @pytest.fixture(autouse=True)
+    def patch_database(self):
+        patch = mock.patch(
+            base_patch_path + ".models.Association.get_index_rows",
+            mock.MagicMock(autospec=True,
+                           side_effect=lambda user_id: [
+                               (0, 0, "label", "sticker_" + str(user_id), 0)]))
+        patch.start()
+        yield
+        patch.stop()
+
+    def test_lazy_load(self):
+        users = index.Index(10)
+        assert 0 not in users
+
+        user_index = users.get(app_for_testing, 0)
+        assert 0 in users
+        assert user_index.get_sticker_ids(["label"]) == ["sticker_0"]
+
+        assert users.get(app_for_testing, 0) is user_index
+        index.models.Association.get_index_rows.assert_called_once_with(0)
+
+    def test_lru_eviction(self):
+        users = index.Index(2)
+        users.get(app_for_testing, 0)
+        users.get(app_for_testing, 1)
+        users.get(app_for_testing, 0)
+        users.get(app_for_testing, 2)
+
+        assert 0 in users
+        assert 1 not in users
+        assert 2 in users
+        assert users.size == 2
+
+    def test_too_large(self):
+        users = index.Index(0)
+        assert users.get(app_for_testing, 0) is None
+        assert len(users) == 0
+
+        # Not loaded again until the user labels another sticker
+        assert users.get(app_for_testing, 0) is None
+        index.models.Association.get_index_rows.assert_called_once_with(0)
+
+        users.add_sticker(0, "sticker_1", [(1, 0, "label")])
+        assert users.get(app_for_testing, 0) is None
+        assert index.models.Association.get_index_rows.call_count == 2
+
+    def test_update_during_overlapping_loads(self):
+        users = index.Index(10)
+        calls = iter(range(2))
+        loading = [threading.Event(), threading.Event()]
+        release = [threading.Event(), threading.Event()]
+
+        def get_index_rows(user_id):
+            call = next(calls)
+            loading[call].set()
+            release[call].wait(1)
+            return [(0, 0, "label", "sticker_0", 0)]
+
+        index.models.Association.get_index_rows.side_effect = get_index_rows
+        threads = [threading.Thread(target=users.get,
+                                    args=(app_for_testing, 0))
+                   for _ in range(2)]
+        threads[0].start()
+        assert loading[0].wait(1)
+        threads[1].start()
+        assert loading[1].wait(1)
+
+        users.add_sticker(0, "sticker_1", [(1, 0, "label")])
+        for thread, released in zip(threads, release):
+            released.set()
+            thread.join()
+
+        # Both loads read the rows before the update
+        assert 0 not in users
+        assert users._loading == {}
+
+    def test_updates(self):
+        users = index.Index(10)
+        users.add_sticker(0, "sticker_1", [(1, 0, "label")])
+        assert 0 not in users
+
+        user_index = users.get(app_for_testing, 0)
+        users.add_sticker(0, "sticker_1", [(1, 0, "label")])
+        users.increment_usage(0, "sticker_1", ["label"])
+
+        assert set(user_index.get_sticker_ids(["label"])) == \
+            {"sticker_0", "sticker_1"}
+        assert user_index.get_usage_count("sticker_1", "label") == 1
+        assert users.size == 2
@@ -6,12 +6,23 @@ from stickertaggerbot import message
 from stickertaggerbot.handlers import inline_query
 import stickertaggerbot.inline_query_result as inline_query_result
 from tests import telegram_factories
-from tests.misc import run_handler, bot
+from tests.misc import app_for_testing, run_handler, bot
 
 base_patch_path = "stickertaggerbot.handlers.inline_query"
 
 
 
+class TestGetLabels(object):
+    def test_complete_labels(self):
+        assert inline_query.get_labels("") == ([], None)
+        assert inline_query.get_labels("label_0 label_1 ") == \
+            (["label_0", "label_1"], None)
+
+    def test_partial_label(self):
+        assert inline_query.get_labels("lab") == ([], "lab")
+        assert inline_query.get_labels("label_0 lab") == (["label_0"], "lab")
+
+
 class TestInlineQueryHandler(object):
     @pytest.fixture(autouse=True)
     def patch_telegram(self):
@@ -22,24 +33,20 @@ class TestInlineQueryHandler(object):
 
     @pytest.yield_fixture(autouse=True)
     def patch_user_association(self):
-        filter_return = mock.MagicMock()
-        filter_return.count = mock.MagicMock()
-        query = mock.MagicMock()
-        query.filter_by = mock.MagicMock(autospec=True,
-                                         return_value=filter_return)
-
-        patch = mock.patch(base_patch_path + ".models.Association.query",
-                           query)
+        patch = mock.patch(
+            base_patch_path + ".models.Association.get_index_rows",
+            mock.MagicMock(autospec=True, return_value=[]))
         patch.start()
 
         yield
         patch.stop()
 
-    def set_user_association(self, result):
-        inline_query.models.Association.query.filter_by.return_value.count.return_value = result
+    # rows: [(association_id, label_id, label_text, sticker_id, uses)]
+    def set_user_association(self, rows):
+        inline_query.models.Association.get_index_rows.return_value = rows
 
     def test_new_user(self):
-        self.set_user_association(0)
+        self.set_user_association([])
 
         update = telegram_factories.InlineQueryUpdateFactory(
             inline_query__query="label",
@@ -61,10 +68,8 @@ class TestInlineQueryHandler(object):
             is_personal=True,
             switch_pm_text=message.Text.Inline.START_BUTTON.value)
 
-    @mock.patch(base_patch_path + ".models.Association.get_sticker_ids",
-                mock.MagicMock(autospec=True, return_value=[]))
     def test_no_stickers(self):
-        self.set_user_association(1)
+        self.set_user_association([(0, 0, "other_label", "sticker", 0)])
 
         update = telegram_factories.InlineQueryUpdateFactory(
             inline_query__query="label",
@@ -86,32 +91,148 @@ class TestInlineQueryHandler(object):
             is_personal=True)
 
     def test_one_label(self):
-        self.set_user_association(1)
+        sticker_id = telegram_factories.StickerFactory().file_id
+        sticker_result = inline_query_result.Sticker(sticker_id)
+        self.set_user_association([(0, 0, "label", sticker_id, 0)])
 
         update = telegram_factories.InlineQueryUpdateFactory(
             inline_query__query="label",
             inline_query__bot=bot)
 
-        sticker_id = telegram_factories.StickerFactory().file_id
-        sticker_result = inline_query_result.Sticker(sticker_id)
-
-        with mock.patch(
-                base_patch_path + ".models.Association.get_sticker_ids",
-                mock.MagicMock(autospec=True, return_value=[sticker_id])), \
-             mock.patch(base_patch_path + ".inline_query_result.Sticker",
+        with mock.patch(base_patch_path + ".inline_query_result.Sticker",
                         mock.MagicMock(return_value=sticker_result)):
             run_handler(inline_query.create_inline_query_handler, update)
 
         bot.answer_inline_query.assert_called_once_with(
-            update.inline_query.id, [sticker_result], is_personal=True)
+            update.inline_query.id, [sticker_result], is_personal=True,
+            next_offset="")
+
+    def test_superseded_query(self):
+        self.set_user_association([(0, 0, "label", "sticker_0", 0)])
+        user = telegram_factories.UserFactory()
+        updates = [telegram_factories.InlineQueryUpdateFactory(
+            inline_query__query=query_string,
+            inline_query__from_user=user,
+            inline_query__bot=bot) for query_string in ["l", "label"]]
+
+        for update in updates:
+            app_for_testing.coalescer.register(update)
+        run_handler(inline_query.create_inline_query_handler, updates[0])
+        bot.answer_inline_query.assert_not_called()
+
+        run_handler(inline_query.create_inline_query_handler, updates[1])
+        assert self.answered_sticker_ids() == ["sticker_0"]
+
+    def test_uses_loaded_index(self):
+        sticker_id = telegram_factories.StickerFactory().file_id
+        self.set_user_association([(0, 0, "label", sticker_id, 0)])
+        user = telegram_factories.UserFactory()
+
+        for _ in range(2):
+            update = telegram_factories.InlineQueryUpdateFactory(
+                inline_query__query="label",
+                inline_query__from_user=user,
+                inline_query__bot=bot)
+            run_handler(inline_query.create_inline_query_handler, update)
+
+        inline_query.models.Association.get_index_rows.assert_called_once_with(
+            user.id)
+
+    def answered_sticker_ids(self):
+        (inline_query_id, results), kwargs = \
+            bot.answer_inline_query.call_args
+        return [result.sticker_file_id for result in results]
 
     # Sort stickers by number of matching labels
     def test_multiple_labels(self):
-        pass
+        self.set_user_association([(0, 0, "label_0", "sticker_0", 0),
+                                   (1, 0, "label_0", "sticker_1", 0),
+                                   (2, 1, "label_1", "sticker_1", 0),
+                                   (3, 2, "label_2", "sticker_2", 0)])
+
+        update = telegram_factories.InlineQueryUpdateFactory(
+            inline_query__query="label_0 label_1",
+            inline_query__bot=bot)
+        run_handler(inline_query.create_inline_query_handler, update)
+
+        assert self.answered_sticker_ids() == ["sticker_1", "sticker_0"]
 
     # Sort stickers by number of matching labels, then by frequency of usage
     def test_multiple_labels_with_usage_frequency(self):
-        pass
+        self.set_user_association([(0, 0, "label_0", "sticker_0", 1),
+                                   (1, 0, "label_0", "sticker_1", 5),
+                                   (2, 0, "label_0", "sticker_2", 3),
+                                   (3, 1, "label_1", "sticker_2", 0)])
+
+        update = telegram_factories.InlineQueryUpdateFactory(
+            inline_query__query="label_0 label_1",
+            inline_query__bot=bot)
+        run_handler(inline_query.create_inline_query_handler, update)
+
+        assert self.answered_sticker_ids() == \
+            ["sticker_2", "sticker_1", "sticker_0"]
+
+    def test_partial_label(self):
+        self.set_user_association([(0, 0, "happy", "sticker_0", 0),
+                                   (1, 1, "cat", "sticker_1", 0),
+                                   (2, 2, "catapult", "sticker_2", 0)])
+
+        update = telegram_factories.InlineQueryUpdateFactory(
+            inline_query__query="ca",
+            inline_query__bot=bot)
+        run_handler(inline_query.create_inline_query_handler, update)
+
+        assert self.answered_sticker_ids() == ["sticker_1", "sticker_2"]
 
     def test_pagination(self):
-        pass
+        total = inline_query.MAX_RESULTS + 1
+        self.set_user_association(
+            [(i, 0, "label", "sticker_" + str(i), 0) for i in range(total)])
+        user = telegram_factories.UserFactory()
+
+        update = telegram_factories.InlineQueryUpdateFactory(
+            inline_query__query="label",
+            inline_query__from_user=user,
+            inline_query__bot=bot)
+        run_handler(inline_query.create_inline_query_handler, update)
+
+        first_page = self.answered_sticker_ids()
+        next_offset = bot.answer_inline_query.call_args[1]["next_offset"]
+        assert len(first_page) == inline_query.MAX_RESULTS
+        assert next_offset
+
+        update = telegram_factories.InlineQueryUpdateFactory(
+            inline_query__query="label",
+            inline_query__offset=next_offset,
+            inline_query__from_user=user,
+            inline_query__bot=bot)
+        run_handler(inline_query.create_inline_query_handler, update)
+
+        second_page = self.answered_sticker_ids()
+        assert bot.answer_inline_query.call_args[1]["next_offset"] == ""
+        assert second_page == ["sticker_" + str(total - 1)]
+        assert set(first_page + second_page) == \
+            {"sticker_" + str(i) for i in range(total)}
+
+    def test_offset_of_other_ranking(self):
+        self.set_user_association([(0, 0, "label", "sticker_0", 0)])
+
+        update = telegram_factories.InlineQueryUpdateFactory(
+            inline_query__query="label",
+            inline_query__offset=inline_query_result.Offset.generate(
+                inline_query_result.Offset.BY_STICKER_USES, (1, 0, 0)),
+            inline_query__bot=bot)
+        run_handler(inline_query.create_inline_query_handler, update)
+
+        assert self.answered_sticker_ids() == []
+
+    def test_invalid_offset(self):
+        self.set_user_association([(0, 0, "label", "sticker_0", 0)])
+
+        update = telegram_factories.InlineQueryUpdateFactory(
+            inline_query__query="label",
+            inline_query__offset="invalid",
+            inline_query__bot=bot)
+        run_handler(inline_query.create_inline_query_handler, update)
+
+        assert self.answered_sticker_ids() == ["sticker_0"]
@@ -0,0 +1,25 @@
+from stickertaggerbot import label_cache
+
+
+class TestLabelCache(object):
+    def test_get_many(self):
+        cache = label_cache.LabelCache(10)
+        cache.update({"label_0": 0, "label_1": 1})
+
+        found, missing = cache.get_many(["label_0", "label_2"])
+        assert found == {"label_0": 0}
+        assert missing == ["label_2"]
+        assert cache.hits == 1
+        assert cache.misses == 1
+
+    def test_lru_eviction(self):
+        cache = label_cache.LabelCache(2)
+        cache.update({"label_0": 0})
+        cache.update({"label_1": 1})
+        cache.get_many(["label_0"])
+        cache.update({"label_2": 2})
+
+        assert "label_0" in cache
+        assert "label_1" not in cache
+        assert "label_2" in cache
+        assert len(cache) == 2
@@ -0,0 +1,71 @@
+import logging as std_logging
+from unittest import mock
+
+from stickertaggerbot import logging
+
+
+class TestGetLogger(object):
+    def test_no_logger_per_update(self):
+        first = logging.get_logger(logging.Type.HANDLER_STICKER, 1)
+        second = logging.get_logger(logging.Type.HANDLER_STICKER, 2)
+
+        assert first.logger is second.logger
+        assert first.logger is logging.get_logger(logging.Type.HANDLER_STICKER)
+        assert logging.Type.HANDLER_STICKER.value + ".1" not in \
+            std_logging.Logger.manager.loggerDict
+
+    def test_helpers(self):
+        logger = logging.get_logger(logging.Type.HANDLER_STICKER, 1)
+
+        with mock.patch.object(logger.logger, "isEnabledFor",
+                               return_value=True), \
+                mock.patch.object(logger.logger, "log") as log:
+            logger.log_start()
+
+        (level, msg), kwargs = log.call_args
+        assert level == std_logging.DEBUG
+        assert msg == "[1] Handling update"
+        assert kwargs["extra"] == {"update_id": 1}
+
+
+class TestPipeline(object):
+    def test_batched_writes(self, tmpdir):
+        path = str(tmpdir.join("log"))
+        handler = logging.BatchingFileHandler(path, batch_size=2)
+        record = std_logging.makeLogRecord({"msg": "%s", "args": ("line",),
+                                            "levelno": std_logging.DEBUG})
+
+        handler.handle(record)
+        assert open(path).read() == ""
+
+        handler.handle(record)
+        assert open(path).read() == "line\nline\n"
+        handler.close()
+
+    def test_listener_flushes_when_idle(self, tmpdir):
+        path = str(tmpdir.join("log"))
+        handler = logging.BatchingFileHandler(path, batch_size=100)
+        log_queue = logging.queue.Queue()
+        listener = logging.BatchingQueueListener(log_queue, 0.01, handler)
+        listener.start()
+
+        logging.DeferredQueueHandler(log_queue).handle(
+            std_logging.makeLogRecord({"msg": "line",
+                                       "levelno": std_logging.DEBUG}))
+        listener.stop()
+        assert open(path).read() == "line\n"
+        handler.close()
+
+    def test_debug_sampler(self):
+        sampler = logging.DebugSampler(0)
+        assert not sampler.filter(
+            std_logging.makeLogRecord({"levelno": std_logging.DEBUG}))
+        assert sampler.filter(
+            std_logging.makeLogRecord({"levelno": std_logging.INFO}))
+
+    def test_set_levels(self):
+        logging.set_levels("test_logging.a=INFO, test_logging.b=warning")
+        assert std_logging.getLogger("test_logging.a").level == \
+            std_logging.INFO
+        assert std_logging.getLogger("test_logging.b").level == \
+            std_logging.WARNING
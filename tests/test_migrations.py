@@ -0,0 +1,23 @@
+from stickertaggerbot import migrations, models
+from tests.misc import app_for_testing
+
+engine = models.database.get_engine(app_for_testing)
+
+
+def test_upgrade_is_idempotent():
+    assert migrations.upgrade(engine) == migrations.latest_version()
+    assert migrations.upgrade(engine) == migrations.latest_version()
+
+
+def test_hot_queries_use_indexes():
+    assert migrations.check_plans(engine) == {}
+
+
+def test_find_seq_scans():
+    plan = {"Node Type": "Hash Join",
+            "Plans": [{"Node Type": "Index Only Scan",
+                       "Relation Name": "association"},
+                      {"Node Type": "Hash",
+                       "Plans": [{"Node Type": "Seq Scan",
+                                  "Relation Name": "label"}]}]}
+    assert migrations.find_seq_scans(plan) == ["label"]
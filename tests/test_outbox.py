@@ -0,0 +1,73 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+import telegram.error
+
+from stickertaggerbot import outbox
+
+
+class TestTokenBucket(object):
+    def test_rate(self):
+        bucket = outbox.TokenBucket(2, 1)
+        now = time.monotonic()
+        assert bucket.delay(now) == 0
+
+        bucket.take(now)
+        assert bucket.delay(now) == pytest.approx(0.5)
+        assert bucket.delay(now + 0.5) == pytest.approx(0)
+
+    def test_pause(self):
+        bucket = outbox.TokenBucket(1, 1)
+        now = time.monotonic()
+        bucket.pause(now, 5)
+        assert bucket.delay(now) == pytest.approx(6)
+        assert bucket.delay(now + 6) == pytest.approx(0)
+
+
+class TestOutbox(object):
+    def test_in_order_per_chat(self):
+        messages = outbox.Outbox(4, 1000, 1000)
+        sent = []
+        for number in range(10):
+            messages.put(0, lambda number=number: sent.append(number))
+
+        messages.start()
+        messages.stop()
+        assert sent == list(range(10))
+        assert messages.sent == 10
+        assert len(messages) == 0
+
+    def test_chat_rate(self):
+        messages = outbox.Outbox(2, 1000, 10)
+        times = []
+        for _ in range(3):
+            messages.put(0, lambda: times.append(time.monotonic()))
+
+        messages.start()
+        messages.stop()
+        assert times[2] - times[0] >= 0.15
+
+    def test_retry_after(self):
+        messages = outbox.Outbox(1, 1000, 1000)
+        send = mock.Mock(side_effect=[telegram.error.RetryAfter(0.1), None])
+        messages.put(0, send)
+
+        messages.start()
+        messages.stop()
+        assert send.call_count == 2
+        assert messages.retried == 1
+        assert messages.sent == 1
+
+    def test_other_chats_are_not_blocked(self):
+        messages = outbox.Outbox(2, 1000, 1000)
+        blocked = threading.Event()
+        sent = threading.Event()
+        messages.put(0, lambda: blocked.wait(3))
+        messages.put(1, sent.set)
+
+        messages.start()
+        assert sent.wait(3)
+        blocked.set()
+        messages.stop()
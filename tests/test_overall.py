@@ -135,4 +135,4 @@ class TestNormalUsage(object):
 
         result = [stickertaggerbot.inline_query_result.Sticker(self.sticker.file_id)]
         app_for_testing.bot.answer_inline_query.assert_called_once_with(
-            update.inline_query.id, result, is_personal=True)
+            update.inline_query.id, result, is_personal=True, next_offset="")
@@ -0,0 +1,24 @@
+import time
+
+from stickertaggerbot import replica
+
+
+class TestRecentWriters(object):
+    def test_window(self):
+        writers = replica.RecentWriters(0.05)
+        writers.add([1, 2])
+        assert 1 in writers
+        assert 3 not in writers
+        assert len(writers) == 2
+
+        time.sleep(0.06)
+        assert 1 not in writers
+        assert len(writers) == 0
+
+    def test_write_extends_window(self):
+        writers = replica.RecentWriters(0.05)
+        writers.add([1])
+        time.sleep(0.03)
+        writers.add([1])
+        time.sleep(0.03)
+        assert 1 in writers
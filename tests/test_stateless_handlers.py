@@ -0,0 +1,119 @@
+from unittest import mock
+
+import pytest
+
+from stickertaggerbot import message, CallbackData
+from stickertaggerbot.handlers import stateless
+from tests import telegram_factories
+from tests.misc import outgoing_message_patches, assert_sent_message_once, \
+    run_handler
+
+base_patch_path = "stickertaggerbot.handlers.stateless"
+models_patch_path = base_patch_path + ".models"
+States = stateless.conversations.Conversation.State
+
+
+class TestStatelessLabelling(object):
+    @pytest.fixture(autouse=True)
+    def patches(self):
+        patches = outgoing_message_patches(base_patch_path)
+        patches.append(mock.patch(
+            models_patch_path + ".database.session.commit"))
+        patches.append(mock.patch(
+            base_patch_path + ".sticker_is_new",
+            mock.MagicMock(autospec=True, return_value=True)))
+
+        for patch in patches:
+            patch.start()
+        yield
+        for patch in patches:
+            patch.stop()
+
+    @pytest.fixture()
+    def user(self):
+        return telegram_factories.UserFactory()
+
+    @pytest.fixture()
+    def pending(self, user):
+        pending = mock.MagicMock()
+        pending.key = "key"
+        pending.user_id = user.id
+        pending.labels = ["label_0", "label_1"]
+        pending.telegram_sticker = telegram_factories.StickerFactory()
+        return pending
+
+    def callback_query_update(self, user, button_text, signed_key):
+        callback_data = CallbackData(States.LABEL, signed_key)
+        return telegram_factories.CallbackQueryUpdateFactory(
+            callback_query__from_user=user,
+            callback_query__data=callback_data.generator(button_text))
+
+    @mock.patch(models_patch_path + ".PendingLabels.start")
+    def test_sticker(self, start, user):
+        update = telegram_factories.StickerUpdateFactory(
+            message__from_user=user)
+        run_handler(stateless.create_sticker_handler, update)
+
+        start.assert_called_once_with(user.id,
+                                      update.effective_message.sticker)
+        assert_sent_message_once(message.Text.Instruction.LABEL)
+
+    @mock.patch(models_patch_path + ".PendingLabels.get_latest",
+                mock.MagicMock(return_value=None))
+    def test_labels_without_sticker(self, user):
+        update = telegram_factories.MessageUpdateFactory(
+            message__text="label", message__from_user=user)
+        run_handler(stateless.create_labels_handler, update)
+
+        assert_sent_message_once(message.Text.Error.NOT_STARTED)
+
+    @mock.patch(models_patch_path + ".Association.bulk_create",
+                mock.MagicMock(autospec=True, return_value=[]))
+    def test_confirm(self, user, pending):
+        update = self.callback_query_update(
+            user, CallbackData.ButtonText.CONFIRM, CallbackData.sign("key"))
+
+        with mock.patch(models_patch_path + ".PendingLabels.get",
+                        mock.MagicMock(return_value=pending)) as get:
+            run_handler(stateless.create_callback_handler, update)
+
+        get.assert_called_once_with("key")
+        stateless.models.Association.bulk_create.assert_called_once_with(
+            user.id, pending.telegram_sticker, pending.labels)
+        pending.delete.assert_called_once()
+        assert_sent_message_once(message.Text.Other.SUCCESS)
+
+    def test_cancel(self, user, pending):
+        update = self.callback_query_update(
+            user, CallbackData.ButtonText.CANCEL, CallbackData.sign("key"))
+
+        with mock.patch(models_patch_path + ".PendingLabels.get",
+                        mock.MagicMock(return_value=pending)):
+            run_handler(stateless.create_callback_handler, update)
+
+        assert pending.labels is None
+        assert_sent_message_once(message.Text.Instruction.RE_LABEL)
+
+    def test_forged_key(self, user, pending):
+        update = self.callback_query_update(
+            user, CallbackData.ButtonText.CONFIRM, "key.forged")
+
+        with mock.patch(models_patch_path + ".PendingLabels.get",
+                        mock.MagicMock(return_value=pending)) as get:
+            run_handler(stateless.create_callback_handler, update)
+
+        get.assert_not_called()
+        assert_sent_message_once(message.Text.Error.UNKNOWN)
+
+
+class TestSignedKeys(object):
+    def test_sign(self):
+        signed_key = CallbackData.sign("key")
+        assert CallbackData.unsign(signed_key) == "key"
+        assert CallbackData.unsign(signed_key + "x") is None
+
+    def test_fits_in_callback_data(self):
+        key = "k" * 11
+        callback_data = CallbackData(States.LABEL, CallbackData.sign(key))
+        generated = callback_data.generator(CallbackData.ButtonText.CONFIRM)
+        assert len(generated.encode()) <= 64
@@ -12,6 +12,13 @@ base_patch_path = "stickertaggerbot.handlers.sticker"
 States = stickertaggerbot.conversations.Conversation.State
 
 
+# Calls back with result as soon as the handler waits on the conversation
+def complete_future(waiting_conversation, result):
+    waiting_conversation.when_future_done = mock.MagicMock(
+        autospec=True,
+        side_effect=lambda callback, timeout=3: callback(result))
+
+
 class TestStickerHandler(object):
     @pytest.yield_fixture(autouse=True)
     def patches(self):
@@ -37,6 +44,7 @@ class TestStickerHandler(object):
                 mock.MagicMock(autospec=True, return_value=True))
     def test_new_sticker(self, update_maker, conversation):
         update = update_maker(conversation)
+        complete_future(conversation, True)
 
         with mock.patch(*get_or_create(conversation)):
             run_handler(
@@ -64,7 +72,7 @@ class TestStickerHandler(object):
     def test_sticker_exists(self, update_maker, conversation):
         update = update_maker(conversation)
 
-        conversation.get_future_result = mock.MagicMock(return_value=False)
+        complete_future(conversation, False)
 
         with mock.patch(*get_or_create(conversation)):
             run_handler(
@@ -76,8 +84,7 @@ class TestStickerHandler(object):
 
     def test_future_timed_out(self, update_maker, conversation):
         update = update_maker(conversation)
-        conversation.get_future_result = mock.MagicMock(autospec=True,
-                                                        return_value=None)
+        complete_future(conversation, None)
 
         with mock.patch(*get_or_create(conversation)):
             run_handler(
@@ -0,0 +1,15 @@
+from stickertaggerbot import text_search
+
+
+def test_config_for():
+    assert text_search.config_for("en-US") == "english"
+    assert text_search.config_for("pt-BR") == "portuguese"
+    assert text_search.config_for("nb") == "norwegian"
+    assert text_search.config_for("zh-hans") == text_search.DEFAULT
+    assert text_search.config_for(None) == text_search.DEFAULT
+
+
+def test_vector_sql():
+    sql = text_search.vector_sql("text")
+    assert "to_tsvector('english', text)" in sql
+    assert sql.endswith("to_tsvector('simple', text)")
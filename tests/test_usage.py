@@ -0,0 +1,67 @@
+from unittest import mock
+
+from stickertaggerbot import usage
+from tests.misc import app_for_testing
+
+base_patch_path = "stickertaggerbot.usage"
+
+
+class TestUsageBuffer(object):
+    def test_add(self):
+        buffer = usage.UsageBuffer(app_for_testing, 60, 10, 1)
+        buffer.add(0, "sticker_0", [0, 1])
+        buffer.add(0, "sticker_0", [0])
+
+        assert len(buffer) == 2
+        assert buffer._counts[(0, "sticker_0", 0)] == 2
+        assert not buffer._wake.is_set()
+
+        buffer.add(1, "sticker_0", range(7))
+        assert buffer._wake.is_set()
+
+    @mock.patch(base_patch_path + ".models.database.session.commit")
+    @mock.patch(base_patch_path + ".models.Association.bulk_increment_usage")
+    def test_flush(self, bulk_increment_usage, commit):
+        buffer = usage.UsageBuffer(app_for_testing, 60, 10, 1)
+        buffer.add(0, "sticker_0", [0, 1])
+        buffer.add(0, "sticker_0", [0])
+        buffer.flush()
+
+        bulk_increment_usage.assert_called_once_with(
+            {(0, "sticker_0", 0): 2, (0, "sticker_0", 1): 1})
+        commit.assert_called_once_with()
+        assert len(buffer) == 0
+        assert buffer.flushed_events == 3
+
+        buffer.flush()
+        bulk_increment_usage.assert_called_once()
+
+    @mock.patch(base_patch_path + ".models.database.session.rollback")
+    @mock.patch(base_patch_path + ".models.Association.bulk_increment_usage",
+                mock.MagicMock(side_effect=Exception("error")))
+    def test_failed_flush(self, rollback):
+        buffer = usage.UsageBuffer(app_for_testing, 60, 10, 1)
+        buffer.add(0, "sticker_0", [0])
+        buffer.flush()
+
+        rollback.assert_called_once_with()
+        assert buffer._counts[(0, "sticker_0", 0)] == 1
+
+        buffer.add(0, "sticker_0", [0])
+        buffer.flush()
+        assert len(buffer) == 0
+        assert buffer.dropped_events == 2
+
+        # Failures are counted afresh after dropping
+        buffer.add(0, "sticker_0", [0])
+        buffer.flush()
+        assert buffer._counts[(0, "sticker_0", 0)] == 1
+
+    @mock.patch(base_patch_path + ".UsageBuffer.flush")
+    def test_stop(self, flush):
+        buffer = usage.UsageBuffer(app_for_testing, 60, 10, 1)
+        buffer.start()
+        buffer.stop()
+
+        assert not buffer._thread.is_alive()
+        assert flush.called
@@ -0,0 +1,56 @@
+import threading
+
+from stickertaggerbot import webhook
+from tests import telegram_factories
+
+
+class TestReplies(object):
+    def test_reply_before_deadline(self):
+        replies = webhook.Replies()
+        update = telegram_factories.InlineQueryUpdateFactory()
+        replies.expect(update)
+        assert replies.is_waiting(update)
+
+        threading.Timer(0.1, replies.give,
+                        [update, "answerInlineQuery"],
+                        {"inline_query_id": "0"}).start()
+
+        payload = replies.wait(update, 3)
+        assert payload == {"method": "answerInlineQuery",
+                           "inline_query_id": "0"}
+        assert not replies.is_waiting(update)
+        assert replies.replied == 1
+
+    def test_reply_after_deadline(self):
+        replies = webhook.Replies()
+        update = telegram_factories.InlineQueryUpdateFactory()
+        replies.expect(update)
+
+        assert replies.wait(update, 0.01) is None
+        assert not replies.give(update, "answerInlineQuery")
+        assert replies.timed_out == 1
+
+    def test_release(self):
+        replies = webhook.Replies()
+        update = telegram_factories.InlineQueryUpdateFactory()
+        replies.expect(update)
+
+        replies.release(update)
+        assert replies.wait(update, 3) is None
+
+    def test_not_waiting(self):
+        replies = webhook.Replies()
+        update = telegram_factories.InlineQueryUpdateFactory()
+        assert not replies.give(update, "answerInlineQuery")
+
+
+class TestExpectsReply(object):
+    def test_update_types(self):
+        assert webhook.expects_reply(
+            telegram_factories.InlineQueryUpdateFactory())
+        assert webhook.expects_reply(
+            telegram_factories.StickerUpdateFactory())
+        assert webhook.expects_reply(
+            telegram_factories.CommandUpdateFactory(command="/start"))
+        assert not webhook.expects_reply(
+            telegram_factories.MessageUpdateFactory(message__text="label"))